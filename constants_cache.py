@@ -0,0 +1,167 @@
+'''This module has an opt-in on-disk cache for expensive constants which only
+depend on a motor and a waveform.
+
+Entries are content-addressed: the key is a hash of everything the constants
+depend on, so changing a motor or waveform definition simply results in a
+different entry. Old entries are evicted once the cache gets too big.
+
+Keys include VERSION, which must be incremented whenever the calculations
+change in a way that affects the results.
+'''
+
+import hashlib
+import json
+import os
+import tempfile
+
+import numpy
+
+import models
+
+VERSION = 5
+
+def _float_key(value):
+  '''Returns an exact string representation of a float.'''
+  return float(value).hex()
+
+def _coeff_key(coeff):
+  return [[_float_key(a), _float_key(b), _float_key(c)]
+          for a, (b, c) in sorted(coeff.items())]
+
+def motor_fingerprint(motor):
+  '''Returns a JSON-compatible description of the parts of a models.Motor
+  which affect electrical calculations.'''
+  return {'f_coeff': _coeff_key(motor.f_coeff),
+          'resistance': _float_key(motor.resistance),
+          'self_inductance': _float_key(motor.self_inductance)}
+
+# The number of points to sample waveforms with no better description at.
+_FINGERPRINT_SAMPLES = 4096
+
+def _parameter_key(value):
+  '''Returns an exact JSON-compatible representation of a number, string or
+  array.'''
+  if isinstance(value, str):
+    return value
+  array = numpy.ascontiguousarray(value, dtype=float)
+  if array.ndim == 0:
+    return _float_key(array)
+  return {'shape': list(array.shape),
+          'values': hashlib.sha256(array.tobytes()).hexdigest()}
+
+def waveform_fingerprint(f):
+  '''Returns a JSON-compatible description of a waveform.
+
+  Waveforms with harmonics are described exactly by them. Waveforms made by
+  arithmetic, differentiation or models.make_tabulated are described by
+  their definitions. Anything else is described by a hash of its values at
+  many points, along with its breakpoints, so those can only be told apart
+  where they differ at one of the points.'''
+  harmonics = getattr(f, 'harmonics', None)
+  if isinstance(f, models.CosSumFunction):
+    harmonics = f.coeff
+  if harmonics is not None:
+    return {'harmonics': _coeff_key(harmonics)}
+  definition = getattr(f, 'definition', None)
+  if definition is not None:
+    name, parameters, operands = definition
+    return {'definition': name,
+            'parameters': {key: _parameter_key(value)
+                           for key, value in parameters.items()},
+            'operands': [waveform_fingerprint(operand)
+                         for operand in operands]}
+  thetas = numpy.arange(_FINGERPRINT_SAMPLES) * (
+      numpy.pi * 2 / _FINGERPRINT_SAMPLES)
+  values = numpy.ascontiguousarray(f(thetas), dtype=float)
+  breakpoints = getattr(f, 'breakpoints', None)
+  if breakpoints is not None:
+    breakpoints = [_float_key(point) for point in breakpoints]
+  return {'samples': hashlib.sha256(values.tobytes()).hexdigest(),
+          'breakpoints': breakpoints}
+
+def make_key(*parts):
+  '''Returns a key for the given JSON-compatible parts.'''
+  text = json.dumps([VERSION] + list(parts), sort_keys=True)
+  return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+class ConstantsCache(object):
+  '''Stores mappings from names to floats in a directory, one file per key.
+
+  Reading an entry marks it as recently used. Whenever the total size exceeds
+  max_bytes, the least recently used entries are deleted.
+
+  It is safe for multiple processes to share a directory. Each entry is
+  written atomically, and a missing or corrupt entry is just a miss.'''
+  def __init__(self, directory, max_bytes = 16 << 20):
+    self._directory = directory
+    self._max_bytes = max_bytes
+    os.makedirs(directory, exist_ok=True)
+
+  @property
+  def directory(self):
+    return self._directory
+
+  @property
+  def max_bytes(self):
+    return self._max_bytes
+
+  def _path(self, key):
+    return os.path.join(self.directory, key + '.json')
+
+  def get(self, key, names=None):
+    '''Returns the values for key, or None if they aren't present.
+
+    If names is given, entries which don't have exactly those values (from an
+    older version, for example) are treated as missing too.'''
+    path = self._path(key)
+    try:
+      with open(path, 'r') as f:
+        entry = json.load(f)
+      os.utime(path)
+    except (OSError, ValueError):
+      return None
+    if entry.get('version') != VERSION or entry.get('key') != key:
+      return None
+    values = entry.get('values')
+    if not isinstance(values, dict):
+      return None
+    if names is not None and set(values) != set(names):
+      return None
+    return values
+
+  def put(self, key, values):
+    '''Stores values (a mapping from names to floats) for key.'''
+    entry = {'version': VERSION, 'key': key,
+             'values': {name: float(value) for name, value in values.items()}}
+    fd, temporary = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+    try:
+      with os.fdopen(fd, 'w') as f:
+        json.dump(entry, f)
+      os.replace(temporary, self._path(key))
+    except BaseException:
+      os.unlink(temporary)
+      raise
+    self._evict()
+
+  def _evict(self):
+    entries = []
+    for name in os.listdir(self.directory):
+      if not name.endswith('.json'):
+        continue
+      try:
+        stat = os.stat(os.path.join(self.directory, name))
+      except OSError:
+        continue
+      entries.append((stat.st_mtime, stat.st_size, name))
+    total = sum(size for _, size, _ in entries)
+    for _, size, name in sorted(entries):
+      if total <= self.max_bytes:
+        break
+      try:
+        os.unlink(os.path.join(self.directory, name))
+      except OSError:
+        pass
+      total -= size
+
+  def __repr__(self):
+    return 'ConstantsCache(%r, max_bytes=%r)' % (self.directory, self.max_bytes)
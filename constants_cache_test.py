@@ -0,0 +1,106 @@
+#!/usr/bin/python3
+
+import os
+import tempfile
+import unittest
+import numpy
+
+import constants_cache
+import models
+import simple
+
+class TestConstantsCache(unittest.TestCase):
+  def setUp(self):
+    self._directory = tempfile.TemporaryDirectory()
+    self.addCleanup(self._directory.cleanup)
+
+  def test_round_trip(self):
+    cache = constants_cache.ConstantsCache(self._directory.name)
+    key = constants_cache.make_key('test', 1)
+    self.assertIsNone(cache.get(key))
+    cache.put(key, {'a': 1 / 3, 'b': numpy.float64(2.5)})
+    self.assertEqual(cache.get(key), {'a': 1 / 3, 'b': 2.5})
+    self.assertIsNone(cache.get(constants_cache.make_key('test', 2)))
+
+  def test_corrupt(self):
+    cache = constants_cache.ConstantsCache(self._directory.name)
+    key = constants_cache.make_key('test')
+    with open(os.path.join(self._directory.name, key + '.json'), 'w') as f:
+      f.write('{')
+    self.assertIsNone(cache.get(key))
+
+  def test_eviction(self):
+    cache = constants_cache.ConstantsCache(self._directory.name, max_bytes=1000)
+    keys = [constants_cache.make_key('test', i) for i in range(50)]
+    for i, key in enumerate(keys):
+      cache.put(key, {'value': i})
+      os.utime(os.path.join(self._directory.name, key + '.json'), (i, i))
+    self.assertLessEqual(
+        sum(os.path.getsize(os.path.join(self._directory.name, name))
+            for name in os.listdir(self._directory.name)), 1000)
+    self.assertIsNone(cache.get(keys[0]))
+    self.assertEqual(cache.get(keys[-1]), {'value': 49})
+
+  def test_fingerprints(self):
+    self.assertEqual(constants_cache.waveform_fingerprint(models.sin),
+                     constants_cache.waveform_fingerprint(
+                         models.CosSum.make_function({1: (1, -numpy.pi / 2)})))
+    self.assertNotEqual(constants_cache.waveform_fingerprint(models.square),
+                        constants_cache.waveform_fingerprint(
+                            models.trapezoid_4step))
+    self.assertNotEqual(constants_cache.motor_fingerprint(models.BOMA),
+                        constants_cache.motor_fingerprint(models.MY1020))
+
+  def test_definition_fingerprints(self):
+    samples = models.trapezoid(numpy.arange(4096) * (numpy.pi * 2 / 4096))
+    linear = models.make_tabulated(samples, 'linear')
+    cubic = models.make_tabulated(samples, 'cubic')
+    # They agree at every sampled point.
+    numpy.testing.assert_allclose(
+        linear(numpy.arange(4096) * (numpy.pi * 2 / 4096)),
+        cubic(numpy.arange(4096) * (numpy.pi * 2 / 4096)), atol=1e-12)
+    fingerprints = [constants_cache.waveform_fingerprint(waveform)
+                    for waveform in (linear, cubic, linear * 2,
+                                     linear + models.square,
+                                     linear * models.square,
+                                     linear.derivative(),
+                                     models.square.derivative())]
+    self.assertEqual(len(set(map(repr, fingerprints))), len(fingerprints))
+    self.assertEqual(constants_cache.waveform_fingerprint(
+                         models.make_tabulated(samples, 'linear') * 2),
+                     fingerprints[2])
+
+  def test_partial_entry(self):
+    cache = constants_cache.ConstantsCache(self._directory.name)
+    key = constants_cache.make_key('test')
+    cache.put(key, {'a': 1})
+    self.assertEqual(cache.get(key, ('a',)), {'a': 1})
+    self.assertIsNone(cache.get(key, ('a', 'b')))
+
+    controller = simple.SimpleController(models.T20, models.trapezoid_6step)
+    key = controller._cache_key()
+    cache.put(key, {'_max_speed': 1})
+    cached = simple.SimpleController(models.T20, models.trapezoid_6step,
+                                     cache=cache)
+    self.assertEqual(cached.max_speed(), controller.max_speed())
+    self.assertEqual(cache.get(key)['_max_speed'], controller.max_speed())
+
+  def test_controller(self):
+    cache = constants_cache.ConstantsCache(self._directory.name)
+    for waveform in (models.sin, models.trapezoid_6step):
+      with self.subTest(waveform=waveform.__doc__):
+        first = simple.SimpleController(models.T20, waveform, cache=cache)
+        second = simple.SimpleController(models.T20, waveform, cache=cache)
+        for kwargs in ({'max_motor_current': 100},
+                       {'max_voltage': 20},
+                       {'max_input_power': 1000}):
+          a = first.operating_point(500, **kwargs)
+          b = second.operating_point(500, **kwargs)
+          self.assertEqual(a.torque, b.torque)
+          self.assertEqual(a.rms_input_power, b.rms_input_power)
+          self.assertEqual(a.average_motor_power, b.average_motor_power)
+        self.assertEqual(first.max_speed(), second.max_speed())
+    self.assertEqual(len(os.listdir(self._directory.name)), 2)
+
+if __name__ == '__main__':
+  unittest.main()
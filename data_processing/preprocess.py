@@ -1,22 +1,192 @@
 #!/usr/bin/python3
 
-# Input format: Two header lines. 10e-5 timestep.
-# Data lines: sequence,voltage,
-# The one voltage is between two phases.
+'''Converts raw scope captures to traces for process_trace.
 
-import csv
+Each scope's format has a profile:
+  sequence: Two header lines, and then sequence,voltage, lines with a fixed
+      timestep (--dt). The one voltage is between two phases.
+  absolute_time: Two header lines, and then time,voltage, lines. The one
+      voltage is between two phases.
+  three_phase: Two header lines, and then
+      time,voltage_a,voltage_b,voltage_c,encoder_index lines.
+
+The output lines are relative_time,line_to_line_voltage. For three_phase, they
+are relative_time,voltage_ab,voltage_bc,voltage_ca,encoder_index instead, which
+process_trace can use for more accurate fits. Alternatively, outputs
+ending in trace_format.EXTENSION are written in that binary format instead.
+Files are processed a chunk of lines at a time, so memory use doesn't depend on
+their lengths.'''
+
+import argparse
+import concurrent.futures
+import itertools
 import sys
 
-DT = 10e-5
-
-with open(sys.argv[1], 'r') as in_file:
-  with open(sys.argv[2], 'w') as out_file:
-    reader = csv.reader(in_file)
-    writer = csv.writer(out_file, lineterminator='\n')
-    time = 0
-    # Skip the header rows.
-    next(reader)
-    next(reader)
-    for row in reader:
-      writer.writerow(('{0:.5f}'.format(time), float(row[1])))
-      time += DT
+import numpy
+
+import trace_format
+
+HEADER_ROWS = 2
+# How many lines to convert at a time.
+CHUNK_ROWS = 1 << 16
+
+class SequenceProfile(object):
+  '''Timesteps are added up, one at a time, from 0.'''
+  usecols = (1,)
+  time_format = '%.5f'
+
+  def __init__(self, dt=10e-5):
+    self._dt = dt
+    self._time = 0.0
+
+  def convert(self, chunk):
+    '''Returns (times, values) for chunk, which has the columns in usecols.
+
+    values is 1-D for a single column, or 2-D with one column per output
+    column.'''
+    # cumsum adds them up in order, so this exactly matches adding dt each line
+    # in a loop.
+    times = numpy.cumsum(numpy.append(self._time,
+                                      numpy.full(len(chunk) - 1, self._dt)))
+    self._time = times[-1] + self._dt
+    return times, chunk[:, 0]
+
+class AbsoluteTimeProfile(object):
+  '''Times are relative to the first line.'''
+  usecols = (0, 1)
+  time_format = '%.6f'
+
+  def __init__(self):
+    self._start_time = None
+
+  def _relative_times(self, times):
+    if self._start_time is None:
+      self._start_time = times[0]
+    return times - self._start_time
+
+  def convert(self, chunk):
+    return self._relative_times(chunk[:, 0]), chunk[:, 1]
+
+class ThreePhaseProfile(AbsoluteTimeProfile):
+  '''All three line-to-line voltages, starting with the one between the first
+  two phases, and then the encoder index.'''
+  usecols = (0, 1, 2, 3, 4)
+
+  def convert(self, chunk):
+    phases = chunk[:, 1:4]
+    return self._relative_times(chunk[:, 0]), numpy.column_stack(
+        (phases - numpy.roll(phases, -1, axis=1), chunk[:, 4]))
+
+PROFILES = {'sequence': SequenceProfile,
+            'absolute_time': AbsoluteTimeProfile,
+            'three_phase': ThreePhaseProfile}
+
+def _read_chunks(in_file, usecols, chunk_rows):
+  '''Yields 2-D arrays of up to chunk_rows lines from in_file.'''
+  while True:
+    lines = list(itertools.islice(in_file, chunk_rows))
+    if not lines:
+      return
+    yield numpy.loadtxt(lines, delimiter=',', usecols=usecols, ndmin=2)
+
+def _repr_floats(values):
+  '''Returns an object array of repr of each of values (which must be 1-D),
+  which is how the csv module writes floats.
+
+  Scopes have a limited resolution, so there usually aren't many different
+  values, and it's a lot faster to only format each of them once.'''
+  # Look at the bits so 0.0 and -0.0 stay different.
+  unique, inverse = numpy.unique(values.view(numpy.int64), return_inverse=True)
+  return numpy.array([repr(value) for value in unique.view(float).tolist()],
+                     dtype=object)[inverse]
+
+def preprocess(in_filename, out_filename, profile, chunk_rows=CHUNK_ROWS,
+               **kwargs):
+  '''Converts one file with the named profile.
+
+  kwargs are passed to the profile (for example dt for sequence).
+
+  Returns the number of samples written.'''
+  profile = PROFILES[profile](**kwargs)
+  count = 0
+  with open(in_filename, 'r') as in_file:
+    for _ in range(HEADER_ROWS):
+      next(in_file)
+    chunks = (profile.convert(chunk) for chunk
+              in _read_chunks(in_file, profile.usecols, chunk_rows))
+    if out_filename.endswith(trace_format.EXTENSION):
+      with trace_format.TraceWriter(out_filename) as writer:
+        for times, values in chunks:
+          writer.write(times, values)
+          count += len(times)
+      return count
+    with open(out_filename, 'w') as out_file:
+      for times, values in chunks:
+        values = values.reshape(len(times), -1)
+        fields = numpy.empty((len(times), values.shape[1] + 1), dtype=object)
+        fields[:, 0] = times.tolist()
+        fields[:, 1:] = _repr_floats(
+            numpy.ascontiguousarray(values).reshape(-1)).reshape(values.shape)
+        line_format = profile.time_format + ',%s' * values.shape[1] + '\n'
+        out_file.write((line_format * len(times)) %
+                       tuple(fields.reshape(-1).tolist()))
+        count += len(times)
+  return count
+
+def output_filename(in_filename, binary=False):
+  '''Returns the default output filename for in_filename.'''
+  if in_filename.endswith('_raw.csv'):
+    return in_filename[:-len('_raw.csv')] + (
+        trace_format.EXTENSION if binary else '.csv')
+  raise ValueError('No default output filename for %s' % (in_filename,))
+
+def _preprocess_task(task):
+  return preprocess(*task[:3], **task[3])
+
+def main(argv):
+  parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+  parser.add_argument('inputs', nargs='+',
+                      help='Raw capture files, named like motor_raw.csv '
+                      'unless --output is given')
+  parser.add_argument('--profile', choices=sorted(PROFILES),
+                      default='sequence',
+                      help='The format of the input files')
+  parser.add_argument('--output',
+                      help='The output file, with a single input (defaults to '
+                      'the input with _raw removed)')
+  parser.add_argument('--binary', action='store_true',
+                      help='Default to writing %s files instead of CSV' %
+                      (trace_format.EXTENSION,))
+  parser.add_argument('--dt', type=float,
+                      help='The timestep for the sequence profile')
+  parser.add_argument('--jobs', type=int,
+                      help='Number of files to convert in parallel')
+  args = parser.parse_args(argv)
+
+  kwargs = {}
+  if args.dt is not None:
+    if args.profile != 'sequence':
+      parser.error('--dt only works with the sequence profile')
+    kwargs['dt'] = args.dt
+  if args.output is not None:
+    if len(args.inputs) != 1:
+      parser.error('--output only works with a single input')
+    outputs = [args.output]
+  else:
+    try:
+      outputs = [output_filename(name, binary=args.binary)
+                 for name in args.inputs]
+    except ValueError as e:
+      parser.error(str(e))
+  tasks = [(in_filename, out_filename, args.profile, kwargs)
+           for in_filename, out_filename in zip(args.inputs, outputs)]
+
+  if len(tasks) == 1:
+    _preprocess_task(tasks[0])
+    return 0
+  with concurrent.futures.ProcessPoolExecutor(args.jobs) as executor:
+    list(executor.map(_preprocess_task, tasks))
+  return 0
+
+if __name__ == '__main__':
+  sys.exit(main(sys.argv[1:]))
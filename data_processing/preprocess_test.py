@@ -0,0 +1,67 @@
+#!/usr/bin/python3
+
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+
+import numpy
+
+import preprocess
+import trace_format
+
+_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+
+def _path(name):
+  return os.path.join(_DIRECTORY, name)
+
+# The bundled traces were made by the older per-scope scripts.
+_PROFILES = {'boma': 'sequence', 'my1020': 'sequence',
+             'neo': 'absolute_time', 't20': 'three_phase'}
+
+class PreprocessTest(unittest.TestCase):
+  def assertSameContents(self, actual_filename, expected_filename):
+    with open(actual_filename, 'rb') as actual:
+      with open(expected_filename, 'rb') as expected:
+        self.assertEqual(actual.read(), expected.read())
+
+  def test_bundled(self):
+    with tempfile.TemporaryDirectory() as directory:
+      for name, profile in _PROFILES.items():
+        for chunk_rows in (preprocess.CHUNK_ROWS, 7):
+          with self.subTest(name=name, chunk_rows=chunk_rows):
+            output = os.path.join(directory, name + '.csv')
+            count = preprocess.preprocess(_path(name + '_raw.csv'), output,
+                                          profile, chunk_rows=chunk_rows)
+            self.assertGreater(count, 1000)
+            self.assertSameContents(output, _path(name + '.csv'))
+
+  def test_binary(self):
+    with tempfile.TemporaryDirectory() as directory:
+      for name, profile in _PROFILES.items():
+        with self.subTest(name=name):
+          output = os.path.join(directory, name + trace_format.EXTENSION)
+          preprocess.preprocess(_path(name + '_raw.csv'), output, profile,
+                                chunk_rows=1000)
+          timesteps, data = trace_format.open_trace(output)
+          expected = numpy.loadtxt(_path(name + '.csv'), delimiter=',').T
+          numpy.testing.assert_allclose(numpy.asarray(timesteps), expected[0],
+                                        atol=1e-6)
+          numpy.testing.assert_allclose(data, expected[1:].T.squeeze(),
+                                        rtol=1e-6)
+
+  def test_batch(self):
+    with tempfile.TemporaryDirectory() as directory:
+      inputs = []
+      for name in ('boma', 'my1020'):
+        inputs.append(os.path.join(directory, name + '_raw.csv'))
+        os.symlink(_path(name + '_raw.csv'), inputs[-1])
+      subprocess.run([sys.executable, _path('preprocess.py'), '--jobs', '2'] +
+                     inputs, check=True)
+      for name in ('boma', 'my1020'):
+        self.assertSameContents(os.path.join(directory, name + '.csv'),
+                                _path(name + '.csv'))
+
+if __name__ == '__main__':
+  unittest.main()
@@ -1,137 +1,766 @@
 #!/usr/bin/python3
 
-import numpy
+'''Fits flux linkage coefficients to a trace of the line-to-line voltage of a
+motor being spun at a constant speed.
+
+This can be imported and used as a library (see process_trace), or run on
+some files and/or directories of traces. Run with --help for details.'''
+
+import argparse
+import concurrent.futures
+import csv
+import functools
+import json
+import os
 import sys
-import matplotlib.pyplot as plt
 
-filename = sys.argv[1]
-file_data = numpy.loadtxt(filename, delimiter=',').T
-data = file_data[1]
-timesteps = file_data[0]
+import numpy
+
+import trace_format
 
 # How many FFT coefficients we'll use to approximate it.
 number_coefficients = 2
 
+def load_trace(filename):
+  '''Returns (timesteps, data) from a preprocessed trace file.
+
+  Binary trace_format files are memory mapped, so only the parts of them which
+  are used are read. Anything else is parsed as CSV. Either way, data is the
+  first channel, which is the line-to-line voltage between the first two
+  phases for three-phase traces.'''
+  if filename.endswith(trace_format.EXTENSION):
+    timesteps, data = trace_format.open_trace(filename)
+    if data.ndim == 2:
+      data = data[:, 0]
+    return timesteps, data
+  file_data = numpy.loadtxt(filename, delimiter=',', usecols=(0, 1)).T
+  return file_data[0], file_data[1]
+
+def load_channels(filename):
+  '''Returns (timesteps, line_lines, index) from a preprocessed three-phase
+  trace file, with all 3 line-to-line voltages as the columns of line_lines.'''
+  if filename.endswith(trace_format.EXTENSION):
+    timesteps, data = trace_format.open_trace(filename)
+  else:
+    file_data = numpy.loadtxt(filename, delimiter=',', ndmin=2)
+    timesteps, data = file_data[:, 0], file_data[:, 1:]
+  if data.ndim != 2 or data.shape[1] != 4:
+    raise ValueError('%s does not have three phases and an encoder index' %
+                     (filename,))
+  return timesteps, data[:, :3], data[:, 3]
+
 def approximate(fft, num):
   '''Returns the inverse transform of fft, after dropping all but the biggest
   num coefficients.'''
-  fft = numpy.copy(fft)
   biggest_indices = numpy.argpartition(abs(fft), -num)[-num:]
-  fft[list(i for i in range(len(fft)) if i not in biggest_indices)] = 0
-  return numpy.fft.irfft(fft), max(biggest_indices)
+  kept = numpy.zeros_like(fft)
+  kept[biggest_indices] = fft[biggest_indices]
+  return numpy.fft.irfft(kept), max(biggest_indices)
+
+# Coefficients smaller than the fundamental divided by this are considered noise.
+noise_ratio = 30
+def select_coefficients(fft, minimum=number_coefficients,
+                        noise_ratio=noise_ratio):
+  '''Returns how many of the biggest coefficients of fft to use before it's
+  mostly noise.
+
+  This keeps adding the next-biggest coefficient (starting with minimum of
+  them) until the highest harmonic used is smaller than the fundamental
+  divided by noise_ratio, and then returns one less than that. This stops
+  before matching the noise, but still gets a close approximation.
+
+  The magnitudes are only sorted once, so this is O(n log n).'''
+  magnitudes = abs(numpy.asarray(fft))
+  order = numpy.argsort(-magnitudes, kind='stable')
+  highest = numpy.maximum.accumulate(order)
+  # Index i is for using the biggest i + 1 coefficients.
+  noise = magnitudes[highest] < magnitudes[1] / noise_ratio
+  noise[:minimum - 1] = False
+  if not noise.any():
+    raise ValueError('Never found the noise floor')
+  return int(numpy.argmax(noise))
 
 zero_noise = 0.15
 max_zero_size = 40
-def find_zero_crossing(start):
-  '''Returns the index into data of the first zero crossing after start.'''
-  i = start
-  while data[i] > 0:
-    i += 1
-  i += max_zero_size
-  while data[i] < -zero_noise:
-    i += 1
-  start = i
-  while data[i] < zero_noise:
-    i += 1
-  end = i
-  assert end - start < max_zero_size
-  return (end + start) // 2
+def _next_index(condition):
+  '''Returns, for each index, the first index at or after it where condition
+  is true (or len(condition) if there isn't one).'''
+  indices = numpy.where(condition, numpy.arange(len(condition)),
+                        len(condition))
+  return numpy.append(numpy.minimum.accumulate(indices[::-1])[::-1],
+                      len(condition))
+
+def find_zero_crossings(data, zero_noise=zero_noise,
+                        max_zero_size=max_zero_size):
+  '''Returns the indices into data of all the upwards zero crossings.
+
+  This uses hysteresis to reject noise. Each crossing ends at the first sample
+  above zero_noise after a sample below -zero_noise. It starts where data first
+  rises above -zero_noise after the negative half-cycle, skipping
+  max_zero_size samples after data goes negative to avoid noise there.
+  The crossing is halfway between the start and end, and crossings which take
+  max_zero_size samples or more are ignored.'''
+  starts, ends = zero_crossing_bounds(data, zero_noise, max_zero_size)
+  return (ends + starts) // 2
+
+def zero_crossing_bounds(data, zero_noise=zero_noise,
+                         max_zero_size=max_zero_size):
+  '''Returns (starts, ends), the indices into data where each of the zero
+  crossings find_zero_crossings finds starts and ends.
+
+  Each one only depends on the data before its end, back to the previous
+  sample above zero_noise.'''
+  data = numpy.asarray(data)
+  low = data < -zero_noise
+  high = data >= zero_noise
+  indices = numpy.arange(len(data))
+  last_high = numpy.maximum.accumulate(numpy.where(high, indices, -1))
+  last_low = numpy.maximum.accumulate(numpy.where(low, indices, -1))
+  ends = numpy.flatnonzero(high[1:] & (last_low[:-1] > last_high[:-1])) + 1
+  next_not_positive = _next_index(data <= 0)
+  next_not_low = _next_index(~low)
+  skipped = numpy.minimum(
+      next_not_positive[last_high[ends - 1] + 1] + max_zero_size, len(data))
+  starts = next_not_low[skipped]
+  qualifying = (starts <= ends) & (ends - starts < max_zero_size)
+  return starts[qualifying], ends[qualifying]
+
+# How many samples _first_zero_crossings looks at first.
+crossing_search_size = 1 << 16
+
+def _first_zero_crossings(data, count, search_size=crossing_search_size):
+  '''Returns the first count of find_zero_crossings(data), or fewer if there
+  aren't that many.
+
+  Only as much of the start of data as it takes is looked at, doubling from
+  search_size samples, so this doesn't read (or allocate memory for) all of a
+  long trace. Crossings only depend on the data up to their end, so they are
+  the same ones.'''
+  size = search_size
+  while True:
+    crossings = find_zero_crossings(data[:size])
+    if len(crossings) >= count or size >= len(data):
+      return crossings[:count]
+    size *= 2
 
 round_angle_multiple = numpy.pi / 6
 def round_angle(angle):
   '''Returns angle rounded to a multiple of pi/6.'''
   return round(angle / round_angle_multiple) * round_angle_multiple
 
-first_zero = find_zero_crossing(0)
-second_zero = find_zero_crossing(first_zero + 100)
-abs_first_zero, abs_second_zero = first_zero, second_zero
-
-# Chop off the last one to make sure the length is even, so FFTs use all the
-# points.
-if (second_zero - first_zero) % 2:
-  second_zero -= 1
-
-one_cycle = data[first_zero:second_zero]
-cycle_timesteps = timesteps[first_zero:second_zero]
-omega = (numpy.pi * 2) / (cycle_timesteps[-1] - cycle_timesteps[0])
-
-fft = numpy.fft.rfft(one_cycle)
-approximated, max_index = approximate(fft, number_coefficients)
-
-# Now grab more and more coefficients until the next-biggest is after 100. We
-# stop at this arbitrary point to avoid matching the noise, but still get a
-# close approximation.
-# I know there's a way less wasteful way to do this without recalculating things
-# all time, but whatever...
-number_precise_coefficients = number_coefficients
-while abs(fft[max_index]) >= abs(fft[1]) / 30:
-  number_precise_coefficients += 1
-  precise_approximated, max_index = approximate(fft, number_precise_coefficients)
-number_precise_coefficients -= 1
-precise_approximated, _ = approximate(fft, number_precise_coefficients)
-print('Mostly found noise after %d' % (number_precise_coefficients,))
-
-# Grab just our one cycle of data.
-fft_offset = -int(round(numpy.angle(fft[1]) / (2 * numpy.pi) *
-                        len(cycle_timesteps)))
-first_zero += fft_offset
-second_zero += fft_offset
-one_cycle = data[first_zero:second_zero]
-cycle_timesteps = timesteps[first_zero:second_zero]
-
-# Shuffle the functions around so they start in the same place in a cycle.
-approximated = numpy.roll(approximated, -fft_offset)
-precise_approximated = numpy.roll(precise_approximated, -fft_offset)
-
-cycle_x = cycle_timesteps - cycle_timesteps[0]
-assert min(cycle_x) == 0
-cycle_time = max(cycle_x)
-
-coefficients = list(sorted(numpy.argpartition(abs(fft), -number_coefficients)[-number_coefficients:]))
-assert coefficients[0] == 1
-f_scale = 1 / (len(cycle_x) / 2)
-zero_scalar = abs(fft[1]) * f_scale
-linkage_message = 'Flux linkage = %.8f * cos(theta)' % (zero_scalar / omega)
-zero_angle = numpy.angle(fft[1])
-cos_arg = 2 * numpy.pi * cycle_x / cycle_time - zero_angle
-f = zero_scalar * numpy.cos(cos_arg + zero_angle)
-f_rounded = numpy.copy(f)
-for coefficient in coefficients[1:]:
-  scalar = abs(fft[coefficient]) * f_scale
-  angle = numpy.angle(fft[coefficient])
-  rounded_angle = round_angle(angle - zero_angle * coefficient) + zero_angle * coefficient
-  linkage_message += ' + %.8f * cos(%d * theta + %f)' % (
-      scalar / omega, coefficient,
-      (rounded_angle - zero_angle * coefficient) % (numpy.pi * 2))
-  f += scalar * numpy.cos(cos_arg * coefficient + angle)
-  f_rounded += scalar * numpy.cos(cos_arg * coefficient + rounded_angle)
-linkage_message += ' V/(rad/s) aka N*m/A'
-print(linkage_message)
-
-plt.subplot(2, 1, 2)
-plt.plot(cycle_x, one_cycle, label='raw')
-# This should precisely overlap f, but put it on here anyways to allow visually
-# double checking.
-plt.plot(cycle_x, approximated, label='course')
-if (approximated != precise_approximated).any() or True:
-  # Avoid overlapping lines because they're confusing.
-  plt.plot(cycle_x, precise_approximated, label='precise')
-plt.plot(cycle_x, f, label='f')
-plt.plot(cycle_x, f_rounded, label='f_rounded')
-plt.legend()
-plt.title('%s one cycle' % (filename,))
-plt.xlabel('time (s)')
-plt.ylabel('volts (line-to-line)')
-
-plt.subplot(2, 1, 1)
-plt.plot(timesteps, data, label='raw')
-plt.title('%s all data' % (filename,))
-plt.axvline(x=timesteps[first_zero], linestyle=':', color='r')
-plt.axvline(x=timesteps[second_zero], linestyle='-', color='r')
-plt.axvline(x=timesteps[abs_first_zero], linestyle=':', color='g')
-plt.axvline(x=timesteps[abs_second_zero], linestyle='-', color='g')
-plt.axhline(y=0)
-plt.xlabel('time (s)')
-plt.ylabel('volts (line-to-line)')
-
-plt.show()
+class TraceFit(object):
+  '''The results of fitting one trace.
+
+  Attributes
+  ----------
+  line_line_f_coeff : dict
+      The line-to-line flux linkage coefficients, in the form
+      models.Motor takes them, in V/(rad/s) aka N*m/A.
+  omega : float
+      The electrical speed in rad/s.
+  number_precise_coefficients : int
+      How many coefficients were found before it was mostly noise.
+
+  The rest of the attributes are intermediate values for plot_fit.
+  '''
+  def __init__(self, **kwargs):
+    self.__dict__.update(kwargs)
+
+  def linkage_message(self):
+    '''Returns a human-readable description of the flux linkage.'''
+    harmonics = sorted(self.line_line_f_coeff)
+    message = 'Flux linkage = %.8f * cos(theta)' % (
+        self.line_line_f_coeff[harmonics[0]][0],)
+    for harmonic in harmonics[1:]:
+      scalar, angle = self.line_line_f_coeff[harmonic]
+      message += ' + %.8f * cos(%d * theta + %f)' % (scalar, harmonic, angle)
+    return message + ' V/(rad/s) aka N*m/A'
+
+def fit_trace(timesteps, data):
+  '''Fits flux linkage coefficients to one cycle of data.
+
+  Returns a TraceFit.'''
+  first_zero, second_zero = _first_zero_crossings(data, 2)
+  abs_first_zero, abs_second_zero = first_zero, second_zero
+
+  # Chop off the last one to make sure the length is even, so FFTs use all the
+  # points.
+  if (second_zero - first_zero) % 2:
+    second_zero -= 1
+
+  one_cycle = data[first_zero:second_zero]
+  cycle_timesteps = timesteps[first_zero:second_zero]
+  omega = (numpy.pi * 2) / (cycle_timesteps[-1] - cycle_timesteps[0])
+
+  fft = numpy.fft.rfft(one_cycle)
+  approximated, _ = approximate(fft, number_coefficients)
+
+  number_precise_coefficients = select_coefficients(fft)
+  precise_approximated, _ = approximate(fft, number_precise_coefficients)
+
+  # Grab just our one cycle of data.
+  fft_offset = -int(round(numpy.angle(fft[1]) / (2 * numpy.pi) *
+                          len(cycle_timesteps)))
+  first_zero += fft_offset
+  second_zero += fft_offset
+  one_cycle = data[first_zero:second_zero]
+  cycle_timesteps = timesteps[first_zero:second_zero]
+
+  # Shuffle the functions around so they start in the same place in a cycle.
+  approximated = numpy.roll(approximated, -fft_offset)
+  precise_approximated = numpy.roll(precise_approximated, -fft_offset)
+
+  cycle_x = cycle_timesteps - cycle_timesteps[0]
+  assert min(cycle_x) == 0
+  cycle_time = max(cycle_x)
+
+  coefficients = list(sorted(numpy.argpartition(abs(fft), -number_coefficients)[-number_coefficients:]))
+  assert coefficients[0] == 1
+  f_scale = 1 / (len(cycle_x) / 2)
+  zero_scalar = abs(fft[1]) * f_scale
+  line_line_f_coeff = {1: (zero_scalar / omega, 0.0)}
+  zero_angle = numpy.angle(fft[1])
+  cos_arg = 2 * numpy.pi * cycle_x / cycle_time - zero_angle
+  f = zero_scalar * numpy.cos(cos_arg + zero_angle)
+  f_rounded = numpy.copy(f)
+  for coefficient in coefficients[1:]:
+    scalar = abs(fft[coefficient]) * f_scale
+    angle = numpy.angle(fft[coefficient])
+    rounded_angle = round_angle(angle - zero_angle * coefficient) + zero_angle * coefficient
+    line_line_f_coeff[int(coefficient)] = (
+        scalar / omega,
+        (rounded_angle - zero_angle * coefficient) % (numpy.pi * 2))
+    f += scalar * numpy.cos(cos_arg * coefficient + angle)
+    f_rounded += scalar * numpy.cos(cos_arg * coefficient + rounded_angle)
+
+  return TraceFit(line_line_f_coeff=line_line_f_coeff, omega=omega,
+                  number_precise_coefficients=number_precise_coefficients,
+                  first_zero=first_zero, second_zero=second_zero,
+                  abs_first_zero=abs_first_zero,
+                  abs_second_zero=abs_second_zero,
+                  cycle_x=cycle_x, one_cycle=one_cycle,
+                  approximated=approximated,
+                  precise_approximated=precise_approximated,
+                  f=f, f_rounded=f_rounded)
+
+# Cycles whose length differs from the median by more than this fraction are
+# assumed to have a missing zero crossing and are ignored.
+cycle_length_tolerance = 0.2
+
+def _resample_cycles(data, starts, ends, samples):
+  '''Returns a 2-D array with each row being data from one start to the
+  corresponding end, linearly interpolated at samples evenly spaced points.'''
+  positions = starts[:, numpy.newaxis] + numpy.multiply.outer(
+      ends - starts, numpy.arange(samples) / samples)
+  indices = numpy.floor(positions).astype(int)
+  fractions = positions - indices
+  return (data[indices] * (1 - fractions) +
+          data[numpy.minimum(indices + 1, len(data) - 1)] * fractions)
+
+def _circular_deviation(angles, mean):
+  '''Returns the standard deviation of angles around mean, wrapping.'''
+  differences = (angles - mean[..., numpy.newaxis] + numpy.pi) % (
+      numpy.pi * 2) - numpy.pi
+  return numpy.sqrt(numpy.mean(differences ** 2, axis=-1))
+
+def fit_all_cycles(timesteps, data, samples=None):
+  '''Fits flux linkage coefficients to every cycle of data, and averages them.
+
+  Each cycle between consecutive zero crossings is resampled onto a common
+  grid of samples points (by default, the shortest cycle's length rounded down
+  to an even number), and they are all transformed together.
+
+  Returns a TraceFit, which also has these attributes:
+    line_line_f_spread: A dict with the same keys as line_line_f_coeff, where
+        each value is the standard deviations of the amplitude and angle
+        (before rounding) across all the cycles.
+    number_cycles: How many cycles were averaged.
+    cycles: The resampled cycles, one per row.'''
+  starts, ends = _regular_intervals(find_zero_crossings(data))
+  if not len(starts):
+    raise ValueError('Found no complete cycles')
+  if samples is None:
+    samples = int(numpy.amin(ends - starts)) // 2 * 2
+
+  cycles = _resample_cycles(data, starts, ends, samples)
+  omegas = (numpy.pi * 2) / (timesteps[ends] - timesteps[starts])
+  fft = numpy.fft.rfft(cycles, axis=1) * (2 / samples)
+  line_line_f_coeff, line_line_f_spread, number_precise_coefficients = (
+      _average_harmonics(fft, omegas))
+
+  return TraceFit(line_line_f_coeff=line_line_f_coeff,
+                  omega=float(numpy.mean(omegas)),
+                  number_precise_coefficients=number_precise_coefficients,
+                  line_line_f_spread=line_line_f_spread,
+                  number_cycles=len(cycles), cycles=cycles)
+
+def _average_harmonics(fft, omegas):
+  '''Averages coefficients from many cycles.
+
+  fft has a row of harmonics (starting at 0) for each cycle, scaled to
+  amplitudes, and omegas has the speed for each cycle.
+
+  Returns (line_line_f_coeff, line_line_f_spread,
+  number_precise_coefficients) for fit_all_cycles.'''
+  magnitudes = abs(fft)
+  mean_magnitudes = numpy.mean(magnitudes, axis=0)
+
+  coefficients = sorted(numpy.argpartition(
+      mean_magnitudes, -number_coefficients)[-number_coefficients:])
+  assert coefficients[0] == 1
+  number_precise_coefficients = select_coefficients(mean_magnitudes)
+
+  # Angles relative to the fundamental, which don't depend on exactly where
+  # each cycle starts.
+  zero_angles = numpy.angle(fft[:, 1])
+  line_line_f_coeff = {}
+  line_line_f_spread = {}
+  for coefficient in coefficients:
+    linkages = magnitudes[:, coefficient] / omegas
+    angles = numpy.angle(fft[:, coefficient]) - zero_angles * coefficient
+    mean_angle = numpy.angle(numpy.mean(numpy.exp(1j * angles)))
+    if coefficient == 1:
+      angle = 0.0
+    else:
+      angle = round_angle(mean_angle) % (numpy.pi * 2)
+    line_line_f_coeff[int(coefficient)] = (float(numpy.mean(linkages)), angle)
+    line_line_f_spread[int(coefficient)] = (
+        float(numpy.std(linkages)),
+        float(_circular_deviation(angles, numpy.array(mean_angle))))
+  return line_line_f_coeff, line_line_f_spread, number_precise_coefficients
+
+def _regular_intervals(positions):
+  '''Returns (starts, ends) of the intervals between consecutive positions,
+  without the ones whose lengths are too far from the median (because of a
+  missed position).'''
+  starts, ends = positions[:-1], positions[1:]
+  if len(starts):
+    lengths = ends - starts
+    median = numpy.median(lengths)
+    regular = abs(lengths - median) <= median * cycle_length_tolerance
+    starts, ends = starts[regular], ends[regular]
+  return starts, ends
+
+index_threshold = 2.5
+def find_index_pulses(index, threshold=index_threshold):
+  '''Returns the (fractional) positions in index where it rises through
+  threshold, linearly interpolated between the samples on each side.'''
+  index = numpy.asarray(index)
+  high = index >= threshold
+  edges = numpy.flatnonzero(high[1:] & ~high[:-1]) + 1
+  before, after = index[edges - 1], index[edges]
+  return edges - 1 + (threshold - before) / (after - before)
+
+def _interpolate_times(timesteps, positions):
+  indices = numpy.minimum(numpy.floor(positions).astype(int),
+                          len(timesteps) - 2)
+  before = timesteps[indices]
+  return before + (positions - indices) * (timesteps[indices + 1] - before)
+
+def fit_three_phase(timesteps, line_lines, index, electrical_ratio=None,
+                    samples=None):
+  '''Fits flux linkage coefficients to every mechanical revolution of all three
+  line-to-line voltages, and averages them.
+
+  The encoder index pulses mark the revolutions, which gives exact timing
+  without relying on finding zero crossings in noisy voltages. Each revolution
+  of each line-to-line voltage is resampled onto a common grid of samples
+  points (by default, the shortest revolution's length rounded down to an even
+  number), and they are all transformed together.
+
+  line_lines has a column for each line-to-line voltage. electrical_ratio is
+  the number of electrical cycles per revolution, which is found from the
+  biggest harmonic by default.
+
+  Returns a TraceFit like fit_all_cycles, which also has these attributes:
+    electrical_ratio: The number of electrical cycles per revolution.
+    number_revolutions: How many revolutions were averaged.'''
+  starts, ends = _regular_intervals(find_index_pulses(index))
+  if not len(starts):
+    raise ValueError('Found no complete revolutions')
+  if samples is None:
+    samples = int(numpy.amin(ends - starts)) // 2 * 2
+
+  line_lines = numpy.asarray(line_lines)
+  revolutions = numpy.stack(
+      [_resample_cycles(line_lines[:, phase], starts, ends, samples)
+       for phase in range(line_lines.shape[1])], axis=1)
+  fft = numpy.fft.rfft(revolutions, axis=-1) * (2 / samples)
+  if electrical_ratio is None:
+    electrical_ratio = int(numpy.argmax(
+        numpy.mean(abs(fft[..., 1:]), axis=(0, 1)))) + 1
+  # Only keep the multiples of the electrical frequency, and treat each
+  # revolution of each line-to-line voltage separately.
+  electrical_fft = fft[..., ::electrical_ratio].reshape(
+      -1, (fft.shape[-1] - 1) // electrical_ratio + 1)
+  mechanical_omegas = (numpy.pi * 2) / (
+      _interpolate_times(timesteps, ends) -
+      _interpolate_times(timesteps, starts))
+  omegas = numpy.repeat(mechanical_omegas * electrical_ratio,
+                        line_lines.shape[1])
+  line_line_f_coeff, line_line_f_spread, number_precise_coefficients = (
+      _average_harmonics(electrical_fft, omegas))
+
+  return TraceFit(line_line_f_coeff=line_line_f_coeff,
+                  omega=float(numpy.mean(omegas)),
+                  number_precise_coefficients=number_precise_coefficients,
+                  line_line_f_spread=line_line_f_spread,
+                  number_cycles=len(starts) * electrical_ratio,
+                  number_revolutions=len(starts),
+                  electrical_ratio=electrical_ratio,
+                  cycles=revolutions)
+
+# The harmonics which have been significant in the motors we've measured.
+default_harmonics = (1, 5, 7, 11, 13)
+# How many samples project_harmonics processes at a time.
+projection_chunk_size = 1 << 16
+
+def project_harmonics(chunks, cycle_length, harmonics=default_harmonics,
+                      chunk_size=projection_chunk_size):
+  '''Calculates just some harmonics of a signal.
+
+  This is a single-bin DFT for each harmonic (like the Goertzel algorithm), so
+  it takes O(n*k) time for n samples and k harmonics, and only needs memory for
+  one chunk at a time. With a whole number of cycles, the results are the same
+  as the corresponding bins of an FFT.
+
+  Arguments
+  ---------
+  chunks : iterable of 1-D arrays
+      The samples, a piece at a time. None of them may be longer than
+      chunk_size.
+  cycle_length : float
+      The number of samples per cycle, which doesn't have to be an integer.
+  harmonics : sequence of int
+
+  Returns
+  -------
+  numpy.ndarray of complex
+      The amplitude and phase of each harmonic, scaled the same as an FFT
+      divided by half the number of samples.
+  '''
+  harmonics = numpy.asarray(harmonics)
+  frequencies = harmonics * (numpy.pi * 2 / cycle_length)
+  # The phasors for each sample within a chunk, relative to its start.
+  phasors = numpy.exp(-1j * numpy.multiply.outer(numpy.arange(chunk_size),
+                                                 frequencies))
+  total = numpy.zeros(len(harmonics), dtype=complex)
+  start = 0
+  for chunk in chunks:
+    chunk = numpy.asarray(chunk, dtype=float)
+    if len(chunk) > chunk_size:
+      raise ValueError('Chunk of %d samples is bigger than %d' % (len(chunk),
+                                                                   chunk_size))
+    # Reduce the start to within a cycle so the phases stay accurate.
+    offset = (start % cycle_length) * frequencies
+    total += (chunk @ phasors[:len(chunk)]) * numpy.exp(-1j * offset)
+    start += len(chunk)
+  if not start:
+    raise ValueError('No samples')
+  return total * (2 / start)
+
+def _chunks(data, start, end, chunk_size):
+  for chunk_start in range(start, end, chunk_size):
+    yield data[chunk_start:min(chunk_start + chunk_size, end)]
+
+def fit_harmonics(timesteps, data, harmonics=default_harmonics,
+                  all_cycles=False, chunk_size=projection_chunk_size):
+  '''Fits flux linkage coefficients using only some harmonics.
+
+  This uses project_harmonics instead of a full FFT. By default it uses the
+  same cycle as fit_trace, and gives the same results (as long as the biggest
+  harmonics are in harmonics). If all_cycles is set, it uses every complete
+  cycle from the first zero crossing to the last one together instead.
+
+  Returns a TraceFit with line_line_f_coeff, omega, and harmonics (a dict
+  with the amplitude of each harmonic, in the same units as
+  line_line_f_coeff).'''
+  crossings = find_zero_crossings(data)
+  if len(crossings) < 2:
+    raise ValueError('Found no complete cycles')
+  if all_cycles:
+    start, end = crossings[0], crossings[-1]
+    cycle_length = (end - start) / (len(crossings) - 1)
+    omega = (numpy.pi * 2) / ((timesteps[end] - timesteps[start]) /
+                              (len(crossings) - 1))
+  else:
+    # The same cycle as fit_trace.
+    start, end = crossings[:2]
+    end -= (end - start) % 2
+    cycle_length = end - start
+    omega = (numpy.pi * 2) / (timesteps[end - 1] - timesteps[start])
+
+  amplitudes = project_harmonics(_chunks(data, start, end, chunk_size),
+                                 cycle_length, harmonics, chunk_size)
+  magnitudes = abs(amplitudes)
+  biggest = sorted(numpy.argpartition(
+      magnitudes, -number_coefficients)[-number_coefficients:],
+                   key=lambda i: harmonics[i])
+  assert harmonics[biggest[0]] == 1
+  zero_angle = numpy.angle(amplitudes[biggest[0]])
+  line_line_f_coeff = {1: (magnitudes[biggest[0]] / omega, 0.0)}
+  for i in biggest[1:]:
+    harmonic = int(harmonics[i])
+    angle = numpy.angle(amplitudes[i]) - zero_angle * harmonic
+    line_line_f_coeff[harmonic] = (magnitudes[i] / omega,
+                                   round_angle(angle) % (numpy.pi * 2))
+  return TraceFit(line_line_f_coeff=line_line_f_coeff, omega=omega,
+                  harmonics={int(harmonic): magnitude / omega
+                             for harmonic, magnitude
+                             in zip(harmonics, magnitudes)})
+
+def decimate_envelope(timesteps, data, buckets):
+  '''Reduces data to the minimum and maximum in each of buckets ranges, which
+  looks the same when plotted as long as there's at least a bucket per pixel.
+
+  Returns (timesteps, data) with the minimum and then the maximum of each
+  bucket, both at the time the bucket starts. If there aren't more than 2
+  samples per bucket, the original arrays are returned.'''
+  if len(data) <= buckets * 2:
+    return timesteps, data
+  starts = numpy.linspace(0, len(data), buckets, endpoint=False).astype(int)
+  data = numpy.asarray(data)
+  envelope = numpy.empty((buckets, 2), dtype=data.dtype)
+  envelope[:, 0] = numpy.minimum.reduceat(data, starts)
+  envelope[:, 1] = numpy.maximum.reduceat(data, starts)
+  return numpy.repeat(timesteps[starts], 2), envelope.reshape(-1)
+
+# The size of saved plots, in inches.
+plot_size = (12, 9)
+
+def _draw_fit(figure, fit, timesteps, data, title):
+  axes = figure.add_subplot(2, 1, 2)
+  axes.plot(fit.cycle_x, fit.one_cycle, label='raw')
+  # This should precisely overlap f, but put it on here anyways to allow visually
+  # double checking.
+  axes.plot(fit.cycle_x, fit.approximated, label='course')
+  if (fit.approximated != fit.precise_approximated).any() or True:
+    # Avoid overlapping lines because they're confusing.
+    axes.plot(fit.cycle_x, fit.precise_approximated, label='precise')
+  axes.plot(fit.cycle_x, fit.f, label='f')
+  axes.plot(fit.cycle_x, fit.f_rounded, label='f_rounded')
+  axes.legend()
+  axes.set_title('%s one cycle' % (title,))
+  axes.set_xlabel('time (s)')
+  axes.set_ylabel('volts (line-to-line)')
+
+  axes = figure.add_subplot(2, 1, 1)
+  # Drawing every sample of a long trace is slow, so only draw the envelope at
+  # a resolution of one bucket per pixel.
+  pixels = int(numpy.ceil(figure.get_figwidth() * figure.dpi))
+  axes.plot(*decimate_envelope(timesteps, data, pixels), label='raw')
+  axes.set_title('%s all data' % (title,))
+  axes.axvline(x=timesteps[fit.first_zero], linestyle=':', color='r')
+  axes.axvline(x=timesteps[fit.second_zero], linestyle='-', color='r')
+  axes.axvline(x=timesteps[fit.abs_first_zero], linestyle=':', color='g')
+  axes.axvline(x=timesteps[fit.abs_second_zero], linestyle='-', color='g')
+  axes.axhline(y=0)
+  axes.set_xlabel('time (s)')
+  axes.set_ylabel('volts (line-to-line)')
+
+def plot_fit(fit, timesteps, data, title, output=None):
+  '''Plots fit and the data it came from.
+
+  If output is None, this shows the plot. Otherwise, the plot is saved to
+  output instead (in a format based on its extension, such as .png or .svg),
+  which doesn't need a GUI.'''
+  if output is not None:
+    import matplotlib.figure
+
+    figure = matplotlib.figure.Figure(figsize=plot_size)
+    _draw_fit(figure, fit, timesteps, data, title)
+    figure.savefig(output)
+    return
+
+  import matplotlib.pyplot as plt
+
+  _draw_fit(plt.figure(), fit, timesteps, data, title)
+  plt.show()
+
+def process_trace(filename, plot=False, all_cycles=False, encoder_index=False,
+                  electrical_ratio=None, harmonics=None, plot_output=None):
+  '''Loads and fits one trace file.
+
+  If all_cycles is set, this uses fit_all_cycles instead of fit_trace. If
+  harmonics is set, this uses fit_harmonics with them (and all_cycles)
+  instead. If encoder_index is set, this uses fit_three_phase (with
+  electrical_ratio) instead, which needs a three-phase trace.
+
+  If plot is set, the fit is shown with plot_fit. If plot_output is set, the
+  plot is saved to it instead. Plotting is only supported with fit_trace, and
+  ValueError is raised for the others.
+
+  Returns a TraceFit.'''
+  if plot or plot_output is not None:
+    # Check before loading anything.
+    if encoder_index:
+      raise ValueError('Plotting three phases is not supported')
+    if harmonics is not None:
+      raise ValueError('Plotting only some harmonics is not supported')
+    if all_cycles:
+      raise ValueError('Plotting all cycles is not supported')
+  if encoder_index:
+    return fit_three_phase(*load_channels(filename),
+                           electrical_ratio=electrical_ratio)
+  timesteps, data = load_trace(filename)
+  if harmonics is not None:
+    return fit_harmonics(timesteps, data, harmonics, all_cycles=all_cycles)
+  if all_cycles:
+    return fit_all_cycles(timesteps, data)
+  fit = fit_trace(timesteps, data)
+  if plot or plot_output is not None:
+    plot_fit(fit, timesteps, data, filename, output=plot_output)
+  return fit
+
+def _plot_output(filename, plot_dir, plot_format):
+  '''Returns where to save the plot for filename, or None to not save it.'''
+  if plot_dir is None:
+    return None
+  name = os.path.splitext(os.path.basename(filename))[0]
+  return os.path.join(plot_dir, '%s.%s' % (name, plot_format))
+
+def _summarize(filename, plot_dir=None, plot_format='png', **kwargs):
+  '''Processes one file for a batch, returning a JSON-compatible summary.
+
+  kwargs are passed to process_trace, and plots are saved in plot_dir if it's
+  set.'''
+  try:
+    fit = process_trace(filename,
+                        plot_output=_plot_output(filename, plot_dir,
+                                                 plot_format),
+                        **kwargs)
+  except Exception as e:
+    return {'file': filename, 'error': '%s: %s' % (type(e).__name__, e)}
+  summary = {'file': filename, 'omega': fit.omega,
+             'line_line_f_coeff': {str(harmonic): list(value)
+                                   for harmonic, value
+                                   in sorted(fit.line_line_f_coeff.items())}}
+  if hasattr(fit, 'line_line_f_spread'):
+    summary['number_cycles'] = fit.number_cycles
+    summary['line_line_f_spread'] = {
+        str(harmonic): list(value)
+        for harmonic, value in sorted(fit.line_line_f_spread.items())}
+  return summary
+
+def _trace_files(paths):
+  '''Expands directories in paths to the preprocessed traces in them.'''
+  for path in paths:
+    if os.path.isdir(path):
+      for name in sorted(os.listdir(path)):
+        if ((name.endswith('.csv') and not name.endswith('_raw.csv')) or
+            name.endswith(trace_format.EXTENSION)):
+          yield os.path.join(path, name)
+    else:
+      yield path
+
+def _write_summary(summaries, output):
+  if output.endswith('.json'):
+    with open(output, 'w') as f:
+      json.dump(summaries, f, indent=2)
+      f.write('\n')
+    return
+  with open(output, 'w') as f:
+    writer = csv.writer(f, lineterminator='\n')
+    writer.writerow(('file', 'omega', 'harmonic', 'amplitude', 'angle',
+                     'amplitude_spread', 'angle_spread', 'cycles', 'error'))
+    for summary in summaries:
+      if 'error' in summary:
+        writer.writerow((summary['file'], '', '', '', '', '', '', '',
+                         summary['error']))
+        continue
+      spreads = summary.get('line_line_f_spread', {})
+      for harmonic, (amplitude, angle) in summary['line_line_f_coeff'].items():
+        amplitude_spread, angle_spread = (
+            (repr(value) for value in spreads[harmonic])
+            if harmonic in spreads else ('', ''))
+        writer.writerow((summary['file'], repr(summary['omega']), harmonic,
+                         repr(amplitude), repr(angle), amplitude_spread,
+                         angle_spread, summary.get('number_cycles', ''), ''))
+
+def main(argv):
+  parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+  parser.add_argument('paths', nargs='+',
+                      help='Preprocessed trace files, or directories of them')
+  parser.add_argument('--plot', action='store_true',
+                      help='Plot each fit (only with a single file)')
+  parser.add_argument('--plot-dir',
+                      help='Save a plot of each fit in this directory, without '
+                      'needing a GUI')
+  parser.add_argument('--plot-format', choices=('png', 'svg', 'pdf'),
+                      default='png', help='The format for --plot-dir')
+  parser.add_argument('--all-cycles', action='store_true',
+                      help='Average the fits of every cycle instead of just '
+                      'fitting the first one')
+  parser.add_argument('--encoder-index', action='store_true',
+                      help='Average the fits of every revolution of all three '
+                      'phases, using the encoder index for timing (only with '
+                      'three-phase traces)')
+  parser.add_argument('--electrical-ratio', type=int,
+                      help='Electrical cycles per revolution for '
+                      '--encoder-index (found automatically by default)')
+  parser.add_argument('--harmonics',
+                      type=lambda text: [int(part) for part in text.split(',')],
+                      help='Only calculate these comma-separated harmonics '
+                      '(for example %s), which is faster for long traces' %
+                      ','.join(str(harmonic) for harmonic in default_harmonics))
+  parser.add_argument('--jobs', type=int,
+                      help='Number of traces to process in parallel')
+  parser.add_argument('--summary',
+                      help='Write a summary of all the fits to this .json or '
+                      '.csv file, instead of JSON to stdout')
+  args = parser.parse_args(argv)
+
+  filenames = list(_trace_files(args.paths))
+  if ((args.plot or args.plot_dir) and
+      (args.all_cycles or args.encoder_index or args.harmonics)):
+    parser.error('Plotting does not work with --all-cycles, --encoder-index or '
+                 '--harmonics')
+  if args.plot_dir is not None:
+    os.makedirs(args.plot_dir, exist_ok=True)
+  if args.harmonics and args.encoder_index:
+    parser.error('--harmonics does not work with --encoder-index')
+  if args.electrical_ratio is not None and not args.encoder_index:
+    parser.error('--electrical-ratio only works with --encoder-index')
+  options = {'all_cycles': args.all_cycles,
+             'encoder_index': args.encoder_index,
+             'electrical_ratio': args.electrical_ratio,
+             'harmonics': args.harmonics}
+  if len(filenames) == 1 and not args.summary:
+    fit = process_trace(filenames[0], plot=args.plot,
+                        plot_output=_plot_output(filenames[0], args.plot_dir,
+                                                 args.plot_format),
+                        **options)
+    if hasattr(fit, 'harmonics'):
+      for harmonic, amplitude in sorted(fit.harmonics.items()):
+        print('Harmonic %d: %.8f V/(rad/s)' % (harmonic, amplitude))
+    else:
+      print('Mostly found noise after %d' %
+            (fit.number_precise_coefficients,))
+    print(fit.linkage_message())
+    if hasattr(fit, 'line_line_f_spread'):
+      print('Averaged %d cycles, standard deviations:' % (fit.number_cycles,))
+      for harmonic, (amplitude, angle) in sorted(
+          fit.line_line_f_spread.items()):
+        print('  harmonic %d: amplitude %.8f, angle %f' % (harmonic, amplitude,
+                                                          angle))
+    return 0
+  if args.plot:
+    parser.error('--plot only works with a single file')
+
+  with concurrent.futures.ProcessPoolExecutor(args.jobs) as executor:
+    summaries = list(executor.map(
+        functools.partial(_summarize, plot_dir=args.plot_dir,
+                          plot_format=args.plot_format, **options),
+        filenames))
+  for summary in summaries:
+    if 'error' in summary:
+      print('%s: %s' % (summary['file'], summary['error']), file=sys.stderr)
+  if args.summary:
+    _write_summary(summaries, args.summary)
+  else:
+    json.dump(summaries, sys.stdout, indent=2)
+    print()
+  return 1 if any('error' in summary for summary in summaries) else 0
+
+if __name__ == '__main__':
+  sys.exit(main(sys.argv[1:]))
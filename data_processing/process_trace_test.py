@@ -0,0 +1,266 @@
+#!/usr/bin/python3
+
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+
+import numpy
+
+import process_trace
+import trace_format
+
+_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+
+def _path(name):
+  return os.path.join(_DIRECTORY, name)
+
+# The coefficients in models.py came from these files.
+_EXPECTED = {
+    'boma.csv': {1: (0.03382623, 0), 7: (0.00343913, 0)},
+    'my1020.csv': {1: (0.03202452, 0), 7: (0.00242868, 0)},
+    't20.csv': {1: (0.00660802, 0), 5: (0.00097149, 0)},
+    }
+
+class ProcessTraceTest(unittest.TestCase):
+  def assertCoeffAlmostEqual(self, actual, expected, places=8):
+    self.assertEqual(sorted(actual), sorted(expected))
+    for harmonic in expected:
+      self.assertAlmostEqual(actual[harmonic][0], expected[harmonic][0],
+                             places=places)
+      self.assertAlmostEqual(actual[harmonic][1], expected[harmonic][1])
+
+  def test_bundled(self):
+    for name, expected in _EXPECTED.items():
+      with self.subTest(name=name):
+        fit = process_trace.process_trace(_path(name))
+        self.assertCoeffAlmostEqual(fit.line_line_f_coeff, expected)
+
+  def test_binary(self):
+    with tempfile.TemporaryDirectory() as directory:
+      for name, expected in _EXPECTED.items():
+        with self.subTest(name=name):
+          filename = os.path.join(directory, name[:-len('.csv')] +
+                                  trace_format.EXTENSION)
+          timesteps, data = process_trace.load_trace(_path(name))
+          with trace_format.TraceWriter(filename) as writer:
+            writer.write(timesteps, data)
+          fit = process_trace.process_trace(filename)
+          self.assertCoeffAlmostEqual(fit.line_line_f_coeff, expected)
+
+  def test_zero_crossings(self):
+    _, data = process_trace.load_trace(_path('t20.csv'))
+    numpy.testing.assert_array_equal(
+        process_trace.find_zero_crossings(data), (533, 2513, 4489, 6463))
+
+    # Noise around the crossings shouldn't add any extra ones.
+    theta = numpy.arange(20000) * (numpy.pi * 2 / 997)
+    noise = numpy.random.default_rng(0).normal(0, 0.05, len(theta))
+    crossings = process_trace.find_zero_crossings(3 * numpy.sin(theta) + noise)
+    self.assertEqual(len(crossings), 20)
+    numpy.testing.assert_allclose((crossings + 498) % 997 - 498, 0, atol=5)
+
+  def test_first_zero_crossings(self):
+    for name in _EXPECTED:
+      _, data = process_trace.load_trace(_path(name))
+      for search_size in (16, 1000, 1 << 20):
+        with self.subTest(name=name, search_size=search_size):
+          numpy.testing.assert_array_equal(
+              process_trace._first_zero_crossings(data, 2, search_size),
+              process_trace.find_zero_crossings(data)[:2])
+    self.assertEqual(len(process_trace._first_zero_crossings(
+        numpy.ones(100), 2, 16)), 0)
+
+  def test_all_cycles(self):
+    for name, expected in _EXPECTED.items():
+      with self.subTest(name=name):
+        fit = process_trace.process_trace(_path(name), all_cycles=True)
+        self.assertGreater(fit.number_cycles, 1)
+        self.assertEqual(sorted(fit.line_line_f_spread), sorted(expected))
+        self.assertCoeffAlmostEqual(fit.line_line_f_coeff, expected, places=3)
+
+  def test_all_cycles_synthetic(self):
+    # 10 kHz samples at 50 electrical revolutions per second.
+    timesteps = numpy.arange(20000) * 1e-4
+    omega = numpy.pi * 2 * 50
+    theta = omega * timesteps + 1
+    data = omega * (0.03 * numpy.cos(theta) +
+                    0.003 * numpy.cos(7 * theta + numpy.pi))
+    data += numpy.random.default_rng(0).normal(0, 0.05, len(data))
+    fit = process_trace.fit_all_cycles(timesteps, data)
+    self.assertGreater(fit.number_cycles, 90)
+    self.assertAlmostEqual(fit.omega, omega, delta=omega * 1e-3)
+    self.assertCoeffAlmostEqual(fit.line_line_f_coeff,
+                                {1: (0.03, 0), 7: (0.003, numpy.pi)},
+                                places=4)
+
+  def test_select_coefficients(self):
+    def reference(fft):
+      '''The original version, which rebuilds the approximation each time.'''
+      number = process_trace.number_coefficients
+      _, max_index = process_trace.approximate(fft, number)
+      while abs(fft[max_index]) >= abs(fft[1]) / 30:
+        number += 1
+        _, max_index = process_trace.approximate(fft, number)
+      return number - 1
+
+    rng = numpy.random.default_rng(0)
+    for _ in range(50):
+      fft = rng.normal(size=200) + 1j * rng.normal(size=200)
+      fft /= numpy.arange(1, 201) ** 1.5
+      fft[1] *= 2
+      self.assertEqual(process_trace.select_coefficients(fft), reference(fft))
+    for name in _EXPECTED:
+      _, data = process_trace.load_trace(_path(name))
+      first, second = process_trace.find_zero_crossings(data)[:2]
+      fft = numpy.fft.rfft(data[first:second - (second - first) % 2])
+      self.assertEqual(process_trace.select_coefficients(fft), reference(fft))
+
+  def test_index_pulses(self):
+    index = numpy.zeros(100)
+    index[[10, 11, 60]] = 5
+    index[40] = 2
+    numpy.testing.assert_allclose(process_trace.find_index_pulses(index),
+                                  (9.5, 59.5))
+
+  def test_three_phase(self):
+    fit = process_trace.process_trace(_path('t20.csv'), encoder_index=True)
+    self.assertEqual(fit.electrical_ratio, 2)
+    self.assertEqual(fit.number_revolutions, 2)
+    self.assertCoeffAlmostEqual(fit.line_line_f_coeff, _EXPECTED['t20.csv'],
+                                places=4)
+
+  def test_three_phase_binary(self):
+    '''Single-channel fits of a three-phase binary trace use the first
+    line-to-line voltage, like they do for CSV.'''
+    with tempfile.TemporaryDirectory() as directory:
+      filename = os.path.join(directory, 't20' + trace_format.EXTENSION)
+      timesteps, line_lines, index = process_trace.load_channels(
+          _path('t20.csv'))
+      with trace_format.TraceWriter(filename) as writer:
+        writer.write(timesteps, numpy.column_stack((line_lines, index)))
+      fit = process_trace.process_trace(filename)
+      self.assertCoeffAlmostEqual(fit.line_line_f_coeff, _EXPECTED['t20.csv'])
+      fit = process_trace.process_trace(filename, encoder_index=True)
+      self.assertEqual(fit.number_revolutions, 2)
+      self.assertCoeffAlmostEqual(fit.line_line_f_coeff, _EXPECTED['t20.csv'],
+                                  places=4)
+
+  def test_three_phase_synthetic(self):
+    # 100 kHz samples at 25 mechanical revolutions per second, with 3
+    # electrical cycles per revolution.
+    timesteps = numpy.arange(50000) * 1e-5
+    mechanical_omega = numpy.pi * 2 * 25
+    mechanical_theta = mechanical_omega * timesteps + 1
+    omega = mechanical_omega * 3
+    rng = numpy.random.default_rng(0)
+    line_lines = []
+    for phase in range(3):
+      theta = mechanical_theta * 3 - phase * numpy.pi * 2 / 3
+      line_lines.append(omega * (0.01 * numpy.cos(theta) +
+                                 0.001 * numpy.cos(5 * theta + numpy.pi)) +
+                        rng.normal(0, 0.2, len(timesteps)))
+    index = numpy.where(mechanical_theta % (numpy.pi * 2) < 0.05, 5.0, 0.0)
+    fit = process_trace.fit_three_phase(timesteps,
+                                        numpy.column_stack(line_lines), index)
+    self.assertEqual(fit.electrical_ratio, 3)
+    self.assertEqual(fit.number_revolutions, 11)
+    self.assertAlmostEqual(fit.omega, omega, delta=omega * 1e-3)
+    self.assertCoeffAlmostEqual(fit.line_line_f_coeff,
+                                {1: (0.01, 0), 5: (0.001, numpy.pi)},
+                                places=5)
+
+  def test_project_harmonics(self):
+    data = numpy.random.default_rng(0).normal(size=1000)
+    fft = numpy.fft.rfft(data) / 500
+    for chunk_size in (1000, 64, 1):
+      with self.subTest(chunk_size=chunk_size):
+        chunks = (data[i:i + chunk_size] for i in range(0, 1000, chunk_size))
+        numpy.testing.assert_allclose(
+            process_trace.project_harmonics(chunks, 1000, (1, 5, 7, 100),
+                                            chunk_size=chunk_size),
+            fft[[1, 5, 7, 100]], atol=1e-12)
+    # Fractional cycles with a whole number of them overall.
+    theta = numpy.arange(1001) * (numpy.pi * 2 * 7 / 1001)
+    numpy.testing.assert_allclose(
+        process_trace.project_harmonics([numpy.cos(theta + 0.5)], 1001 / 7,
+                                        (1, 2)),
+        (numpy.exp(0.5j), 0), atol=1e-12)
+    with self.assertRaises(ValueError):
+      process_trace.project_harmonics([data], 1000, chunk_size=100)
+
+  def test_fit_harmonics(self):
+    for name in ('boma.csv', 'my1020.csv', 't20.csv', 'neo.csv'):
+      with self.subTest(name=name):
+        timesteps, data = process_trace.load_trace(_path(name))
+        expected = process_trace.fit_trace(timesteps, data)
+        fit = process_trace.fit_harmonics(timesteps, data)
+        self.assertAlmostEqual(fit.omega, expected.omega)
+        self.assertCoeffAlmostEqual(fit.line_line_f_coeff,
+                                    expected.line_line_f_coeff, places=12)
+        self.assertCoeffAlmostEqual(
+            process_trace.fit_harmonics(timesteps, data,
+                                        all_cycles=True).line_line_f_coeff,
+            expected.line_line_f_coeff, places=3)
+
+  def test_decimate_envelope(self):
+    timesteps = numpy.arange(10000) * 0.5
+    data = numpy.random.default_rng(0).normal(size=10000)
+    decimated_timesteps, decimated = process_trace.decimate_envelope(
+        timesteps, data, 100)
+    self.assertEqual(len(decimated), 200)
+    numpy.testing.assert_array_equal(decimated_timesteps[::2],
+                                     timesteps[::100])
+    numpy.testing.assert_array_equal(decimated[0::2],
+                                     data.reshape(100, 100).min(axis=1))
+    numpy.testing.assert_array_equal(decimated[1::2],
+                                     data.reshape(100, 100).max(axis=1))
+    short_timesteps, short = process_trace.decimate_envelope(
+        timesteps[:150], data[:150], 100)
+    numpy.testing.assert_array_equal(short_timesteps, timesteps[:150])
+    numpy.testing.assert_array_equal(short, data[:150])
+
+  def test_plot_output(self):
+    with tempfile.TemporaryDirectory() as directory:
+      code = '\n'.join((
+          'import sys',
+          'import process_trace',
+          'for extension in ("png", "svg"):',
+          '  process_trace.process_trace(sys.argv[1], plot_output="%s/t20.%s" '
+          '% (sys.argv[2], extension))',
+          'assert "matplotlib.pyplot" not in sys.modules'))
+      subprocess.run((sys.executable, '-c', code, _path('t20.csv'), directory),
+                     cwd=_DIRECTORY, check=True)
+      for extension in ('png', 'svg'):
+        self.assertGreater(
+            os.path.getsize(os.path.join(directory, 't20.' + extension)), 1000)
+
+  def test_plot_unsupported(self):
+    for kwargs in ({'encoder_index': True}, {'harmonics': (1, 5)},
+                   {'all_cycles': True}):
+      for plot_kwargs in ({'plot': True}, {'plot_output': 'unused.png'}):
+        with self.subTest(**kwargs, **plot_kwargs):
+          with self.assertRaises(ValueError):
+            process_trace.process_trace(_path('t20.csv'), **kwargs,
+                                        **plot_kwargs)
+
+  def test_batch(self):
+    with tempfile.TemporaryDirectory() as directory:
+      summary = os.path.join(directory, 'summary.json')
+      subprocess.run((sys.executable, _path('process_trace.py'), _DIRECTORY,
+                      '--jobs', '2', '--summary', summary), check=True)
+      with open(summary) as f:
+        summaries = {os.path.basename(entry['file']): entry
+                     for entry in json.load(f)}
+    for name, expected in _EXPECTED.items():
+      with self.subTest(name=name):
+        self.assertNotIn('error', summaries[name])
+        self.assertCoeffAlmostEqual(
+            {int(harmonic): value for harmonic, value
+             in summaries[name]['line_line_f_coeff'].items()},
+            expected)
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,191 @@
+#!/usr/bin/python3
+
+'''Measures flux linkage coefficients against speed from a trace of a motor
+spinning down.
+
+The speed doesn't have to be constant, so one spin-down capture gives the back
+EMF constants over a whole range of speeds. The trace is split into
+overlapping windows, which each have to be short enough for the speed to be
+about constant over them. The speed in each one is found from the biggest peak
+in its spectrum, and then each harmonic is measured at exactly that speed.
+
+Run with --help for details of the command line tool, which writes a CSV table
+to stdout.'''
+
+import argparse
+import sys
+
+import numpy
+from numpy.lib.stride_tricks import sliding_window_view
+
+import process_trace
+
+# How many cycles each window is by default.
+window_cycles = 8
+# How many windows to analyze at a time. This bounds the memory used.
+batch_size = 64
+
+def _dtype(harmonics):
+  return numpy.dtype([('time', float), ('omega', float)] +
+                     [(name % harmonic, float) for harmonic in harmonics
+                      for name in ('linkage_%d', 'angle_%d')])
+
+def spin_down(timesteps, data, window=None, hop=None,
+              harmonics=process_trace.default_harmonics):
+  '''Analyzes overlapping windows of a trace.
+
+  Arguments
+  ---------
+  timesteps, data : arrays
+      The trace, which must be evenly spaced.
+  window : int, optional
+      The number of samples in each window. This must be at least a few
+      cycles at the slowest speed of interest, but short enough that the speed
+      doesn't change much within it. By default it's window_cycles times the
+      median cycle length, or the whole trace if that's shorter.
+  hop : int, optional
+      The number of samples between the start of each window. By default it's a
+      quarter of window.
+  harmonics : sequence of int
+      The harmonics to measure, which must start with 1.
+
+  Returns
+  -------
+  numpy.ndarray
+      A structured array with a row for each window. It has time (of the middle
+      of the window in s) and omega (in electrical rad/s) fields, and
+      linkage_N (in V/(rad/s)) and angle_N (relative to the fundamental, like
+      line_line_f_coeff) fields for each harmonic N.
+  '''
+  harmonics = numpy.asarray(harmonics)
+  if harmonics[0] != 1:
+    raise ValueError('harmonics must start with the fundamental')
+  data = numpy.asarray(data)
+  if window is None:
+    crossings = process_trace.find_zero_crossings(data)
+    if len(crossings) < 2:
+      raise ValueError('Found no complete cycles')
+    window = min(int(numpy.median(numpy.diff(crossings)) * window_cycles),
+                 len(data))
+  if hop is None:
+    hop = max(window // 4, 1)
+  if window > len(data):
+    raise ValueError('window is longer than the trace')
+  dt = (timesteps[len(data) - 1] - timesteps[0]) / (len(data) - 1)
+
+  windows = sliding_window_view(data, window)[::hop]
+  starts = numpy.arange(len(windows)) * hop
+  taper = numpy.hanning(window)
+  # Measure phases relative to the middle of the window, where the speed is
+  # closest to the average.
+  offsets = numpy.arange(window) - (window - 1) / 2
+  half = window // 2
+  half_taper = numpy.hanning(half)
+  half_offsets = numpy.arange(half) - (half - 1) / 2
+  amplitudes = numpy.empty((len(windows), len(harmonics)), dtype=complex)
+  frequencies = numpy.empty(len(windows))
+  for batch in range(0, len(windows), batch_size):
+    frames = windows[batch:batch + batch_size] * taper
+    magnitudes = abs(numpy.fft.rfft(frames, axis=1))
+    # The biggest peak above DC is the fundamental. Interpolate a parabola
+    # through the log of it and its neighbours to find the exact frequency.
+    peaks = numpy.argmax(magnitudes[:, 2:-1], axis=1) + 2
+    rows = numpy.arange(len(frames))
+    with numpy.errstate(divide='ignore'):
+      below, peak, above = (numpy.log(magnitudes[rows, peaks + offset])
+                            for offset in (-1, 0, 1))
+    curvature = below - 2 * peak + above
+    shift = numpy.where(curvature < 0,
+                        0.5 * (below - above) / numpy.where(curvature < 0,
+                                                            curvature, -1), 0)
+    frame_frequencies = (peaks + shift) / window
+    # Refine that with the difference in the fundamental's phase between the
+    # two halves of the window.
+    halves = windows[batch:batch + batch_size, :half * 2].reshape(
+        len(frames), 2, half) * half_taper
+    half_phasors = numpy.exp(-2j * numpy.pi * numpy.multiply.outer(
+        frame_frequencies, half_offsets))
+    first, second = numpy.einsum('whn,wn->hw', halves, half_phasors)
+    # Each half is relative to its own middle, so remove the difference that
+    # frame_frequencies accounts for.
+    frame_frequencies += numpy.angle(
+        second * numpy.conj(first) *
+        numpy.exp(-2j * numpy.pi * frame_frequencies * half)) / (
+            numpy.pi * 2 * half)
+    frequencies[batch:batch + len(frames)] = frame_frequencies
+
+    phasors = numpy.exp(-2j * numpy.pi * frame_frequencies[:, None, None] *
+                        numpy.multiply.outer(offsets, harmonics))
+    amplitudes[batch:batch + len(frames)] = numpy.einsum(
+        'wn,wnk->wk', frames, phasors) * (2 / numpy.sum(taper))
+
+  rows = numpy.zeros(len(windows), dtype=_dtype(harmonics))
+  rows['time'] = timesteps[starts + window // 2]
+  rows['omega'] = numpy.pi * 2 * frequencies / dt
+  angles = numpy.angle(amplitudes)
+  for i, harmonic in enumerate(harmonics):
+    rows['linkage_%d' % harmonic] = abs(amplitudes[:, i]) / rows['omega']
+    relative = angles[:, i] - angles[:, 0] * harmonic
+    rows['angle_%d' % harmonic] = (relative + numpy.pi) % (
+        numpy.pi * 2) - numpy.pi
+  return rows
+
+def speed_table(rows, bin_width):
+  '''Averages rows from spin_down by speed.
+
+  Returns a structured array with a row for each bin_width (in rad/s) wide
+  range of omegas which has any windows in it. It has omega (the average),
+  count, and linkage_N and linkage_N_std (the standard deviation) for each
+  harmonic N.'''
+  harmonics = [int(name[len('linkage_'):]) for name in rows.dtype.names
+               if name.startswith('linkage_')]
+  bins = numpy.floor(rows['omega'] / bin_width).astype(int)
+  used, inverse = numpy.unique(bins, return_inverse=True)
+  count = numpy.bincount(inverse)
+  def mean(values):
+    return numpy.bincount(inverse, values) / count
+  table = numpy.zeros(len(used), dtype=[('omega', float), ('count', int)] + [
+      (name % harmonic, float) for harmonic in harmonics
+      for name in ('linkage_%d', 'linkage_%d_std')])
+  table['omega'] = mean(rows['omega'])
+  table['count'] = count
+  for harmonic in harmonics:
+    linkage = rows['linkage_%d' % harmonic]
+    average = mean(linkage)
+    table['linkage_%d' % harmonic] = average
+    table['linkage_%d_std' % harmonic] = numpy.sqrt(numpy.maximum(
+        mean(linkage ** 2) - average ** 2, 0))
+  return table
+
+def main(argv):
+  parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+  parser.add_argument('path', help='A preprocessed trace')
+  parser.add_argument('--window', type=int,
+                      help='Samples per window (default %d cycles)' %
+                      window_cycles)
+  parser.add_argument('--hop', type=int,
+                      help='Samples between windows (default a quarter of '
+                      'the window)')
+  parser.add_argument('--harmonics',
+                      type=lambda text: [int(part) for part in text.split(',')],
+                      default=process_trace.default_harmonics,
+                      help='Comma-separated harmonics to measure, starting '
+                      'with 1')
+  parser.add_argument('--speed-bin', type=float,
+                      help='Average the windows into bins this wide (in rad/s) '
+                      'instead of writing each one')
+  args = parser.parse_args(argv)
+
+  timesteps, data = process_trace.load_trace(args.path)
+  rows = spin_down(timesteps, data, window=args.window, hop=args.hop,
+                   harmonics=args.harmonics)
+  if args.speed_bin is not None:
+    rows = speed_table(rows, args.speed_bin)
+  formats = ['%d' if rows.dtype[name].kind == 'i' else '%.10g'
+             for name in rows.dtype.names]
+  numpy.savetxt(sys.stdout, rows, fmt=formats, delimiter=',',
+                header=','.join(rows.dtype.names), comments='')
+  return 0
+
+if __name__ == '__main__':
+  sys.exit(main(sys.argv[1:]))
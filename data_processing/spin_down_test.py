@@ -0,0 +1,71 @@
+#!/usr/bin/python3
+
+import os
+import unittest
+
+import numpy
+
+import process_trace
+import spin_down
+
+_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+
+class SpinDownTest(unittest.TestCase):
+  def setUp(self):
+    # 100 kHz samples of an exponential spin-down from 300 electrical
+    # revolutions per second, with a fundamental which increases with speed.
+    self.timesteps = numpy.arange(500000) * 1e-5
+    self.start_omega = numpy.pi * 2 * 300
+    self.time_constant = 2.5
+    omega = self.omega(self.timesteps)
+    theta = self.start_omega * self.time_constant * (
+        1 - numpy.exp(-self.timesteps / self.time_constant))
+    self.data = omega * (self.linkage(omega) * numpy.cos(theta) +
+                         0.003 * numpy.cos(7 * theta + numpy.pi))
+    self.data += numpy.random.default_rng(0).normal(0, 0.2, len(self.data))
+
+  def omega(self, time):
+    return self.start_omega * numpy.exp(-time / self.time_constant)
+
+  def linkage(self, omega):
+    return 0.03 * (1 + 0.1 * omega / self.start_omega)
+
+  def test_spin_down(self):
+    rows = spin_down.spin_down(self.timesteps, self.data, window=4096,
+                               harmonics=(1, 5, 7))
+    self.assertEqual(len(rows), (len(self.data) - 4096) // 1024 + 1)
+    omega = self.omega(rows['time'])
+    # At least 4 cycles per window.
+    fast = omega > numpy.pi * 2 * 4 / (4096 * 1e-5)
+    self.assertGreater(numpy.sum(fast), len(rows) // 2)
+    rows, omega = rows[fast], omega[fast]
+    numpy.testing.assert_allclose(rows['omega'], omega, rtol=1e-3)
+    numpy.testing.assert_allclose(rows['linkage_1'], self.linkage(omega),
+                                  rtol=2e-3)
+    numpy.testing.assert_allclose(rows['linkage_5'], 0, atol=1e-4)
+    numpy.testing.assert_allclose(rows['linkage_7'], 0.003, rtol=2e-2)
+    numpy.testing.assert_allclose(abs(rows['angle_7']), numpy.pi, atol=0.05)
+
+  def test_speed_table(self):
+    rows = spin_down.spin_down(self.timesteps, self.data, window=4096)
+    table = spin_down.speed_table(rows, 200)
+    self.assertEqual(numpy.sum(table['count']), len(rows))
+    self.assertTrue((numpy.diff(table['omega']) > 0).all())
+    fast = table['omega'] > 1000
+    numpy.testing.assert_allclose(table['linkage_1'][fast],
+                                  self.linkage(table['omega'][fast]),
+                                  rtol=2e-3)
+
+  def test_constant_speed(self):
+    timesteps, data = process_trace.load_trace(
+        os.path.join(_DIRECTORY, 't20.csv'))
+    fit = process_trace.fit_all_cycles(timesteps, data)
+    rows = spin_down.spin_down(timesteps, data)
+    numpy.testing.assert_allclose(rows['omega'], fit.omega, rtol=1e-2)
+    numpy.testing.assert_allclose(rows['linkage_1'],
+                                  fit.line_line_f_coeff[1][0], rtol=1e-2)
+    numpy.testing.assert_allclose(rows['linkage_5'],
+                                  fit.line_line_f_coeff[5][0], rtol=2e-2)
+
+if __name__ == '__main__':
+  unittest.main()
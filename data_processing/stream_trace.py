@@ -0,0 +1,337 @@
+#!/usr/bin/python3
+
+'''Estimates flux linkage coefficients from a trace while it's being captured.
+
+This reads lines in the same format as preprocessed traces (time,voltage) from
+a file which is still being written to, or a pipe, and prints the estimate
+after each cycle until it converges.
+
+The pieces are generators, so they can be used separately too:
+  read_samples produces chunks of samples from a file.
+  stream_cycles splits chunks of samples into complete cycles.
+  estimate_stream produces a running estimate after each cycle.
+'''
+
+import argparse
+import sys
+import time
+
+import numpy
+
+import process_trace
+
+# How many bytes to read at a time.
+BLOCK_SIZE = 1 << 16
+# The most samples to keep while waiting for the next zero crossing.
+MAX_BUFFER = 1 << 22
+
+def _parse_lines(lines):
+  data = numpy.loadtxt(lines, delimiter=',', usecols=(0, 1), ndmin=2)
+  return data[:, 0], data[:, 1]
+
+def read_samples(f, block_size=BLOCK_SIZE, follow=False, poll_interval=0.1,
+                 idle_timeout=None):
+  '''Yields (timesteps, data) chunks of the lines read from f.
+
+  f must be a binary file object (such as sys.stdin.buffer). Each chunk has
+  whatever complete lines were available.
+
+  If follow is set, this keeps waiting for more lines to be appended to f
+  (checking every poll_interval seconds) after reaching the end, until nothing
+  has been added for idle_timeout seconds (forever if it's None).'''
+  remainder = b''
+  last_data = time.monotonic()
+  while True:
+    block = f.read1(block_size)
+    if not block:
+      if follow and (idle_timeout is None or
+                     time.monotonic() - last_data < idle_timeout):
+        time.sleep(poll_interval)
+        continue
+      break
+    last_data = time.monotonic()
+    lines = (remainder + block).split(b'\n')
+    remainder = lines.pop()
+    lines = [line.decode('ascii') for line in lines if line.strip()]
+    if lines:
+      yield _parse_lines(lines)
+  if remainder.strip():
+    yield _parse_lines([remainder.decode('ascii')])
+
+class _SampleBuffer(object):
+  '''Timesteps and data which can have samples appended to the end and dropped
+  from the start, each in amortized constant time per sample.
+
+  The arrays from times and data stay valid after later changes.'''
+  def __init__(self, capacity=1 << 10):
+    self._times = numpy.zeros(capacity)
+    self._data = numpy.zeros(capacity)
+    self._begin = 0
+    self._end = 0
+
+  def __len__(self):
+    return self._end - self._begin
+
+  @property
+  def times(self):
+    return self._times[self._begin:self._end]
+
+  @property
+  def data(self):
+    return self._data[self._begin:self._end]
+
+  def append(self, times, data):
+    count = len(data)
+    if self._end + count > len(self._data):
+      # Leave as much room as there is data, so copying it is paid for by the
+      # appends before the next time.
+      capacity = max(len(self._data), (len(self) + count) * 2)
+      times_array, data_array = numpy.zeros(capacity), numpy.zeros(capacity)
+      times_array[:len(self)] = self.times
+      data_array[:len(self)] = self.data
+      self._times, self._data = times_array, data_array
+      self._begin, self._end = 0, len(self)
+    self._times[self._end:self._end + count] = times
+    self._data[self._end:self._end + count] = data
+    self._end += count
+
+  def drop(self, count):
+    '''Removes count samples from the start.'''
+    self._begin += count
+
+def stream_cycles(chunks, max_buffer=MAX_BUFFER):
+  '''Splits chunks of samples into complete cycles.
+
+  Zero crossings are found exactly like process_trace.find_zero_crossings
+  does, but as each chunk arrives. Only the samples since the last zero
+  crossing (up to max_buffer of them) are kept.
+
+  Each crossing ends at a sample above process_trace.zero_noise, and only
+  depends on the data back to the one before that. So chunks without any of
+  those are skipped, and the rest are only searched from there, which keeps
+  the total work proportional to the number of samples.
+
+  Arguments
+  ---------
+  chunks : iterable of (timesteps, data)
+
+  Yields
+  ------
+  (start, period, data)
+      Where the cycle starts (as an index into all the samples), how long it
+      takes in seconds, and its samples.
+  '''
+  buffer = _SampleBuffer()
+  # The index of the first sample in the buffer.
+  offset = 0
+  last_crossing = None
+  last_end = -1
+  # The index of the last sample above zero_noise.
+  last_high = None
+  for timesteps, data in chunks:
+    data = numpy.asarray(data, dtype=float)
+    chunk_start = offset + len(buffer)
+    buffer.append(timesteps, data)
+    high = numpy.flatnonzero(data >= process_trace.zero_noise)
+    if len(high):
+      search = offset if last_high is None else max(last_high, offset)
+      starts, ends = process_trace.zero_crossing_bounds(
+          buffer.data[search - offset:])
+      starts, ends = starts + search, ends + search
+      new = ends > last_end
+      for start, end in zip(starts[new], ends[new]):
+        crossing = (start + end) // 2
+        if last_crossing is not None:
+          yield (last_crossing,
+                 buffer.times[crossing - offset] -
+                 buffer.times[last_crossing - offset],
+                 buffer.data[last_crossing - offset:crossing - offset])
+        last_crossing = crossing
+        last_end = end
+      last_high = chunk_start + high[-1]
+
+    if last_crossing is not None:
+      keep = last_crossing - offset
+    else:
+      keep = 0
+    keep = max(keep, len(buffer) - max_buffer)
+    if last_crossing is not None and last_crossing - offset < keep:
+      # The cycle is too long to keep, so start again at the next crossing.
+      last_crossing = None
+    buffer.drop(keep)
+    offset += keep
+
+class RunningStatistics(object):
+  '''Keeps track of the mean and variance of arrays of values as they're added,
+  with Welford's algorithm.'''
+  def __init__(self, shape=()):
+    self._count = 0
+    self._mean = numpy.zeros(shape)
+    self._m2 = numpy.zeros(shape)
+
+  def add(self, values):
+    self._count += 1
+    delta = values - self._mean
+    self._mean = self._mean + delta / self._count
+    self._m2 = self._m2 + delta * (values - self._mean)
+
+  @property
+  def count(self):
+    return self._count
+
+  @property
+  def mean(self):
+    return self._mean
+
+  @property
+  def variance(self):
+    '''The sample variance.'''
+    if self._count < 2:
+      return numpy.zeros_like(self._m2)
+    return self._m2 / (self._count - 1)
+
+  @property
+  def standard_error(self):
+    '''The standard error of the mean.'''
+    return numpy.sqrt(self.variance / max(self._count, 1))
+
+# Estimates are converged once the standard errors of the coefficients are all
+# less than this fraction of the fundamental.
+convergence_tolerance = 1e-3
+# Always wait for at least this many cycles before deciding it's converged.
+min_cycles = 5
+# How many cycles the median length to filter the rest by comes from.
+reference_cycles = 5
+
+def estimate_stream(cycles, harmonics=process_trace.default_harmonics,
+                    tolerance=convergence_tolerance, min_cycles=min_cycles,
+                    reference_cycles=reference_cycles):
+  '''Keeps a running estimate of the flux linkage coefficients.
+
+  Cycles whose length is too far from the average are skipped, because they
+  probably have a missed zero crossing. Until the first one is accepted, the
+  lengths are compared with the median of the first reference_cycles of them
+  instead (which delays the first estimate until they've all arrived), so a bad
+  cycle at the start can't make all the good ones look wrong.
+
+  Arguments
+  ---------
+  cycles : iterable of (start, period, data)
+      For example from stream_cycles.
+  harmonics : sequence of int
+      The harmonics to estimate, which must include 1.
+
+  Yields
+  ------
+  process_trace.TraceFit
+      After each cycle, with line_line_f_coeff, omega, harmonics (like
+      process_trace.fit_harmonics), number_cycles, standard_errors (for each
+      harmonic in line_line_f_coeff) and converged.
+  '''
+  harmonics = numpy.asarray(harmonics)
+  if 1 not in harmonics:
+    raise ValueError('harmonics must include the fundamental')
+  fundamental = int(numpy.flatnonzero(harmonics == 1)[0])
+  # Each harmonic's flux linkage, and the cosine and sine of its angle relative
+  # to the fundamental.
+  statistics = RunningStatistics((3, len(harmonics)))
+  omegas = RunningStatistics()
+  lengths = RunningStatistics()
+
+  def regular(data, length):
+    return (abs(len(data) - length) <=
+            length * process_trace.cycle_length_tolerance)
+
+  def near_median(pending):
+    median = numpy.median([len(data) for _, data in pending])
+    return [(period, data) for period, data in pending
+            if regular(data, median)]
+
+  def accepted(cycles):
+    '''Yields the (period, data) of the cycles which should be used.'''
+    pending = []
+    for _, period, data in cycles:
+      if lengths.count:
+        if regular(data, lengths.mean):
+          yield period, data
+        continue
+      pending.append((period, data))
+      if len(pending) >= reference_cycles:
+        yield from near_median(pending)
+        pending = []
+    if pending:
+      yield from near_median(pending)
+
+  for period, data in accepted(cycles):
+    lengths.add(len(data))
+    omega = (numpy.pi * 2) / period
+    omegas.add(omega)
+    amplitudes = process_trace.project_harmonics([data], len(data), harmonics,
+                                                 chunk_size=len(data))
+    angles = numpy.angle(amplitudes) - (numpy.angle(amplitudes[fundamental]) *
+                                        harmonics)
+    statistics.add(numpy.array((abs(amplitudes) / omega, numpy.cos(angles),
+                                numpy.sin(angles))))
+
+    linkages = statistics.mean[0]
+    others = [i for i in numpy.argsort(linkages)[::-1] if i != fundamental]
+    used = [fundamental] + others[:process_trace.number_coefficients - 1]
+    line_line_f_coeff = {1: (float(linkages[fundamental]), 0.0)}
+    for i in used[1:]:
+      angle = numpy.arctan2(statistics.mean[2, i], statistics.mean[1, i])
+      line_line_f_coeff[int(harmonics[i])] = (
+          float(linkages[i]),
+          process_trace.round_angle(angle) % (numpy.pi * 2))
+    standard_errors = {int(harmonics[i]): float(statistics.standard_error[0, i])
+                       for i in used}
+    converged = bool(
+        statistics.count >= min_cycles and
+        max(standard_errors.values()) <= tolerance * linkages[fundamental])
+    yield process_trace.TraceFit(
+        line_line_f_coeff=line_line_f_coeff, omega=float(omegas.mean),
+        harmonics={int(harmonic): float(linkage)
+                   for harmonic, linkage in zip(harmonics, linkages)},
+        number_cycles=statistics.count, standard_errors=standard_errors,
+        converged=converged)
+
+def main(argv):
+  parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+  parser.add_argument('path',
+                      help='The trace to read, or - to read from stdin')
+  parser.add_argument('--follow', action='store_true',
+                      help='Keep waiting for more to be written to the file')
+  parser.add_argument('--idle-timeout', type=float,
+                      help='With --follow, stop after nothing has been '
+                      'written for this many seconds')
+  parser.add_argument('--harmonics',
+                      type=lambda text: [int(part) for part in text.split(',')],
+                      default=process_trace.default_harmonics,
+                      help='Comma-separated harmonics to estimate')
+  parser.add_argument('--tolerance', type=float,
+                      default=convergence_tolerance,
+                      help='Stop once the standard errors are less than this '
+                      'fraction of the fundamental')
+  parser.add_argument('--min-cycles', type=int, default=min_cycles)
+  args = parser.parse_args(argv)
+
+  if args.path == '-':
+    f = sys.stdin.buffer
+  else:
+    f = open(args.path, 'rb')
+  with f:
+    chunks = read_samples(f, follow=args.follow,
+                          idle_timeout=args.idle_timeout)
+    for fit in estimate_stream(stream_cycles(chunks), args.harmonics,
+                               tolerance=args.tolerance,
+                               min_cycles=args.min_cycles):
+      print('%d cycles, omega %.3f: %s' % (fit.number_cycles, fit.omega,
+                                          fit.linkage_message()))
+      sys.stdout.flush()
+      if fit.converged:
+        print('Converged')
+        return 0
+  print('Ran out of data before converging')
+  return 1
+
+if __name__ == '__main__':
+  sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,145 @@
+#!/usr/bin/python3
+
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+import numpy
+
+import process_trace
+import stream_trace
+
+_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+
+def _path(name):
+  return os.path.join(_DIRECTORY, name)
+
+def _synthetic(noise=0.3, count=400000):
+  '''Returns (timesteps, data) at 100 kHz and 50 electrical revolutions per
+  second.'''
+  timesteps = numpy.arange(count) * 1e-5
+  omega = numpy.pi * 2 * 50
+  theta = omega * timesteps + 1
+  data = omega * (0.03 * numpy.cos(theta) +
+                  0.003 * numpy.cos(7 * theta + numpy.pi))
+  data += numpy.random.default_rng(0).normal(0, noise, count)
+  return timesteps, data
+
+def _chunks(timesteps, data, size):
+  for i in range(0, len(data), size):
+    yield timesteps[i:i + size], data[i:i + size]
+
+class StreamTraceTest(unittest.TestCase):
+  def test_cycles(self):
+    for name in ('boma.csv', 't20.csv', 'neo.csv'):
+      timesteps, data = process_trace.load_trace(_path(name))
+      crossings = process_trace.find_zero_crossings(data)
+      for size in (1, 37, 100000):
+        with self.subTest(name=name, size=size):
+          cycles = list(stream_trace.stream_cycles(
+              _chunks(timesteps, data, size)))
+          self.assertEqual([start for start, _, _ in cycles],
+                           list(crossings[:-1]))
+          self.assertEqual([len(cycle) for _, _, cycle in cycles],
+                           list(numpy.diff(crossings)))
+
+  def test_cycles_linear(self):
+    '''A long stretch without crossings isn't searched again for each chunk.'''
+    timesteps, data = _synthetic(noise=0.01, count=100000)
+    # The motor stops for a while, with just noise.
+    data[20000:70000] = numpy.random.default_rng(1).normal(0, 0.01, 50000)
+    searched = []
+    original = process_trace.zero_crossing_bounds
+    def zero_crossing_bounds(data):
+      searched.append(len(data))
+      return original(data)
+    with mock.patch.object(stream_trace.process_trace, 'zero_crossing_bounds',
+                           zero_crossing_bounds):
+      cycles = list(stream_trace.stream_cycles(_chunks(timesteps, data, 50)))
+    self.assertLess(sum(searched), len(data) * 2)
+    crossings = process_trace.find_zero_crossings(data)
+    self.assertEqual([start for start, _, _ in cycles], list(crossings[:-1]))
+
+  def test_running_statistics(self):
+    values = numpy.random.default_rng(0).normal(size=(50, 3))
+    statistics = stream_trace.RunningStatistics(3)
+    for row in values:
+      statistics.add(row)
+    self.assertEqual(statistics.count, 50)
+    numpy.testing.assert_allclose(statistics.mean, numpy.mean(values, axis=0))
+    numpy.testing.assert_allclose(statistics.variance,
+                                  numpy.var(values, axis=0, ddof=1))
+
+  def test_converges(self):
+    timesteps, data = _synthetic()
+    for fit in stream_trace.estimate_stream(stream_trace.stream_cycles(
+        _chunks(timesteps, data, 5000))):
+      if fit.converged:
+        break
+    self.assertTrue(fit.converged)
+    self.assertLess(fit.number_cycles, 100)
+    self.assertEqual(sorted(fit.line_line_f_coeff), [1, 7])
+    self.assertAlmostEqual(fit.line_line_f_coeff[1][0], 0.03, places=4)
+    self.assertAlmostEqual(fit.line_line_f_coeff[7][0], 0.003, places=4)
+    self.assertAlmostEqual(fit.line_line_f_coeff[7][1], numpy.pi)
+
+  def test_bad_first_cycle(self):
+    '''A missed crossing in the first cycle doesn't get the rest rejected.'''
+    timesteps, data = _synthetic()
+    cycles = list(stream_trace.stream_cycles(_chunks(timesteps, data, 5000)))
+    (start, first_period, first), (_, second_period, second) = cycles[:2]
+    cycles[:2] = [(start, first_period + second_period,
+                   numpy.concatenate((first, second)))]
+    fits = list(stream_trace.estimate_stream(cycles))
+    self.assertEqual(fits[-1].number_cycles, len(cycles) - 1)
+    converged = next(fit for fit in fits if fit.converged)
+    self.assertAlmostEqual(converged.line_line_f_coeff[1][0], 0.03, places=4)
+    self.assertAlmostEqual(converged.line_line_f_coeff[7][0], 0.003, places=4)
+    # Short streams still get estimates.
+    self.assertEqual(
+        len(list(stream_trace.estimate_stream(cycles[:3]))), 2)
+
+  def test_follow(self):
+    with open(_path('boma.csv'), 'rb') as f:
+      contents = f.read()
+    with tempfile.TemporaryDirectory() as directory:
+      filename = os.path.join(directory, 'live.csv')
+      # Start with part of a line, and then write the rest later.
+      split = len(contents) // 2 + 3
+      with open(filename, 'wb') as f:
+        f.write(contents[:split])
+      def finish():
+        time.sleep(0.2)
+        with open(filename, 'ab') as f:
+          f.write(contents[split:])
+      writer = threading.Thread(target=finish)
+      writer.start()
+      with open(filename, 'rb') as f:
+        chunks = list(stream_trace.read_samples(f, follow=True,
+                                                poll_interval=0.01,
+                                                idle_timeout=1))
+      writer.join()
+    expected_timesteps, expected_data = process_trace.load_trace(
+        _path('boma.csv'))
+    numpy.testing.assert_array_equal(
+        numpy.concatenate([timesteps for timesteps, _ in chunks]),
+        expected_timesteps)
+    numpy.testing.assert_array_equal(
+        numpy.concatenate([data for _, data in chunks]), expected_data)
+
+  def test_pipe(self):
+    timesteps, data = _synthetic()
+    text = ''.join('%.5f,%r\n' % row for row in zip(timesteps.tolist(),
+                                                    data.tolist()))
+    result = subprocess.run((sys.executable, _path('stream_trace.py'), '-'),
+                            input=text.encode('ascii'), stdout=subprocess.PIPE,
+                            check=True)
+    self.assertTrue(result.stdout.endswith(b'Converged\n'))
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,147 @@
+'''A binary format for traces, which can be memory mapped instead of parsed.
+
+A .trace file has a HEADER_SIZE byte header, followed by the samples as
+little-endian float32. The header has MAGIC, the format version, the header
+size, the time of the first sample, the time between samples, the number of
+samples, and the number of channels. Each sample has a value for every
+channel, stored together. The samples must be evenly spaced, which they are for
+all the scopes we use.'''
+
+import struct
+
+import numpy
+
+EXTENSION = '.trace'
+MAGIC = b'MOTRACE\0'
+VERSION = 1
+HEADER_SIZE = 64
+_HEADER = struct.Struct('<8sIIddQI')
+SAMPLE_DTYPE = numpy.dtype('<f4')
+
+# How far apart samples can be from evenly spaced, as a fraction of the time
+# between them.
+_TIMESTEP_TOLERANCE = 0.01
+
+class UniformTimesteps(object):
+  '''Evenly spaced times, which act like a read-only array but are only
+  calculated when indexed.'''
+  def __init__(self, start, dt, count):
+    self._start = start
+    self._dt = dt
+    self._count = count
+
+  @property
+  def start(self):
+    return self._start
+
+  @property
+  def dt(self):
+    return self._dt
+
+  def __len__(self):
+    return self._count
+
+  def __getitem__(self, index):
+    if isinstance(index, slice):
+      indices = range(self._count)[index]
+      indices = numpy.arange(indices.start, indices.stop, indices.step)
+    else:
+      indices = numpy.asarray(index)
+      if ((indices < -self._count) | (indices >= self._count)).any():
+        raise IndexError('index out of range for %d timesteps' %
+                         (self._count,))
+      indices = numpy.where(indices < 0, indices + self._count, indices)
+    return self._start + indices * self._dt
+
+  def __array__(self, dtype=None):
+    return numpy.asarray(self[:], dtype=dtype)
+
+  def __repr__(self):
+    return 'UniformTimesteps(%r, %r, %r)' % (self._start, self._dt,
+                                             self._count)
+
+def open_trace(filename):
+  '''Opens a .trace file.
+
+  Returns (timesteps, data), where timesteps is a UniformTimesteps and data is
+  a read-only numpy.memmap. data is 1-D if there's a single channel, or has a
+  column for each channel otherwise.'''
+  with open(filename, 'rb') as f:
+    header = f.read(_HEADER.size)
+  if len(header) != _HEADER.size:
+    raise ValueError('%s is too short to be a trace' % (filename,))
+  magic, version, header_size, start, dt, count, channels = _HEADER.unpack(
+      header)
+  if magic != MAGIC:
+    raise ValueError('%s is not a trace' % (filename,))
+  if version != VERSION:
+    raise ValueError('%s has unsupported version %d' % (filename, version))
+  shape = (count,) if channels == 1 else (count, channels)
+  data = numpy.memmap(filename, dtype=SAMPLE_DTYPE, mode='r',
+                      offset=header_size, shape=shape)
+  return UniformTimesteps(start, dt, count), data
+
+class TraceWriter(object):
+  '''Writes a .trace file a chunk at a time.
+
+  The header is filled in by close, once the time between samples is known.
+  Use it as a context manager to close it automatically.'''
+  def __init__(self, filename):
+    self._file = open(filename, 'wb')
+    self._file.write(b'\0' * HEADER_SIZE)
+    self._count = 0
+    self._start = None
+    self._step = None
+    self._last = None
+    self._channels = None
+
+  def write(self, times, samples):
+    '''Appends samples, which were taken at times.
+
+    samples is either 1-D, or has a column for each channel.'''
+    times = numpy.asarray(times, dtype=float)
+    if not len(times):
+      return
+    if self._start is None:
+      self._start = times[0]
+    else:
+      times = numpy.append(self._last, times)
+    steps = numpy.diff(times)
+    if len(steps):
+      if self._step is None:
+        self._step = steps[0]
+      if (abs(steps - self._step) >
+          abs(self._step) * _TIMESTEP_TOLERANCE).any():
+        raise ValueError('Samples are not evenly spaced')
+    self._last = times[-1]
+    samples = numpy.asarray(samples, dtype=SAMPLE_DTYPE)
+    channels = 1 if samples.ndim == 1 else samples.shape[1]
+    if self._channels is None:
+      self._channels = channels
+    elif channels != self._channels:
+      raise ValueError('Expected %d channels, got %d' % (self._channels,
+                                                         channels))
+    self._file.write(samples.tobytes())
+    self._count += len(samples)
+
+  def close(self):
+    if self._file.closed:
+      return
+    try:
+      if self._count < 2:
+        raise ValueError('Need at least 2 samples for a trace')
+      dt = (self._last - self._start) / (self._count - 1)
+      self._file.seek(0)
+      self._file.write(_HEADER.pack(MAGIC, VERSION, HEADER_SIZE, self._start,
+                                    dt, self._count, self._channels))
+    finally:
+      self._file.close()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    if exc_type is None:
+      self.close()
+    else:
+      self._file.close()
@@ -0,0 +1,65 @@
+#!/usr/bin/python3
+
+import os
+import tempfile
+import unittest
+
+import numpy
+
+import trace_format
+
+class TraceFormatTest(unittest.TestCase):
+  def setUp(self):
+    directory = tempfile.TemporaryDirectory()
+    self.addCleanup(directory.cleanup)
+    self.filename = os.path.join(directory.name, 'test' +
+                                 trace_format.EXTENSION)
+
+  def test_round_trip(self):
+    times = 0.25 + numpy.arange(1000) * 1e-5
+    samples = numpy.sin(numpy.arange(1000) * 0.1)
+    with trace_format.TraceWriter(self.filename) as writer:
+      writer.write(times[:1], samples[:1])
+      writer.write(times[1:400], samples[1:400])
+      writer.write(times[400:], samples[400:])
+    timesteps, data = trace_format.open_trace(self.filename)
+    self.assertIsInstance(data, numpy.memmap)
+    self.assertEqual(len(timesteps), 1000)
+    self.assertEqual(len(data), 1000)
+    numpy.testing.assert_allclose(numpy.asarray(timesteps), times, rtol=1e-12)
+    numpy.testing.assert_array_equal(data, samples.astype(numpy.float32))
+
+  def test_channels(self):
+    samples = numpy.arange(30).reshape(10, 3)
+    with trace_format.TraceWriter(self.filename) as writer:
+      writer.write(numpy.arange(4), samples[:4])
+      writer.write(numpy.arange(4, 10), samples[4:])
+    _, data = trace_format.open_trace(self.filename)
+    numpy.testing.assert_array_equal(data, samples)
+    with self.assertRaises(ValueError):
+      with trace_format.TraceWriter(self.filename) as writer:
+        writer.write(numpy.arange(4), samples[:4])
+        writer.write(numpy.arange(4, 10), samples[4:, 0])
+
+  def test_timesteps(self):
+    timesteps = trace_format.UniformTimesteps(1.0, 0.5, 10)
+    self.assertEqual(timesteps[0], 1.0)
+    self.assertEqual(timesteps[-1], 5.5)
+    numpy.testing.assert_array_equal(timesteps[2:5], [2.0, 2.5, 3.0])
+    numpy.testing.assert_array_equal(timesteps[numpy.array([1, 9])], [1.5, 5.5])
+    with self.assertRaises(IndexError):
+      timesteps[10]
+
+  def test_uneven(self):
+    with self.assertRaises(ValueError):
+      with trace_format.TraceWriter(self.filename) as writer:
+        writer.write([0, 1, 2, 4], [0, 0, 0, 0])
+
+  def test_not_trace(self):
+    with open(self.filename, 'w') as f:
+      f.write('0.0,1.0\n' * 100)
+    with self.assertRaises(ValueError):
+      trace_format.open_trace(self.filename)
+
+if __name__ == '__main__':
+  unittest.main()
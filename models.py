@@ -4,14 +4,15 @@ These models are all simple linear/sinusoidal functions at runtime. There is
 some moderately more complex math at initialization time, but everything in this
 module is simple at runtime.'''
 
+import abc
+import numbers
 import numpy
-import scipy.optimize
 import types
 
 _frozendict = types.MappingProxyType
 
 def _vectorize_float(f):
-  return numpy.vectorize(f, otypes=(numpy.float,))
+  return numpy.vectorize(f, otypes=(float,))
 
 def _offset_coeff(coeff):
   coeff = dict(coeff)
@@ -37,9 +38,23 @@ class CosSum(object):
                self.line_line_coeff[a][1])
            for a in self.line_line_coeff})
 
+    self._make_functions()
+
+  def _make_functions(self):
     self._phase = CosSum.make_function(self._phase_coeff)
     self._line_line = CosSum.make_function(self._line_line_coeff)
 
+  def __getstate__(self):
+    # Both sets of coefficients are saved, because converting between them
+    # doesn't round trip exactly.
+    return {'phase': dict(self._phase_coeff),
+            'line_line': dict(self._line_line_coeff)}
+
+  def __setstate__(self, state):
+    self._phase_coeff = _frozendict(state['phase'])
+    self._line_line_coeff = _frozendict(state['line_line'])
+    self._make_functions()
+
   @property
   def phase(self):
     return self._phase
@@ -58,16 +73,102 @@ class CosSum(object):
 
   @staticmethod
   def make_function(coeff):
-    terms = tuple(CosSum._do_cos(a, *coeff[a]) for a in coeff)
-    def r(theta):
-      return numpy.sum(term(theta) for term in terms)
-    return r
+    return CosSumFunction(coeff)
 
   @staticmethod
-  def _do_cos(a, b, c):
-    def r(theta):
-      return b * numpy.cos(a * theta + c)
-    return r
+  def evaluate_many(functions, theta):
+    '''Evaluates several CosSumFunctions at the same thetas at once.
+
+    This is equivalent to numpy.array([f(theta) for f in functions]), but
+    does all the work in one set of array operations.
+
+    Returns an array with one row for each function, followed by the shape of
+    theta.'''
+    theta = numpy.asarray(theta, dtype=float)
+    width = max([len(f.a) for f in functions] + [1])
+    a, b, c = numpy.zeros((3, len(functions), width))
+    for i, f in enumerate(functions):
+      a[i, :len(f.a)] = f.a
+      b[i, :len(f.b)] = f.b
+      c[i, :len(f.c)] = f.c
+    flat_theta = theta.reshape(-1)
+    angles = (flat_theta[numpy.newaxis, :, numpy.newaxis] *
+              a[:, numpy.newaxis, :] + c[:, numpy.newaxis, :])
+    r = numpy.einsum('mnk,mk->mn', numpy.cos(angles), b)
+    return r.reshape((len(functions),) + theta.shape)
+
+class CosSumFunction(object):
+  r'''The function $\sum b * cos(a * \theta + c)$ for a mapping from a to
+  (b, c).
+
+  The harmonics are stored as contiguous arrays, and evaluated for all of them
+  at once. theta may be a scalar or an array of any shape, and the result has
+  the same shape as theta.'''
+  def __init__(self, coeff):
+    self._coeff = _frozendict(dict(coeff))
+    a = sorted(self._coeff)
+    self._a = numpy.array(a, dtype=float)
+    self._b = numpy.array([self._coeff[i][0] for i in a], dtype=float)
+    self._c = numpy.array([self._coeff[i][1] for i in a], dtype=float)
+    for array in (self._a, self._b, self._c):
+      array.setflags(write=False)
+
+  def __call__(self, theta):
+    theta = numpy.asarray(theta, dtype=float)
+    return numpy.cos(numpy.multiply.outer(theta, self._a) + self._c) @ self._b
+
+  def __reduce__(self):
+    return (CosSumFunction, (dict(self._coeff),))
+
+  def derivative(self):
+    '''Returns the exact derivative, which is another CosSumFunction.'''
+    # d/dtheta b * cos(a * theta + c) = a * b * cos(a * theta + c + pi / 2)
+    return CosSumFunction({a: (a * b, c + numpy.pi / 2)
+                           for a, (b, c) in self._coeff.items() if a != 0})
+
+  @property
+  def coeff(self):
+    return self._coeff
+
+  @property
+  def a(self):
+    return self._a
+
+  @property
+  def b(self):
+    return self._b
+
+  @property
+  def c(self):
+    return self._c
+
+  def __repr__(self):
+    return 'CosSumFunction(%r)' % dict(self.coeff)
+
+# The default RMS error for Waveform.harmonic_series.
+harmonic_tolerance = 1e-2
+# The most harmonics Waveform.harmonic_series will look at.
+max_harmonic = 1 << 16
+
+def _truncate_series(amplitudes, mean_square, tolerance):
+  '''Picks the fewest harmonics from amplitudes (complex, indexed by harmonic)
+  which leave an RMS error of at most tolerance, for a function whose mean
+  square is mean_square.
+
+  Returns (coeff, error) like Waveform.harmonic_series.'''
+  # The mean square of each harmonic, by Parseval's theorem.
+  power = abs(amplitudes) ** 2 / 2
+  power[0] = abs(amplitudes[0]) ** 2
+  order = numpy.argsort(-power, kind='stable')
+  errors = mean_square - numpy.concatenate(([0], numpy.cumsum(power[order])))
+  enough = numpy.flatnonzero(errors <= tolerance ** 2)
+  if not len(enough):
+    raise ValueError('Need more than %d harmonics for an RMS error of %g' %
+                     (len(amplitudes) - 1, tolerance))
+  used = numpy.sort(order[:enough[0]])
+  coeff = {int(a): (float(abs(amplitudes[a])), float(numpy.angle(amplitudes[a])))
+           for a in used}
+  return _frozendict(coeff), float(numpy.sqrt(max(errors[enough[0]], 0)))
 
 _RPM_TO_RAD_S = numpy.pi * 2 / 60
 """RPM / (rad/s)"""
@@ -205,9 +306,96 @@ def _cos_harmonic(cos_scalar, harmonic_scalar, harmonic_index, harmonic_offset):
   return r
 
 class Waveform(object):
-  def __init__(self, scalar_f):
+  r'''A periodic function of theta, with its extrema.
+
+  min and max are the extreme values over a whole revolution. The basic
+  waveforms we use are all odd-symmetric, so max is -min unless it's given.
+
+  Finding min numerically is moderately expensive, so it is only done the first
+  time it is needed. Callers which already know it can pass it in instead.
+
+  Waveforms can be scaled, offset, added, multiplied (by numbers or each
+  other), and phase shifted with shift. The results are Waveforms too, with
+  extrema, harmonics, breakpoints and series worked out from the operands
+  instead of from scratch.
+
+  harmonics is the same kind of mapping as CosSum coefficients, for waveforms
+  which are exactly a finite sum of cosines. It is filled in automatically when
+  scalar_f is a CosSumFunction.
+
+  breakpoints is the angles where a piecewise waveform (or its derivatives) is
+  discontinuous, which lets numeric integration split it into smooth pieces.
+  It is None if they aren't known.
+
+  vectorized_f is the same function as scalar_f, but takes an array of thetas
+  and does all of them with array operations. Without it, scalar_f gets called
+  once per theta through numpy.vectorize, which is a lot slower. CosSumFunctions
+  and ufuncs (like numpy.sin) already take arrays, so they are used directly.
+
+  series is the Fourier series of a waveform which needs infinitely many
+  harmonics. It takes an array of harmonic numbers (starting from 0) and
+  returns a complex amplitude $A_a$ for each one, such that the waveform is
+  $\sum Re(A_a e^{i a \theta})$. mean_square is the waveform's mean square
+  over a whole revolution, which must be given along with series to know how
+  much a truncated series leaves out.'''
+  # Make numpy defer to our reflected operators, so numpy scalars work on
+  # either side.
+  __array_ufunc__ = None
+
+  def __init__(self, scalar_f, min=None, harmonics=None, breakpoints=None,
+               vectorized_f=None, series=None, mean_square=None, max=None):
     self.__doc__ = scalar_f.__doc__
-    self._f = _vectorize_float(scalar_f)
+    self._scalar_f = scalar_f
+    if vectorized_f is None and isinstance(scalar_f, (CosSumFunction,
+                                                      numpy.ufunc)):
+      vectorized_f = scalar_f
+    self._vectorized_f = vectorized_f
+    if vectorized_f is not None:
+      self._f = vectorized_f
+    else:
+      self._f = _vectorize_float(scalar_f)
+    self._min = min
+    self._max = max
+    if harmonics is None and isinstance(scalar_f, CosSumFunction):
+      harmonics = scalar_f.coeff
+    if harmonics is not None:
+      harmonics = _frozendict(dict(harmonics))
+    self._harmonics = harmonics
+    if harmonics is not None and breakpoints is None:
+      breakpoints = ()
+    if breakpoints is not None:
+      breakpoints = tuple(breakpoints)
+    self._breakpoints = breakpoints
+    if series is not None and mean_square is None:
+      raise ValueError('Must specify mean_square with series')
+    self._series = series
+    self._mean_square = mean_square
+    self._derivative = None
+
+  def __call__(self, *args):
+    return self._f(*args)
+
+  def __getstate__(self):
+    # numpy.vectorize objects can't be pickled, so it gets recreated instead.
+    return {'scalar_f': self._scalar_f, 'min': self._min, 'max': self._max,
+            'harmonics': (None if self._harmonics is None
+                          else dict(self._harmonics)),
+            'breakpoints': self._breakpoints,
+            'vectorized_f': self._vectorized_f,
+            'series': self._series, 'mean_square': self._mean_square}
+
+  def __setstate__(self, state):
+    self.__init__(state['scalar_f'], min=state['min'],
+                  harmonics=state['harmonics'],
+                  breakpoints=state['breakpoints'],
+                  vectorized_f=state.get('vectorized_f'),
+                  series=state.get('series'),
+                  mean_square=state.get('mean_square'),
+                  max=state.get('max'))
+
+  def _find_min(self):
+    import scipy.optimize
+
     one_sixth_min = min(self._f(numpy.linspace(0, numpy.pi * 2, 12)))
     continuous_min = scipy.optimize.minimize(self._f,
                                              x0=(numpy.pi * 3 / 2),
@@ -216,21 +404,563 @@ class Waveform(object):
     global_min = scipy.optimize.differential_evolution(
         self._f, bounds=((numpy.pi, numpy.pi * 2),), polish=True)
     assert global_min.success
-    self._min = numpy.array([one_sixth_min,
-                             float(self._f(continuous_min.x[0])),
-                             float(self._f(global_min.x[0])),
-                             ]).min()
-
-  def __call__(self, *args):
-    return self._f(*args)
+    return numpy.array([one_sixth_min,
+                        float(self._f(continuous_min.x[0])),
+                        float(self._f(global_min.x[0])),
+                        ]).min()
 
   @property
   def min(self):
+    if self._min is None:
+      if isinstance(self._scalar_f, _Derived):
+        self._min, self._max = self._scalar_f.extrema()
+      else:
+        self._min = self._find_min()
     return self._min
 
   @property
   def max(self):
-    return -self._min
+    if self._max is None:
+      if isinstance(self._scalar_f, _Derived):
+        self._min, self._max = self._scalar_f.extrema()
+      else:
+        return -self.min
+    return self._max
+
+  @property
+  def harmonics(self):
+    return self._harmonics
+
+  @property
+  def breakpoints(self):
+    return self._breakpoints
+
+  @property
+  def definition(self):
+    '''(name, parameters, operands) which define this exactly, for waveforms
+    made by arithmetic, differentiation or make_tabulated. None for anything
+    else.
+
+    parameters is a dict of numbers, strings and arrays, and operands is a
+    tuple of Waveforms.'''
+    if isinstance(self._scalar_f, _Derived):
+      return self._scalar_f.definition()
+    return None
+
+  def _series_amplitudes(self, a):
+    '''Returns amplitudes like series for the harmonics a, from either series
+    or harmonics. Returns None if there's neither, or harmonics has some which
+    aren't integers.'''
+    if self._series is not None:
+      return numpy.asarray(self._series(a), dtype=complex)
+    if self._harmonics is None or not all(
+        float(harmonic).is_integer() for harmonic in self._harmonics):
+      return None
+    a = numpy.asarray(a)
+    r = numpy.zeros(a.shape, dtype=complex)
+    for harmonic, x in two_sided(self._harmonics).items():
+      if harmonic >= 0:
+        r[a == harmonic] += x if harmonic == 0 else x * 2
+    return r
+
+  def _sampled_series(self, samples):
+    '''Returns (amplitudes, mean_square) like series and mean_square, from the
+    FFT of samples evenly spaced points.'''
+    step = numpy.pi * 2 / samples
+    # Sample halfway between the usual points, so breakpoints at simple
+    # fractions of a revolution don't land right on a sample.
+    values = self._f((numpy.arange(samples) + 0.5) * step)
+    harmonics = numpy.arange(samples // 2)
+    amplitudes = numpy.fft.rfft(values)[:len(harmonics)] * (
+        2 / samples) * numpy.exp(-0.5j * step * harmonics)
+    amplitudes[0] /= 2
+    return amplitudes, float(numpy.mean(values ** 2))
+
+  def harmonic_series(self, tolerance=harmonic_tolerance, samples=1 << 16):
+    '''Finds the fewest harmonics which describe this waveform to within an RMS
+    error of tolerance.
+
+    Waveforms with harmonics are already exact. Ones with a series are
+    truncated from that. Anything else is sampled at samples points and
+    truncated from the FFT, which means the error is only measured at those
+    points, and harmonics above samples / 2 are aliased onto lower ones.
+
+    Discontinuous waveforms converge slowly, with an RMS error of about
+    0.6 / sqrt(number of harmonics) for square, so small tolerances need a lot
+    of harmonics.
+
+    Returns
+    -------
+    (coeff, error)
+        coeff is a mapping of the same kind as harmonics, and error is the RMS
+        error of leaving out the other harmonics.
+
+    Raises
+    ------
+    ValueError
+        If more than max_harmonic (or samples / 2) harmonics would be needed.
+    '''
+    if self._harmonics is not None:
+      return self._harmonics, 0.0
+    if self._series is not None:
+      amplitudes = numpy.asarray(self._series(numpy.arange(max_harmonic + 1)),
+                                 dtype=complex)
+      return _truncate_series(amplitudes, self._mean_square, tolerance)
+    return _truncate_series(*self._sampled_series(samples), tolerance)
+
+  def truncated(self, tolerance=harmonic_tolerance, **kwargs):
+    '''Returns a Waveform which is this one truncated to harmonic_series, so it
+    has exact harmonics.
+
+    kwargs are passed to harmonic_series.'''
+    coeff, _ = self.harmonic_series(tolerance, **kwargs)
+    return Waveform(CosSum.make_function(coeff))
+
+  def derivative(self):
+    '''Returns the first derivative, as another Waveform.
+
+    It is exact for waveforms with harmonics. Tabulated waveforms are
+    differentiated spectrally, and then interpolated the same way. Derivatives
+    of arithmetic on waveforms are made from the derivatives of the operands.
+    Anything else with breakpoints uses simulation.piecewise_difference, which
+    is exact for the piecewise-linear built-ins, and the rest use
+    simulation.central_difference.'''
+    if self._derivative is None:
+      if self._harmonics is not None:
+        self._derivative = Waveform(
+            CosSum.make_function(self._harmonics).derivative())
+      elif isinstance(self._scalar_f, _Derived):
+        self._derivative = self._scalar_f.derivative()
+      else:
+        self._derivative = _Difference.make(self)
+    return self._derivative
+
+  def shift(self, offset):
+    '''Returns theta -> self(theta + offset).'''
+    return _Affine.make(self, shift=offset)
+
+  def __mul__(self, other):
+    if isinstance(other, Waveform):
+      return _Product.make(self, other)
+    if isinstance(other, numbers.Real):
+      return _Affine.make(self, scale=other)
+    return NotImplemented
+
+  __rmul__ = __mul__
+
+  def __truediv__(self, other):
+    if isinstance(other, numbers.Real):
+      return _Affine.make(self, scale=1 / other)
+    return NotImplemented
+
+  def __neg__(self):
+    return _Affine.make(self, scale=-1)
+
+  def __add__(self, other):
+    if isinstance(other, Waveform):
+      return _Sum.make(self, other)
+    if isinstance(other, numbers.Real):
+      return _Affine.make(self, offset=other)
+    return NotImplemented
+
+  __radd__ = __add__
+
+  def __sub__(self, other):
+    if isinstance(other, (Waveform, numbers.Real)):
+      return self + -other
+    return NotImplemented
+
+  def __rsub__(self, other):
+    if isinstance(other, numbers.Real):
+      return -self + other
+    return NotImplemented
+
+def two_sided(coeff):
+  r'''Returns the complex Fourier coefficients $X_k$ of a mapping like CosSum
+  coefficients, as a dict from harmonic (including negative ones) to
+  coefficient, such that $\sum b * cos(a * \theta + c) = \sum_k X_k e^{i k
+  \theta}$.'''
+  r = {}
+  for a, (b, c) in coeff.items():
+    if a == 0:
+      r[0] = r.get(0, 0) + b * numpy.cos(c)
+    else:
+      r[a] = r.get(a, 0) + b / 2 * numpy.exp(1j * c)
+      r[-a] = r.get(-a, 0) + b / 2 * numpy.exp(-1j * c)
+  return r
+
+def one_sided(coefficients):
+  '''The inverse of two_sided, leaving out any harmonics which are 0.'''
+  coeff = {}
+  for a, x in sorted(coefficients.items()):
+    if a == 0 and x.real != 0:
+      coeff[0] = (float(abs(x.real)), 0.0 if x.real > 0 else float(numpy.pi))
+    elif a > 0 and x != 0:
+      coeff[a] = (float(abs(x) * 2), float(numpy.angle(x)))
+  return coeff
+
+def _merge_breakpoints(*all_breakpoints):
+  if any(breakpoints is None for breakpoints in all_breakpoints):
+    return None
+  return tuple(sorted(set(float(point) for breakpoints in all_breakpoints
+                          for point in breakpoints)))
+
+# How many points _sampled_extrema looks at before refining the best ones.
+_EXTREMA_SAMPLES = 2048
+
+def _sampled_extrema(f, breakpoints):
+  '''Returns (min, max) of f over a revolution, by sampling it.
+
+  Jumps at breakpoints might only approach an extreme value from one side, so
+  simulation.max_circle checks both sides of each breakpoint too.'''
+  import simulation
+
+  breakpoints = breakpoints or ()
+  maximum = simulation.max_circle(f, samples=_EXTREMA_SAMPLES,
+                                  breakpoints=breakpoints)
+  minimum = -simulation.max_circle(lambda theta: -f(theta),
+                                   samples=_EXTREMA_SAMPLES,
+                                   breakpoints=breakpoints)
+  return float(minimum), float(maximum)
+
+class _Derived(abc.ABC):
+  '''A function for a Waveform which knows how to find its own extrema, for
+  example from the Waveforms it was made from.'''
+
+  @abc.abstractmethod
+  def extrema(self):
+    '''Returns (min, max).'''
+
+  @abc.abstractmethod
+  def derivative(self):
+    '''Returns the Waveform of the first derivative.'''
+
+  @abc.abstractmethod
+  def definition(self):
+    '''Returns (name, parameters, operands), like Waveform.definition.'''
+
+class _Difference(_Derived):
+  '''The finite difference approximation to the derivative of f, which stays
+  within the pieces between f's breakpoints when they're known.'''
+  def __init__(self, f):
+    self._operand = f
+    self.__doc__ = 'd/dtheta (%s)' % (f.__doc__ or repr(f)).split('\n')[0]
+
+  @staticmethod
+  def make(f):
+    combination = _Difference(f)
+    return Waveform(combination, vectorized_f=combination,
+                    breakpoints=f.breakpoints)
+
+  def __call__(self, theta):
+    import simulation
+
+    breakpoints = self._operand.breakpoints
+    if breakpoints is None:
+      return simulation.central_difference(self._operand, theta)
+    return simulation.piecewise_difference(self._operand, breakpoints, theta)
+
+  def extrema(self):
+    return _sampled_extrema(self, self._operand.breakpoints)
+
+  def derivative(self):
+    return _Difference.make(Waveform(self, vectorized_f=self,
+                                     breakpoints=self._operand.breakpoints))
+
+  def definition(self):
+    return 'difference', {}, (self._operand,)
+
+class _Affine(_Derived):
+  '''theta -> f(theta + shift) * scale + offset.'''
+  def __init__(self, f, scale=1, offset=0, shift=0):
+    self._operand = f
+    self._scale = scale
+    self._offset = offset
+    self._shift = shift
+    self.__doc__ = '(%s)(theta + %r) * %r + %r' % (
+        (f.__doc__ or repr(f)).split('\n')[0], shift, scale, offset)
+
+  @staticmethod
+  def make(f, scale=1, offset=0, shift=0):
+    '''Returns the Waveform of the transformation of the Waveform f.'''
+    if isinstance(f._scalar_f, _Affine):
+      # Combine them, instead of adding another layer of calls.
+      inner = f._scalar_f
+      f, scale, offset, shift = (inner._operand, inner._scale * scale,
+                                 inner._offset * scale + offset,
+                                 inner._shift + shift)
+    combination = _Affine(f, scale, offset, shift)
+    harmonics = None
+    if f.harmonics is not None:
+      coefficients = {a: x * scale * numpy.exp(1j * a * shift)
+                      for a, x in two_sided(f.harmonics).items()}
+      coefficients[0] = coefficients.get(0, 0) + offset
+      harmonics = one_sided(coefficients)
+    breakpoints = None
+    if f.breakpoints is not None:
+      breakpoints = tuple(point - shift for point in f.breakpoints)
+    series = mean_square = None
+    if f._series is not None:
+      series = combination.series
+      mean = f._series_amplitudes(0).real
+      mean_square = (f._mean_square * scale ** 2 + mean * scale * offset * 2 +
+                     offset ** 2)
+    return Waveform(combination, vectorized_f=combination, harmonics=harmonics,
+                    breakpoints=breakpoints, series=series,
+                    mean_square=mean_square)
+
+  def __call__(self, theta):
+    return (self._operand(numpy.asarray(theta, dtype=float) + self._shift) *
+            self._scale + self._offset)
+
+  def series(self, a):
+    a = numpy.asarray(a)
+    r = self._operand._series_amplitudes(a) * self._scale * numpy.exp(
+        1j * a * self._shift)
+    return r + numpy.where(a == 0, self._offset, 0)
+
+  def derivative(self):
+    return _Affine.make(self._operand.derivative(), scale=self._scale,
+                        shift=self._shift)
+
+  def definition(self):
+    return ('affine',
+            {'scale': self._scale, 'offset': self._offset, 'shift': self._shift},
+            (self._operand,))
+
+  def extrema(self):
+    low = self._operand.min * self._scale
+    high = self._operand.max * self._scale
+    if self._scale < 0:
+      low, high = high, low
+    return low + self._offset, high + self._offset
+
+class _Sum(_Derived):
+  '''theta -> f(theta) + g(theta).'''
+  def __init__(self, f, g):
+    self._operands = (f, g)
+    self.__doc__ = '(%s) + (%s)' % tuple((operand.__doc__ or repr(operand)
+                                         ).split('\n')[0]
+                                        for operand in self._operands)
+
+  @staticmethod
+  def make(f, g):
+    combination = _Sum(f, g)
+    harmonics = None
+    if f.harmonics is not None and g.harmonics is not None:
+      coefficients = two_sided(f.harmonics)
+      for a, x in two_sided(g.harmonics).items():
+        coefficients[a] = coefficients.get(a, 0) + x
+      harmonics = one_sided(coefficients)
+    breakpoints = _merge_breakpoints(f.breakpoints, g.breakpoints)
+    series = mean_square = None
+    if (harmonics is None and breakpoints is not None and
+        f._series_amplitudes(0) is not None and
+        g._series_amplitudes(0) is not None):
+      import simulation
+
+      series = combination.series
+      # The cross terms between two infinite series don't have a closed form,
+      # but splitting at the breakpoints makes numeric integration exact for
+      # piecewise polynomials.
+      mean_square = simulation.PeriodicIntegrator().average(
+          lambda theta: combination(theta) ** 2, breakpoints)
+    return Waveform(combination, vectorized_f=combination, harmonics=harmonics,
+                    breakpoints=breakpoints, series=series,
+                    mean_square=mean_square)
+
+  def __call__(self, theta):
+    f, g = self._operands
+    return f(theta) + g(theta)
+
+  def series(self, a):
+    f, g = self._operands
+    return f._series_amplitudes(a) + g._series_amplitudes(a)
+
+  def extrema(self):
+    f, g = self._operands
+    return _sampled_extrema(self, _merge_breakpoints(f.breakpoints,
+                                                     g.breakpoints))
+
+  def derivative(self):
+    f, g = self._operands
+    return f.derivative() + g.derivative()
+
+  def definition(self):
+    return 'sum', {}, self._operands
+
+class _Product(_Derived):
+  '''theta -> f(theta) * g(theta).'''
+  def __init__(self, f, g):
+    self._operands = (f, g)
+    self.__doc__ = '(%s) * (%s)' % tuple((operand.__doc__ or repr(operand)
+                                         ).split('\n')[0]
+                                        for operand in self._operands)
+
+  @staticmethod
+  def make(f, g):
+    combination = _Product(f, g)
+    harmonics = None
+    if f.harmonics is not None and g.harmonics is not None:
+      coefficients = {}
+      for a, x in two_sided(f.harmonics).items():
+        for b, y in two_sided(g.harmonics).items():
+          coefficients[a + b] = coefficients.get(a + b, 0) + x * y
+      harmonics = one_sided(coefficients)
+    return Waveform(combination, vectorized_f=combination, harmonics=harmonics,
+                    breakpoints=_merge_breakpoints(f.breakpoints,
+                                                   g.breakpoints))
+
+  def __call__(self, theta):
+    f, g = self._operands
+    return f(theta) * g(theta)
+
+  def extrema(self):
+    f, g = self._operands
+    return _sampled_extrema(self, _merge_breakpoints(f.breakpoints,
+                                                     g.breakpoints))
+
+  def derivative(self):
+    f, g = self._operands
+    return f.derivative() * g + f * g.derivative()
+
+  def definition(self):
+    return 'product', {}, self._operands
+
+class _Tabulated(_Derived):
+  '''Periodic interpolation between evenly spaced samples.'''
+  def __init__(self, samples, kind, start):
+    self._samples = numpy.array(samples, dtype=float)
+    self._samples.setflags(write=False)
+    self._kind = kind
+    self._start = start
+    n = len(self._samples)
+    self._step = numpy.pi * 2 / n
+    self._sample_fft = numpy.fft.fft(self._samples)
+    self._fft = self._sample_fft
+    if kind == 'linear':
+      self._values = self._samples
+      self._order = 2
+    else:
+      # Cubic B-spline coefficients c, such that each sample is
+      # (c[j - 1] + c[j] * 4 + c[j + 1]) / 6. That's a circular convolution,
+      # so it's a division in the frequency domain.
+      self._fft = self._fft * 3 / (2 + numpy.cos(numpy.arange(n) * self._step))
+      self._values = numpy.fft.ifft(self._fft).real
+      self._order = 4
+    self.__doc__ = 'Periodic %s interpolation of %d samples' % (kind, n)
+
+  def __reduce__(self):
+    return (_Tabulated, (self._samples, self._kind, self._start))
+
+  @property
+  def samples(self):
+    return self._samples
+
+  def __call__(self, theta):
+    x = (numpy.asarray(theta, dtype=float) - self._start) / self._step
+    index = numpy.floor(x)
+    t = x - index
+    index = index.astype(int) % len(self._values)
+    values = self._values
+    if self._kind == 'linear':
+      return (values[index] * (1 - t) +
+              values[(index + 1) % len(values)] * t)
+    t2 = t * t
+    t3 = t2 * t
+    return (values[(index - 1) % len(values)] * ((1 - t) ** 3) +
+            values[index] * (t3 * 3 - t2 * 6 + 4) +
+            values[(index + 1) % len(values)] * (t3 * -3 + t2 * 3 + t * 3 + 1) +
+            values[(index + 2) % len(values)] * t3) / 6
+
+  def series(self, a):
+    # Each sample (or B-spline coefficient) contributes a scaled copy of the
+    # interpolation kernel, whose Fourier transform is a power of sinc.
+    a = numpy.asarray(a)
+    n = len(self._values)
+    r = (self._fft[a % n] / n * numpy.sinc(a / n) ** self._order *
+         numpy.exp(-1j * a * self._start))
+    return numpy.where(a == 0, r, r * 2)
+
+  def mean_square(self):
+    values = self._values
+    following = numpy.roll(values, -1)
+    if self._kind == 'linear':
+      return float(numpy.mean(values ** 2 + values * following +
+                              following ** 2) / 3)
+    # Each piece is a cubic, so its square is exactly integrated by 4 point
+    # Gauss-Legendre quadrature.
+    nodes, weights = numpy.polynomial.legendre.leggauss(4)
+    thetas = numpy.add.outer(numpy.arange(len(values)), (nodes + 1) / 2) * (
+        self._step) + self._start
+    return float(numpy.mean(self(thetas) ** 2 @ weights) / 2)
+
+  def derivative(self):
+    # Differentiate the trigonometric interpolation of the samples, which is
+    # exact if they're a sum of harmonics below half the sample rate.
+    n = len(self._samples)
+    harmonics = numpy.fft.fftfreq(n, 1 / n)
+    if n % 2 == 0:
+      # The Nyquist harmonic's derivative is ambiguous.
+      harmonics[n // 2] = 0
+    return make_tabulated(numpy.fft.ifft(self._sample_fft * harmonics * 1j).real,
+                          self._kind, start=self._start)
+
+  def extrema(self):
+    if self._kind == 'linear':
+      return float(numpy.amin(self._samples)), float(numpy.amax(self._samples))
+    return _sampled_extrema(self, None)
+
+  def definition(self):
+    return ('tabulated',
+            {'samples': self._samples, 'kind': self._kind, 'start': self._start},
+            ())
+
+def make_tabulated(samples, kind='cubic', start=0):
+  '''Returns a Waveform which interpolates between samples.
+
+  Arguments
+  ---------
+  samples : array_like
+      Values over exactly one revolution (one cycle of a trace, for example),
+      evenly spaced, with the first one at theta = start.
+  kind : str
+      'linear' or 'cubic' (a periodic cubic spline).
+  start : float
+      The angle of the first sample.
+
+  Returns
+  -------
+  Waveform
+      Its series is the exact Fourier series of the interpolation, which is
+      from the FFT of samples, so harmonic_series works to any tolerance. Its
+      breakpoints are the samples, where the pieces of the interpolation
+      meet.
+  '''
+  if kind not in ('linear', 'cubic'):
+    raise ValueError('Unknown kind of interpolation %r' % (kind,))
+  samples = numpy.asarray(samples, dtype=float)
+  if samples.ndim != 1 or len(samples) < 3:
+    raise ValueError('Need a 1-D array of at least 3 samples')
+  f = _Tabulated(samples, kind, start)
+  return Waveform(f, vectorized_f=f, series=f.series,
+                  mean_square=f.mean_square(),
+                  breakpoints=start + numpy.arange(len(samples)) * (
+                      numpy.pi * 2 / len(samples)))
+
+_SIXTHS = numpy.arange(6) * (numpy.pi / 3)
+"""Multiples of pi/3, which are breakpoints of the piecewise waveforms."""
+
+def _odd_sin_series(a, b):
+  r'''Returns series amplitudes for $\sum_{odd a} b_a sin(a \theta)$, which is
+  what all the built-in piecewise waveforms are.
+
+  b is a function of the harmonic numbers, which gets them with 1 instead of
+  the even ones.'''
+  a = numpy.asarray(a)
+  odd = a % 2 == 1
+  # sin(x) = Re(-i e^(ix))
+  return numpy.where(odd, -1j * b(numpy.where(odd, a, 1)), 0)
 
 def _trapezoid(theta):
   '''A trapezoid with 120-degree flat regions.
@@ -246,7 +976,21 @@ def _trapezoid(theta):
     return -1
   else:
     return (theta - one_sixth * 5.5) / one_sixth * 2
-trapezoid = Waveform(_trapezoid)
+def _vectorized_trapezoid(theta):
+  one_sixth = numpy.pi / 3
+  theta = (numpy.asarray(theta, dtype=float) - one_sixth / 2) % (numpy.pi * 2)
+  return numpy.select(
+      (theta < one_sixth * 2, theta < one_sixth * 3, theta < one_sixth * 5),
+      (1.0, (theta - one_sixth * 2.5) / one_sixth * -2, -1.0),
+      (theta - one_sixth * 5.5) / one_sixth * 2)
+def _trapezoid_series(a):
+  return _odd_sin_series(a, lambda a: 24 / (numpy.pi ** 2 * a ** 2) *
+                         numpy.sin(a * numpy.pi / 6))
+trapezoid = Waveform(_trapezoid, min=-1,
+                     breakpoints=_SIXTHS + numpy.pi / 6,
+                     vectorized_f=_vectorized_trapezoid,
+                     series=_trapezoid_series,
+                     mean_square=7 / 9)
 
 def _trapezoid_6step(theta):
   '''A 6-step "trapezoid".
@@ -267,7 +1011,19 @@ def _trapezoid_6step(theta):
     return -1
   else:
     return -0.5
-trapezoid_6step = Waveform(_trapezoid_6step)
+def _vectorized_trapezoid_6step(theta):
+  one_sixth = numpy.pi / 3
+  theta = numpy.asarray(theta, dtype=float) % (numpy.pi * 2)
+  return numpy.select(
+      [theta < one_sixth * i for i in range(1, 6)],
+      (0.5, 1.0, 0.5, -0.5, -1.0), -0.5)
+def _trapezoid_6step_series(a):
+  return _odd_sin_series(a, lambda a: 2 / (numpy.pi * a) *
+                         (1 + numpy.cos(a * numpy.pi / 3)))
+trapezoid_6step = Waveform(_trapezoid_6step, min=-1, breakpoints=_SIXTHS,
+                           vectorized_f=_vectorized_trapezoid_6step,
+                           series=_trapezoid_6step_series,
+                           mean_square=1 / 2)
 
 def _trapezoid_4step(theta):
   '''A 4-step kind-of-trapezoid. This only has the 120-degree flat regions, and
@@ -287,7 +1043,20 @@ def _trapezoid_4step(theta):
     return -1
   else:
     return 0
-trapezoid_4step = Waveform(_trapezoid_4step)
+def _vectorized_trapezoid_4step(theta):
+  one_sixth = numpy.pi / 3
+  theta = (numpy.asarray(theta, dtype=float) - one_sixth / 2) % (numpy.pi * 2)
+  return numpy.select(
+      (theta < one_sixth * 2, theta < one_sixth * 3, theta < one_sixth * 5),
+      (1.0, 0.0, -1.0), 0.0)
+def _trapezoid_4step_series(a):
+  return _odd_sin_series(a, lambda a: 4 / (numpy.pi * a) *
+                         numpy.cos(a * numpy.pi / 6))
+trapezoid_4step = Waveform(_trapezoid_4step, min=-1,
+                           breakpoints=_SIXTHS + numpy.pi / 6,
+                           vectorized_f=_vectorized_trapezoid_4step,
+                           series=_trapezoid_4step_series,
+                           mean_square=2 / 3)
 
 def _square(theta):
   '''A 2-step square wave.
@@ -299,9 +1068,17 @@ def _square(theta):
     return 1
   else:
     return -1
-square = Waveform(_square)
+def _vectorized_square(theta):
+  theta = numpy.asarray(theta, dtype=float) % (numpy.pi * 2)
+  return numpy.where(theta < numpy.pi, 1.0, -1.0)
+def _square_series(a):
+  return _odd_sin_series(a, lambda a: 4 / (numpy.pi * a))
+square = Waveform(_square, min=-1, breakpoints=(0, numpy.pi),
+                  vectorized_f=_vectorized_square,
+                  series=_square_series,
+                  mean_square=1)
 
-sin = Waveform(numpy.sin)
+sin = Waveform(numpy.sin, min=-1, harmonics={1: (1, -numpy.pi / 2)})
 
 def make_sin_constant(coeff):
   '''Returns a Waveform which will produce constant torque for the given motor
@@ -1,5 +1,9 @@
 #!/usr/bin/python3
 
+import os
+import pickle
+import subprocess
+import sys
 import unittest
 import numpy
 
@@ -117,6 +121,27 @@ class TestCosSum(TestCase):
         for f in (cos_sum.phase, cos_sum.line_line):
           self.assertPeriodicSymmetric(f)
 
+  def test_function_shapes(self):
+    coeff = {1: (1, -numpy.pi / 2), 5: (0.05, 0.3), 7: (0.1, 1)}
+    f = models.CosSum.make_function(coeff)
+    def expected(theta):
+      return sum(b * numpy.cos(a * theta + c) for a, (b, c) in coeff.items())
+    for theta in (0.3, numpy.float64(2), self.theta,
+                  self.theta.reshape((10, -1)), numpy.zeros((0, 3))):
+      with self.subTest(shape=numpy.shape(theta)):
+        self.assertEqual(numpy.shape(f(theta)), numpy.shape(theta))
+        numpy.testing.assert_allclose(f(theta), expected(theta), atol=1e-12)
+
+  def test_evaluate_many(self):
+    functions = (models.BOMA.f, models.T20.line_line_f,
+                 models.CosSum.make_function({1: (2, 0.1), 5: (0.05, 0.3),
+                                              7: (0.1, 1), 11: (0.01, 0)}))
+    theta = self.theta.reshape((2, -1))
+    r = models.CosSum.evaluate_many(functions, theta)
+    self.assertEqual(r.shape, (3,) + theta.shape)
+    for f, row in zip(functions, r):
+      numpy.testing.assert_allclose(row, f(theta), atol=1e-12)
+
 class TestWaveforms(TestCase):
   '''A sanity test of various commutation patterns we define. This verifies
   they are continuous and all three phases add up to a constant.
@@ -197,5 +222,347 @@ class TestWaveforms(TestCase):
         self.assertContinuous(sin_constant)
         self.assertConstant(sin_constant, models.CosSum.make_function(coeff))
 
+  def testVectorized(self):
+    '''The vectorized versions must match the scalar ones exactly, including
+    right at (and on both sides of) every breakpoint.'''
+    sixths = numpy.arange(-24, 25) * (numpy.pi / 6)
+    theta = numpy.concatenate((
+        numpy.linspace(-50, 50, 100001), sixths,
+        numpy.nextafter(sixths, numpy.inf), numpy.nextafter(sixths, -numpy.inf)))
+    for waveform in (models.trapezoid, models.trapezoid_6step,
+                     models.trapezoid_4step, models.square):
+      with self.subTest(waveform=waveform.__doc__):
+        expected = numpy.array([waveform._scalar_f(t) for t in theta],
+                               dtype=float)
+        numpy.testing.assert_array_equal(waveform(theta), expected)
+        self.assertEqual(float(waveform(1.0)), waveform._scalar_f(1.0))
+        numpy.testing.assert_array_equal(
+            waveform(theta[:100000].reshape(-1, 10)),
+            expected[:100000].reshape(-1, 10))
+
+class TestHarmonicSeries(TestCase):
+  def test_closed_form(self):
+    '''The built-in series must match the FFT of the waveforms.'''
+    for waveform in (models.trapezoid, models.trapezoid_6step,
+                     models.trapezoid_4step, models.square):
+      with self.subTest(waveform=waveform.__doc__):
+        sampled = models.Waveform(waveform, vectorized_f=waveform)
+        coeff, _ = waveform.harmonic_series(0.05)
+        sampled_coeff, _ = sampled.harmonic_series(0.05)
+        self.assertEqual(sorted(coeff), sorted(sampled_coeff))
+        for a, (b, c) in coeff.items():
+          self.assertAlmostEqual(b, sampled_coeff[a][0], places=4)
+          self.assertAlmostEqual(c, sampled_coeff[a][1], places=4)
+
+  def test_error(self):
+    '''The reported error must be the actual RMS error, and within
+    tolerance.'''
+    theta = numpy.linspace(0, numpy.pi * 2, 20000, endpoint=False) + 1e-7
+    for waveform in (models.trapezoid, models.trapezoid_6step,
+                     models.trapezoid_4step, models.square,
+                     models.Waveform(lambda t: abs(numpy.sin(t)) - 2 / numpy.pi,
+                                     vectorized_f=lambda t: abs(numpy.sin(t)) -
+                                     2 / numpy.pi)):
+      for tolerance in (0.1, 0.03):
+        with self.subTest(waveform=waveform.__doc__, tolerance=tolerance):
+          coeff, error = waveform.harmonic_series(tolerance)
+          self.assertLessEqual(error, tolerance)
+          truncated = waveform.truncated(tolerance)
+          self.assertEqual(truncated.harmonics, coeff)
+          actual = numpy.sqrt(numpy.mean((truncated(theta) -
+                                          waveform(theta)) ** 2))
+          self.assertAlmostEqual(error, actual, delta=tolerance / 100)
+
+  def test_exact(self):
+    self.assertEqual(models.sin.harmonic_series(), (models.sin.harmonics, 0))
+    coeff = {0: (0.3, 0), 2: (1, 0.4), 5: (0.25, -1)}
+    sampled = models.Waveform(models.CosSum.make_function(coeff).__call__)
+    sampled_coeff, error = sampled.harmonic_series(1e-9)
+    self.assertEqual(sorted(sampled_coeff), sorted(coeff))
+    for a in coeff:
+      numpy.testing.assert_allclose(sampled_coeff[a], coeff[a], atol=1e-12)
+    self.assertLess(error, 1e-9)
+
+  def test_too_many(self):
+    with self.assertRaises(ValueError):
+      models.square.harmonic_series(1e-4)
+
+class TestArithmetic(TestCase):
+  def assertCombination(self, waveform, expected):
+    '''Asserts that waveform is a Waveform which matches the function
+    expected, including its extrema and any harmonics or series.'''
+    self.assertIsInstance(waveform, models.Waveform)
+    theta = numpy.concatenate((self.theta, self.theta - self.epsilon / 2,
+                               waveform.breakpoints or ()))
+    values = expected(theta)
+    numpy.testing.assert_allclose(waveform(theta), values, atol=1e-12)
+    self.assertAlmostEqual(waveform.min, min(values), places=4)
+    self.assertAlmostEqual(waveform.max, max(values), places=4)
+    if waveform.harmonics is not None:
+      numpy.testing.assert_allclose(
+          models.CosSum.make_function(waveform.harmonics)(theta), values,
+          atol=1e-12)
+    if waveform._series is not None:
+      coeff, error = waveform.harmonic_series(0.05)
+      dense = numpy.linspace(0, numpy.pi * 2, 20000, endpoint=False) + 1e-7
+      actual = numpy.sqrt(numpy.mean(
+          (models.CosSum.make_function(coeff)(dense) - expected(dense)) ** 2))
+      self.assertAlmostEqual(error, actual, delta=0.0005)
+    copy = pickle.loads(pickle.dumps(waveform))
+    numpy.testing.assert_array_equal(copy(theta), waveform(theta))
+
+  def test_affine(self):
+    sin, trapezoid = models.sin, models.trapezoid
+    self.assertCombination(sin * 13, lambda t: numpy.sin(t) * 13)
+    self.assertEqual(dict((sin * 13).harmonics), {1: (13, -numpy.pi / 2)})
+    self.assertCombination(numpy.float64(2) * trapezoid,
+                           lambda t: trapezoid(t) * 2)
+    self.assertCombination(-trapezoid / 4 + 0.5,
+                           lambda t: 0.5 - trapezoid(t) / 4)
+    self.assertCombination(1 - models.square, lambda t: 1 - models.square(t))
+    self.assertCombination(trapezoid.shift(0.3) * -2,
+                           lambda t: trapezoid(t + 0.3) * -2)
+    self.assertEqual((trapezoid.shift(0.3) * -2).breakpoints,
+                     tuple(point - 0.3 for point in trapezoid.breakpoints))
+
+  def test_nested_affine(self):
+    waveform = ((models.trapezoid * 2).shift(0.1) + 1) * 3
+    self.assertIs(waveform._scalar_f._operand, models.trapezoid)
+    self.assertCombination(waveform,
+                           lambda t: (models.trapezoid(t + 0.1) * 2 + 1) * 3)
+
+  def test_sum(self):
+    sin, trapezoid, square = models.sin, models.trapezoid, models.square
+    self.assertCombination(sin + sin.shift(1),
+                           lambda t: numpy.sin(t) + numpy.sin(t + 1))
+    self.assertIsNotNone((sin + sin.shift(1)).harmonics)
+    self.assertCombination(trapezoid + square,
+                           lambda t: trapezoid(t) + square(t))
+    self.assertCombination(trapezoid - sin / 2,
+                           lambda t: trapezoid(t) - numpy.sin(t) / 2)
+
+  def test_product(self):
+    sin, trapezoid = models.sin, models.trapezoid
+    self.assertCombination(sin * sin, lambda t: numpy.sin(t) ** 2)
+    self.assertEqual(set((sin * sin).harmonics), {0, 2})
+    bemf = models.Waveform(models.BOMA.f)
+    self.assertCombination(bemf * models.make_sin_constant(models.BOMA.f_coeff),
+                           lambda t: models.BOMA.f(t) * models.make_sin_constant(
+                               models.BOMA.f_coeff)(t))
+    self.assertCombination(trapezoid * models.trapezoid_4step,
+                           lambda t: trapezoid(t) * models.trapezoid_4step(t))
+
+  def test_two_sided(self):
+    coeff = {0: (0.5, numpy.pi), 1: (1, 0.3), 7: (0.1, -2)}
+    coefficients = models.two_sided(coeff)
+    self.assertEqual(sorted(coefficients), [-7, -1, 0, 1, 7])
+    numpy.testing.assert_allclose(
+        sum(x * numpy.exp(1j * a * self.theta)
+            for a, x in coefficients.items()),
+        models.CosSum.make_function(coeff)(self.theta), atol=1e-12)
+    inverse = models.one_sided(coefficients)
+    self.assertEqual(sorted(inverse), [0, 1, 7])
+    for a in coeff:
+      numpy.testing.assert_allclose(inverse[a], coeff[a])
+
+  def test_unsupported(self):
+    with self.assertRaises(TypeError):
+      models.sin * numpy.sin
+    with self.assertRaises(TypeError):
+      models.sin + 'a'
+
+class TestTabulated(TestCase):
+  @staticmethod
+  def expected(theta):
+    return numpy.sin(theta) + 0.2 * numpy.cos(theta * 5 + 0.4)
+
+  def setUp(self):
+    self.start = 0.3
+    self.knots = self.start + numpy.arange(64) * (numpy.pi * 2 / 64)
+    self.dense = numpy.linspace(0, numpy.pi * 2, 20000, endpoint=False) + 1e-7
+
+  def test_interpolation(self):
+    for kind, atol in (('linear', 1e-2), ('cubic', 1e-4)):
+      with self.subTest(kind=kind):
+        waveform = models.make_tabulated(self.expected(self.knots), kind,
+                                         start=self.start)
+        numpy.testing.assert_allclose(waveform(self.knots),
+                                      self.expected(self.knots), atol=1e-12)
+        numpy.testing.assert_allclose(waveform(self.theta),
+                                      self.expected(self.theta), atol=atol)
+        numpy.testing.assert_allclose(waveform(self.theta + numpy.pi * 6),
+                                      waveform(self.theta), atol=1e-12)
+        values = waveform(numpy.concatenate((self.dense, self.knots)))
+        self.assertAlmostEqual(waveform.min, min(values), places=6)
+        self.assertAlmostEqual(waveform.max, max(values), places=6)
+        self.assertEqual(len(waveform.breakpoints), len(self.knots))
+
+  def test_linear(self):
+    waveform = models.make_tabulated((0, 1, 0, -1), 'linear')
+    numpy.testing.assert_allclose(
+        waveform(numpy.arange(-2, 8) * (numpy.pi / 4)),
+        (-1, -0.5, 0, 0.5, 1, 0.5, 0, -0.5, -1, -0.5), atol=1e-12)
+    self.assertEqual((waveform.min, waveform.max), (-1, 1))
+
+  def test_series(self):
+    '''The series must be the exact Fourier series of the interpolation.'''
+    for kind in ('linear', 'cubic'):
+      with self.subTest(kind=kind):
+        waveform = models.make_tabulated(self.expected(self.knots), kind,
+                                         start=self.start)
+        values = waveform(self.dense - 1e-7)
+        fft = numpy.fft.rfft(values) / len(values)
+        amplitudes = waveform._series(numpy.arange(100))
+        numpy.testing.assert_allclose(amplitudes[0], fft[0], atol=1e-12)
+        # The linear interpolation's harmonics fall off slowly, so some alias
+        # into the FFT.
+        numpy.testing.assert_allclose(amplitudes[1:], fft[1:100] * 2,
+                                      atol=1e-7)
+        self.assertAlmostEqual(waveform._mean_square, numpy.mean(values ** 2),
+                               places=8)
+        for tolerance in (1e-2, 1e-4):
+          coeff, error = waveform.harmonic_series(tolerance)
+          self.assertLessEqual(error, tolerance)
+          actual = numpy.sqrt(numpy.mean(
+              (models.CosSum.make_function(coeff)(self.dense) -
+               waveform(self.dense)) ** 2))
+          self.assertAlmostEqual(error, actual, delta=tolerance / 100)
+
+  def test_pickle(self):
+    waveform = models.make_tabulated(self.expected(self.knots), start=1)
+    copy = pickle.loads(pickle.dumps(waveform))
+    numpy.testing.assert_array_equal(copy(self.theta), waveform(self.theta))
+    numpy.testing.assert_array_equal(copy.breakpoints, waveform.breakpoints)
+
+  def test_invalid(self):
+    with self.assertRaises(ValueError):
+      models.make_tabulated(numpy.zeros(8), 'quadratic')
+    with self.assertRaises(ValueError):
+      models.make_tabulated(numpy.zeros((8, 2)))
+
+class TestDerivative(TestCase):
+  def test_harmonics(self):
+    derivative = models.BOMA.f.derivative()
+    self.assertIsInstance(derivative, models.CosSumFunction)
+    self.assertFClose(derivative, lambda t: sum(
+        -a * b * numpy.sin(a * t + c) for a, (b, c) in models.BOMA.f_coeff.items()))
+    waveform = models.make_sin_constant(models.BOMA.f_coeff) + 0.5
+    self.assertIsNotNone(waveform.derivative().harmonics)
+    self.assertFClose(waveform.derivative(), lambda t: sum(
+        -a * b * numpy.sin(a * t + c) for a, (b, c)
+        in models.make_sin_constant(models.BOMA.f_coeff).harmonics.items()))
+    self.assertIs(waveform.derivative(), waveform.derivative())
+
+  def test_tabulated(self):
+    '''Samples of a sum of low harmonics are differentiated exactly at the
+    samples.'''
+    knots = numpy.arange(64) * (numpy.pi * 2 / 64) + 0.2
+    for kind in ('linear', 'cubic'):
+      with self.subTest(kind=kind):
+        waveform = models.make_tabulated(
+            numpy.sin(knots) + numpy.cos(knots * 5) * 0.2, kind, start=0.2)
+        derivative = waveform.derivative()
+        numpy.testing.assert_allclose(
+            derivative(knots),
+            numpy.cos(knots) - numpy.sin(knots * 5), atol=1e-12)
+        self.assertIsNotNone(derivative._series)
+
+  def test_combinations(self):
+    trapezoid, sin = models.trapezoid, models.sin
+    # Away from the trapezoid's breakpoints, where the central difference of
+    # the whole thing isn't the same as combining the operands'.
+    theta = numpy.linspace(0.6, 1.5, 50)
+    for waveform in (trapezoid.shift(0.3) * -2 + 1, trapezoid + sin,
+                     trapezoid * sin.shift(1)):
+      with self.subTest(waveform=waveform.__doc__):
+        expected = (waveform(theta + 1e-6) - waveform(theta - 1e-6)) / 2e-6
+        numpy.testing.assert_allclose(waveform.derivative()(theta), expected,
+                                      atol=1e-6)
+
+  def test_central_difference(self):
+    derivative = models.trapezoid.derivative()
+    self.assertAlmostEqual(float(derivative(numpy.pi)), -6 / numpy.pi)
+    self.assertAlmostEqual(float(derivative(1)), 0)
+    self.assertAlmostEqual(derivative.max, 6 / numpy.pi)
+    copy = pickle.loads(pickle.dumps(derivative))
+    numpy.testing.assert_array_equal(copy(self.theta), derivative(self.theta))
+    self.assertEqual(derivative.derivative().breakpoints,
+                     models.trapezoid.breakpoints)
+    self.assertEqual(
+        (models.trapezoid + models.trapezoid.shift(1)).derivative().breakpoints,
+        models._merge_breakpoints(models.trapezoid.breakpoints,
+                                  models.trapezoid.shift(1).breakpoints))
+
+class TestPickle(TestCase):
+  def test_cos_sum(self):
+    for cos_sum in (models.CosSum(line_line={1: (0.03, 0.2), 7: (0.003, 1)}),
+                    models.CosSum(phase={1: (1, 0), 5: (0.1, 0)})):
+      copy = pickle.loads(pickle.dumps(cos_sum))
+      self.assertEqual(copy.phase_coeff, cos_sum.phase_coeff)
+      self.assertEqual(copy.line_line_coeff, cos_sum.line_line_coeff)
+      self.assertTrue((copy.phase(self.theta) == cos_sum.phase(self.theta)).all())
+
+  def test_motor(self):
+    for motor in (models.BOMA, models.MY1020, models.T20):
+      copy = pickle.loads(pickle.dumps(motor))
+      self.assertEqual(repr(copy), repr(motor))
+      self.assertEqual(copy.line_line_f_coeff, motor.line_line_f_coeff)
+      self.assertTrue((copy.f(self.theta) == motor.f(self.theta)).all())
+
+  def test_waveform(self):
+    for waveform in (models.trapezoid, models.trapezoid_6step,
+                     models.trapezoid_4step, models.square, models.sin,
+                     models.make_sin_constant(models.BOMA.f_coeff)):
+      with self.subTest(waveform=waveform.__doc__):
+        copy = pickle.loads(pickle.dumps(waveform))
+        self.assertTrue((copy(self.theta) == waveform(self.theta)).all())
+        self.assertEqual(copy.min, waveform.min)
+        self.assertEqual(copy.harmonics, waveform.harmonics)
+        self.assertEqual(copy.breakpoints, waveform.breakpoints)
+        self.assertEqual(copy.harmonic_series(), waveform.harmonic_series())
+
+class TestImport(unittest.TestCase):
+  '''Makes sure importing the modules stays cheap, because every worker process
+  pays for it before doing anything useful.'''
+
+  # How many times as long importing our modules may take as importing numpy
+  # itself. They take about a quarter as long, which leaves plenty of margin
+  # for slow machines, but importing scipy.integrate as well goes over.
+  _RELATIVE_BUDGET = 1
+  # How many processes to take the median time from.
+  _RUNS = 5
+
+  _SCRIPT = '''
+import sys
+import time
+start = time.perf_counter()
+import numpy
+middle = time.perf_counter()
+import models, simulation, simple
+end = time.perf_counter()
+print(middle - start, end - middle)
+print(' '.join(sorted(name for name in ('scipy', 'matplotlib')
+                      if name in sys.modules)))
+'''
+
+  def run_script(self):
+    '''Returns (numpy import seconds, our import seconds, heavy modules).'''
+    lines = subprocess.run(
+        (sys.executable, '-c', self._SCRIPT), check=True,
+        stdout=subprocess.PIPE, universal_newlines=True,
+        cwd=os.path.dirname(os.path.abspath(__file__))).stdout.split('\n')
+    numpy_time, our_time = map(float, lines[0].split())
+    return numpy_time, our_time, lines[1]
+
+  def test_import_time(self):
+    results = [self.run_script() for _ in range(self._RUNS)]
+    numpy_time = numpy.median([result[0] for result in results])
+    our_time = numpy.median([result[1] for result in results])
+    self.assertLess(our_time, numpy_time * self._RELATIVE_BUDGET)
+
+  def test_lazy_imports(self):
+    '''scipy and matplotlib are only imported when they're needed.'''
+    self.assertEqual(self.run_script()[2], '')
+
 if __name__ == '__main__':
   unittest.main()
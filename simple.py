@@ -1,60 +1,163 @@
+import constants_cache
 import simulation
+import spectral
 import numpy
-import scipy
 
 class SimpleController(simulation.MotorController):
-  def __init__(self, motor, phase_g):
-    super().__init__(motor)
+  # All the attributes calculated by _calculate_unit_constants.
+  _UNIT_CONSTANTS = ('_unit_phase_average_torque', '_unit_total_rms_torque',
+                     '_unit_phase_rms_torque', '_unit_phase_rms_current',
+                     '_unit_phase_average_current', '_unit_total_rms_current',
+                     '_max_speed', '_unit_voltage')
+  # Keyword arguments for simulation.max_circle when finding the unit voltage.
+  _VOLTAGE_SEARCH = {'samples': 2000, 'candidates': 8, 'tolerance': 1e-10}
+  # The initial grid size for simulation.zero_crossings of phase_g.
+  _CROSSING_SAMPLES = 2000
 
+  def __init__(self, motor, phase_g, integrator = None, cache = None):
+    '''cache is an optional constants_cache.ConstantsCache, to reuse the
+    expensive constants across processes.'''
+    super().__init__(motor, integrator)
+    self._set_phase_g(phase_g)
+
+    if cache is None:
+      self._calculate_unit_constants()
+      return
+    key = self._cache_key()
+    constants = cache.get(key, self._UNIT_CONSTANTS)
+    if constants is None:
+      self._calculate_unit_constants()
+      cache.put(key, {name: float(getattr(self, name))
+                      for name in self._UNIT_CONSTANTS})
+    else:
+      for name in self._UNIT_CONSTANTS:
+        setattr(self, name, constants[name])
+
+  def _set_phase_g(self, phase_g):
     self._phase_g = phase_g
     def line_line_g(theta):
       return phase_g(theta) - phase_g(theta + numpy.pi * 2 / 3)
     self._line_line_g = line_line_g
 
+  def __getstate__(self):
+    # Everything else is closures built from these.
+    return {'motor': self.motor, 'phase_g': self.phase_g,
+            'integrator': self.integrator,
+            'constants': {name: getattr(self, name)
+                          for name in self._UNIT_CONSTANTS}}
+
+  def __setstate__(self, state):
+    simulation.MotorController.__init__(self, state['motor'],
+                                        state['integrator'])
+    self._set_phase_g(state['phase_g'])
+    for name, value in state['constants'].items():
+      setattr(self, name, value)
+
+  def _cache_key(self):
+    '''Returns the cache key for everything _calculate_unit_constants
+    depends on.'''
+    return constants_cache.make_key(
+        type(self).__name__,
+        constants_cache.motor_fingerprint(self.motor),
+        constants_cache.waveform_fingerprint(self.phase_g),
+        repr(self.integrator),
+        {'voltage_search': self._VOLTAGE_SEARCH,
+         'crossing_samples': self._CROSSING_SAMPLES,
+         'difference_epsilon': simulation._DIFFERENCE_EPSILON})
+
+  def _calculate_unit_constants(self):
     def phase_average_sane(phase, total):
       return round(phase * 3 - total, 7) == 0
 
     def phase_torque(theta):
       r = self.motor.f(theta) * self.phase_g(theta)
-      assert (r >= -1e-20).all(), '%f: %f * %f = %f' % (theta, self.motor.f(theta), self.phase_g(theta), r)
+      assert (r >= -1e-12).all(), '%s: %s * %s = %s' % (theta, self.motor.f(theta), self.phase_g(theta), r)
       return r
     def total_torque(theta):
       return simulation.three_phases(phase_torque, theta)
-    # N*m for one phase.
-    self._unit_phase_average_torque = simulation.average_circle(phase_torque)
-    assert phase_average_sane(self._unit_phase_average_torque, simulation.average_circle(total_torque))
-    # N*m for all phases *at once*.
-    self._unit_total_rms_torque = simulation.rms_circle(total_torque)
-    # N*m for one phase.
-    self._unit_phase_rms_torque = simulation.rms_circle(phase_torque)
+    breakpoints = getattr(self.phase_g, 'breakpoints', None)
+    integrator = self.integrator
+    if breakpoints is None:
+      # We don't know where phase_g might be discontinuous, so only adaptive
+      # integration can find it.
+      breakpoints = ()
+      integrator = simulation.AdaptiveIntegrator()
+      abs_breakpoints = ()
+    else:
+      # Taking the absolute value adds breakpoints where the current crosses
+      # zero.
+      abs_breakpoints = tuple(breakpoints) + tuple(
+          simulation.zero_crossings(self.phase_g, breakpoints,
+                                    samples=self._CROSSING_SAMPLES))
+    total_breakpoints = simulation.three_phases_breakpoints(breakpoints)
+
+    f_spectrum = spectral.Spectrum.of(self.motor.f)
+    g_spectrum = spectral.Spectrum.of(self.phase_g)
+    if f_spectrum is not None and g_spectrum is not None:
+      # Both are finite sums of harmonics, so these are all exact sums of
+      # coefficient products.
+      phase_torque_spectrum = f_spectrum * g_spectrum
+      thetas = numpy.linspace(0, numpy.pi * 2, 1000)
+      assert (phase_torque_spectrum(thetas) >= -1e-12).all(), 'negative torque'
+      total_torque_spectrum = phase_torque_spectrum.three_phases()
+      self._unit_phase_average_torque = phase_torque_spectrum.average()
+      assert phase_average_sane(self._unit_phase_average_torque, total_torque_spectrum.average())
+      self._unit_total_rms_torque = total_torque_spectrum.rms()
+      self._unit_phase_rms_torque = phase_torque_spectrum.rms()
+      self._unit_phase_rms_current = g_spectrum.rms()
+    else:
+      # N*m for one phase.
+      self._unit_phase_average_torque = simulation.average_circle(
+          phase_torque, integrator, breakpoints)
+      assert phase_average_sane(self._unit_phase_average_torque, simulation.average_circle(
+          total_torque, integrator, total_breakpoints))
+      # N*m for all phases *at once*.
+      self._unit_total_rms_torque = simulation.rms_circle(
+          total_torque, integrator, total_breakpoints)
+      # N*m for one phase.
+      self._unit_phase_rms_torque = simulation.rms_circle(
+          phase_torque, integrator, breakpoints)
+      # A for a single phase.
+      # Taking the absolute value changes nothing for RMS of a single quantity.
+      self._unit_phase_rms_current = simulation.rms_circle(
+          self.phase_g, integrator, breakpoints)
 
     def abs_phase_current(theta):
       return numpy.abs(self.phase_g(theta))
     def total_current(theta):
       return simulation.three_phases(abs_phase_current, theta)
+    # The absolute values aren't sums of harmonics, so these always have to be
+    # integrated numerically.
+    total_abs_breakpoints = simulation.three_phases_breakpoints(abs_breakpoints)
     # A (absolute value) for a single phase.
-    self._unit_phase_average_current = simulation.average_circle(abs_phase_current)
-    assert phase_average_sane(self._unit_phase_average_current, simulation.average_circle(total_current))
+    self._unit_phase_average_current = simulation.average_circle(
+        abs_phase_current, integrator, abs_breakpoints)
+    assert phase_average_sane(self._unit_phase_average_current, simulation.average_circle(
+        total_current, integrator, total_abs_breakpoints))
     # A (absolute value) for all phases *at once*.
-    self._unit_total_rms_current = simulation.rms_circle(total_current)
-    # A for a single phase.
-    # Taking the absolute value changes nothing for RMS of a single quantity.
-    self._unit_phase_rms_current = simulation.rms_circle(self.phase_g)
+    self._unit_total_rms_current = simulation.rms_circle(
+        total_current, integrator, total_abs_breakpoints)
 
     thetas = numpy.linspace(0, numpy.pi * 2, 1000)
     self._max_speed = 1 / numpy.amax(self.motor.line_line_f(thetas))
 
+    phase_g_derivative = simulation.derivative(self.phase_g)
     def input_voltage(theta):
-      thetas = (theta, theta + numpy.pi * 2 / 3,
-                theta - numpy.pi * 2 / 3)
+      thetas = numpy.array((theta, theta + numpy.pi * 2 / 3,
+                            theta - numpy.pi * 2 / 3))
       from_resistance = self.phase_g(thetas) * self.motor.resistance
-      from_inductance = (simulation.differentiate(self.phase_g, thetas) *
+      from_inductance = (phase_g_derivative(thetas) *
                           self.motor.self_inductance)
       voltages = from_resistance + from_inductance
       return numpy.amax(numpy.abs((voltages[0] - voltages[1],
                                     voltages[0] - voltages[2],
-                                    voltages[1] - voltages[2])))
-    self._unit_voltage = simulation.max_circle(input_voltage)
+                                    voltages[1] - voltages[2])), axis=0)
+    # The derivative is only defined between the breakpoints, so jumps in the
+    # current don't count. Both sides of each one are checked for the ends of
+    # the pieces.
+    self._unit_voltage = simulation.max_circle(
+        input_voltage, **self._VOLTAGE_SEARCH,
+        breakpoints=simulation.three_phases_breakpoints(breakpoints))
 
   def max_speed(self):
     return self._max_speed
@@ -65,13 +168,30 @@ class SimpleController(simulation.MotorController):
                       max_input_power = None,
                       max_voltage = None,
                       ):
-    scale_limits = []
+    return self.operating_points(omega,
+                                 max_torque=max_torque,
+                                 max_motor_current=max_motor_current,
+                                 max_input_power=max_input_power,
+                                 max_voltage=max_voltage)[()]
+
+  def operating_points(self, omega,
+                       max_torque = None,
+                       max_motor_current = None,
+                       max_input_power = None,
+                       max_voltage = None,
+                       ):
+    omega = numpy.asarray(omega, dtype=float)
+    # Maps from the name of each limit to the scale it allows.
+    scale_limits = {}
 
     if max_torque is not None:
-      scale_limits.append(max_torque / (self._unit_phase_average_torque * 3))
+      scale_limits['torque'] = (numpy.asarray(max_torque, dtype=float) /
+                                (self._unit_phase_average_torque * 3))
 
     if max_motor_current is not None:
-      scale_limits.append(max_motor_current / self._unit_phase_rms_current)
+      scale_limits['motor_current'] = (
+          numpy.asarray(max_motor_current, dtype=float) /
+          self._unit_phase_rms_current)
 
     # W/A burned as heat for all phases.
     unit_rms_electrical_power = (self._unit_total_rms_current**2 *
@@ -79,6 +199,7 @@ class SimpleController(simulation.MotorController):
     # W/A turned into torque for all phases.
     unit_rms_mechanical_power = self._unit_total_rms_torque * omega
     if max_input_power is not None:
+      max_input_power = numpy.asarray(max_input_power, dtype=float)
       # input_power = unit_mechanical_power*x + unit_electrical_power*x^2
       # 0 = unit_electrical * x^2 + unit_mechanical * x + -input_power
       # Then, use the quadratic formula.
@@ -87,15 +208,25 @@ class SimpleController(simulation.MotorController):
                     numpy.sqrt(unit_rms_mechanical_power ** 2 -
                                4 * unit_rms_electrical_power * -max_input_power)) /
                    (2 * unit_rms_electrical_power))
-      scale_limits.append(new_scale)
+      scale_limits['input_power'] = new_scale
 
     if max_voltage is not None:
+      max_voltage = numpy.asarray(max_voltage, dtype=float)
       bemf_voltage = omega / self.max_speed()
-      assert bemf_voltage <= max_voltage, 'TODO(Brian): braking not supported yet'
-      scale_limits.append((max_voltage - bemf_voltage) / self._unit_voltage)
+      assert (bemf_voltage <= max_voltage).all(), 'TODO(Brian): braking not supported yet'
+      scale_limits['voltage'] = (max_voltage - bemf_voltage) / self._unit_voltage
 
     assert scale_limits, 'Need to specify at least one limit'
-    final_scale = numpy.nanmin(scale_limits)
+    names = [name for name in simulation.LIMITS if name in scale_limits]
+    scale_limits = numpy.array(numpy.broadcast_arrays(
+        omega, *[scale_limits[name] for name in names])[1:])
+    final_scale = numpy.nanmin(scale_limits, axis=0)
+    limit = numpy.array(names)[numpy.argmin(
+        numpy.where(numpy.isnan(scale_limits), numpy.inf, scale_limits),
+        axis=0)]
+    omega = numpy.broadcast_to(omega, final_scale.shape)
+    unit_rms_mechanical_power = numpy.broadcast_to(unit_rms_mechanical_power,
+                                                   final_scale.shape)
 
     rms_motor_power = (((self._unit_phase_rms_current * final_scale) ** 2) *
                        self.motor.resistance * 3)
@@ -103,13 +234,14 @@ class SimpleController(simulation.MotorController):
     rms_input_power = rms_output_power + unit_rms_electrical_power * final_scale**2
     average_motor_power = (((self._unit_phase_average_current * final_scale) ** 2) *
                            self.motor.resistance * 3)
-    return simulation.OperatingPoint(
+    return simulation.OperatingPoints(
         omega=omega,
         rms_motor_power=rms_motor_power,
         rms_output_power=rms_output_power,
         rms_input_power=rms_input_power,
         average_motor_power=average_motor_power,
         torque=self._unit_phase_average_torque * final_scale * 3,
+        limit=limit,
       )
 
   @property
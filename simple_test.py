@@ -1,9 +1,13 @@
 #!/usr/bin/python3
 
+import pickle
 import unittest
+from unittest import mock
 import numpy
 
 import simple
+import simulation
+import spectral
 import models
 
 _one_offset = -numpy.pi / 2
@@ -34,6 +38,11 @@ _CONTROLLERS = (
                                          phase_f_coeff = {1: (1, 0)},
                                          electrical_ratio = 1),
                             lambda t: models.sin(t) * 13),
+    simple.SimpleController(models.Motor(phase_resistance = 1,
+                                         phase_self_inductance = 1,
+                                         phase_f_coeff = {1: (1, 0)},
+                                         electrical_ratio = 1),
+                            models.sin * 13),
     simple.SimpleController(models.Motor(phase_resistance = 1,
                                          phase_self_inductance = 1,
                                          phase_f_coeff = {1: (1, 0), 5: (0.5, 0)},
@@ -70,6 +79,152 @@ class SimpleControllerTest(unittest.TestCase):
   def assertGreaterAlmostEqual(self, a, b):
     self.assertGreaterEqual(round(a, 7), round(b, 7))
 
+  def test_spectral_matches_numeric(self):
+    for controller in _CONTROLLERS:
+      if spectral.Spectrum.of(controller.phase_g) is None:
+        continue
+      with self.subTest(controller=controller):
+        phase_g = controller.phase_g
+        numeric = simple.SimpleController(controller.motor,
+                                          lambda t: phase_g(t))
+        for omega in (0, 100):
+          spectral_point = controller.operating_point(omega,
+                                                      max_motor_current = 1)
+          numeric_point = numeric.operating_point(omega,
+                                                  max_motor_current = 1)
+          self.assertAlmostEqual(spectral_point.torque, numeric_point.torque)
+          self.assertAlmostEqual(spectral_point.rms_input_power,
+                                 numeric_point.rms_input_power)
+          self.assertAlmostEqual(spectral_point.rms_motor_power,
+                                 numeric_point.rms_motor_power)
+
+  def test_tabulated(self):
+    '''A waveform interpolated from samples of one of the others should behave
+    about the same.'''
+    thetas = numpy.arange(256) * (numpy.pi * 2 / 256)
+    exact = simple.SimpleController(_MOTOR1, models.sin)
+    tabulated = simple.SimpleController(
+        _MOTOR1, models.make_tabulated(models.sin(thetas)),
+        integrator=simulation.PeriodicIntegrator())
+    for omega in (0, 0.5):
+      exact_point = exact.operating_point(omega, max_motor_current=1)
+      tabulated_point = tabulated.operating_point(omega, max_motor_current=1)
+      self.assertAlmostEqual(tabulated_point.torque, exact_point.torque,
+                             places=5)
+      self.assertAlmostEqual(tabulated_point.rms_input_power,
+                             exact_point.rms_input_power, places=5)
+
+  def test_shifted_crossings(self):
+    '''The kinks in |phase_g| come from where it actually crosses zero.'''
+    motor = models.Motor(phase_resistance = 1,
+                         phase_self_inductance = 1,
+                         phase_f_coeff = {1: (1, 0), 2: (0.4, 1)},
+                         electrical_ratio = 1)
+    phase_g = models.make_tabulated(
+        motor.f(numpy.arange(64) * (numpy.pi * 2 / 64)))
+    controller = simple.SimpleController(
+        motor, phase_g, integrator=simulation.PeriodicIntegrator())
+    thetas = numpy.arange(1000000) * (numpy.pi * 2 / 1000000)
+    point = controller.operating_point(0, max_motor_current=1)
+    scale = 1 / numpy.sqrt(numpy.mean(phase_g(thetas) ** 2))
+    self.assertAlmostEqual(
+        point.average_motor_power,
+        (numpy.mean(numpy.abs(phase_g(thetas))) * scale) ** 2 *
+        motor.resistance * 3, places=9)
+
+  def test_unknown_breakpoints(self):
+    '''Functions without breakpoints fall back to adaptive integration.'''
+    known = simple.SimpleController(
+        models.T20, models.square, integrator=simulation.PeriodicIntegrator())
+    unknown = simple.SimpleController(
+        models.T20, lambda t: models.square(t),
+        integrator=simulation.PeriodicIntegrator())
+    for kwargs in ({'max_motor_current': 10}, {'max_torque': 1}):
+      known_point = known.operating_point(0, **kwargs)
+      unknown_point = unknown.operating_point(0, **kwargs)
+      self.assertAlmostEqual(unknown_point.torque, known_point.torque)
+      self.assertAlmostEqual(unknown_point.average_motor_power,
+                             known_point.average_motor_power)
+
+  def test_piecewise_voltage(self):
+    '''Jumps in the current don't count towards the voltage. At a standstill,
+    a square wave only needs enough voltage to push its current through two
+    phases.'''
+    thetas = numpy.arange(6000) * (numpy.pi * 2 / 6000) + 0.001
+    for motor in (models.BOMA, models.MY1020, models.T20):
+      for waveform in (models.square, models.trapezoid_4step):
+        with self.subTest(motor=motor, waveform=waveform):
+          controller = simple.SimpleController(
+              motor, waveform, integrator=simulation.PeriodicIntegrator())
+          point = controller.operating_point(
+              0, max_voltage=motor.resistance * 2)
+          self.assertAlmostEqual(point.rms_motor_power / motor.resistance,
+                                 numpy.mean(waveform(thetas) ** 2) * 3)
+
+  def test_voltage_step_size(self):
+    '''The unit voltage doesn't depend on the finite difference step.'''
+    for waveform in (models.square, models.trapezoid, models.trapezoid_6step,
+                     models.trapezoid_4step, models.sin):
+      voltages = []
+      for epsilon in (1e-3, 1e-5):
+        with mock.patch.object(simulation, '_DIFFERENCE_EPSILON', epsilon):
+          controller = simple.SimpleController(
+              models.BOMA, waveform,
+              integrator=simulation.PeriodicIntegrator())
+        voltages.append(controller.operating_point(
+            0, max_voltage=1).rms_motor_power)
+      with self.subTest(waveform=waveform):
+        self.assertAlmostEqual(voltages[0], voltages[1], places=12)
+
+  def test_operating_points(self):
+    omegas = numpy.array([0, 0.5, 0.9, 0.999])
+    max_currents = numpy.array([[1], [10], [100]])
+    for controller in _CONTROLLERS:
+      with self.subTest(controller=controller):
+        points = controller.operating_points(
+            omegas * controller.max_speed() * 10,
+            max_motor_current=max_currents, max_input_power=500,
+            max_voltage=10)
+        self.assertEqual(points.shape, (3, 4))
+        fallback = simulation.MotorController.operating_points(
+            controller, omegas * controller.max_speed() * 10,
+            max_motor_current=max_currents, max_input_power=500,
+            max_voltage=10)
+        for index in numpy.ndindex(points.shape):
+          point = controller.operating_point(
+              omegas[index[1]] * controller.max_speed() * 10,
+              max_motor_current=max_currents[index[0], 0],
+              max_input_power=500, max_voltage=10)
+          for field in ('omega', 'torque', 'rms_motor_power',
+                        'rms_output_power', 'rms_input_power',
+                        'average_motor_power', 'efficiency', 'limit'):
+            self.assertEqual(getattr(points, field)[index],
+                             getattr(point, field))
+            self.assertEqual(getattr(points[index], field),
+                             getattr(point, field))
+            self.assertEqual(getattr(fallback, field)[index],
+                             getattr(point, field))
+        self.assertEqual(points.limit[0, 0], 'motor_current')
+        self.assertEqual(points.limit[2, 3], 'voltage')
+
+  def test_pickle(self):
+    for controller in _CONTROLLERS[:1] + _CONTROLLERS[2:] + (
+        simple.SimpleController(models.BOMA, models.trapezoid_6step),
+        simple.SimpleController(models.T20, models.square)):
+      with self.subTest(controller=controller):
+        copy = pickle.loads(pickle.dumps(controller))
+        self.assertEqual(copy.max_speed(), controller.max_speed())
+        for omega in (0, controller.max_speed() * 5):
+          for kwargs in ({'max_torque': 1}, {'max_motor_current': 10},
+                         {'max_input_power': 100}, {'max_voltage': 10}):
+            a = controller.operating_point(omega, **kwargs)
+            b = copy.operating_point(omega, **kwargs)
+            for field in ('torque', 'rms_motor_power', 'rms_output_power',
+                          'rms_input_power', 'average_motor_power', 'limit'):
+              self.assertEqual(getattr(a, field), getattr(b, field))
+        self.assertTrue((copy.line_line_g(numpy.arange(0, 7, 0.1)) ==
+                         controller.line_line_g(numpy.arange(0, 7, 0.1))).all())
+
   def test_max_torque(self):
     for controller in _CONTROLLERS:
       with self.subTest(controller=controller):
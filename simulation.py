@@ -40,55 +40,385 @@ All signs are positive for operation in quadrant I (motoring).
 TODO(Brian): Define sign conventions for all quantities for the other quadrants.
 '''
 
+import functools
+
 import numpy
-import scipy.optimize
-import scipy.integrate
 
-def average_circle(f):
-  return scipy.integrate.quad(f, 0, numpy.pi * 2)[0] / (numpy.pi * 2)
+class AdaptiveIntegrator(object):
+  """Integrates over a revolution with scipy.integrate.quad.
+
+  This works for any function, including ones which only accept scalars, but
+  it takes many separate function calls.
+  """
+  def average(self, f, breakpoints=()):
+    """
+    Calculates the average of f over a whole revolution.
+
+    Arguments
+    ---------
+    f : callable
+        Function from theta to a scalar, with a period of 2*pi.
+    breakpoints : iterable of float, optional
+        Angles where f or its derivatives are discontinuous.
+
+    Returns
+    -------
+    float
+        The average value.
+    """
+    import scipy.integrate
+
+    points = [point for point in _wrap_breakpoints(breakpoints) if point > 0]
+    return scipy.integrate.quad(f, 0, numpy.pi * 2, points=points or None,
+                                limit=max(50, len(points) * 2)
+                                )[0] / (numpy.pi * 2)
 
-def rms_circle(f):
-  return numpy.sqrt(average_circle(lambda t: f(t)**2))
+  def __repr__(self):
+    return 'AdaptiveIntegrator()'
+
+class PeriodicIntegrator(object):
+  """Integrates over a revolution with a fixed number of samples.
+
+  For smooth periodic functions, the trapezoid rule on a uniform grid converges
+  exponentially with the number of samples. Piecewise functions instead get
+  split at their breakpoints, and each piece is integrated with Gauss-Legendre
+  quadrature, which converges just as fast for each smooth piece.
+
+  f is called once, with an array of all the thetas at the same time.
+
+  The error is estimated by comparing the result from samples against the one
+  from twice as many. If tolerance is specified, the number of samples is
+  doubled until the error estimate is within it, and ValueError is raised if
+  that would take more than max_samples.
+
+  Attributes
+  ----------
+  samples : int
+      The initial number of samples per revolution.
+  tolerance : float or None
+      The maximum acceptable error estimate.
+  max_samples : int
+      The most samples to evaluate when trying to meet tolerance.
+  """
+  def __init__(self, samples = 256, tolerance = None, max_samples = 1 << 16):
+    self._samples = samples
+    self._tolerance = tolerance
+    self._max_samples = max_samples
+
+  @property
+  def samples(self):
+    return self._samples
+
+  @property
+  def tolerance(self):
+    return self._tolerance
+
+  @property
+  def max_samples(self):
+    return self._max_samples
+
+  def average(self, f, breakpoints=()):
+    """Like AdaptiveIntegrator.average."""
+    return self.average_with_error(f, breakpoints)[0]
+
+  def average_with_error(self, f, breakpoints=()):
+    """
+    Calculates the average of f over a whole revolution, with an estimate of
+    the error.
+
+    Arguments are the same as AdaptiveIntegrator.average.
+
+    Returns
+    -------
+    (float, float)
+        The average value, and the estimated absolute error in it.
+    """
+    points = _wrap_breakpoints(breakpoints)
+    samples = self.samples
+    while True:
+      value, error = self._average_pair(f, points, samples)
+      if self.tolerance is None or error <= self.tolerance:
+        return value, error
+      if samples * 4 > self.max_samples:
+        raise ValueError('Error %g > %g with %d samples' % (
+            error, self.tolerance, samples * 2))
+      samples *= 2
+
+  @staticmethod
+  def _average_pair(f, points, samples):
+    """Returns the average with samples*2 samples, and its difference from
+    the one with samples."""
+    if not points:
+      # The trapezoid rule, with every other point forming the coarse grid.
+      thetas = numpy.arange(samples * 2) * (numpy.pi / samples)
+      values = f(thetas)
+      fine = numpy.mean(values)
+      coarse = numpy.mean(values[::2])
+      return fine, abs(fine - coarse)
+    coarse_thetas, coarse_weights = _gauss_legendre(points, samples)
+    fine_thetas, fine_weights = _gauss_legendre(points, samples * 2)
+    values = f(numpy.concatenate((coarse_thetas, fine_thetas)))
+    coarse = coarse_weights @ values[:len(coarse_thetas)]
+    fine = fine_weights @ values[len(coarse_thetas):]
+    return fine, abs(fine - coarse)
+
+  def __repr__(self):
+    return 'PeriodicIntegrator(samples=%r, tolerance=%r, max_samples=%r)' % (
+        self.samples, self.tolerance, self.max_samples)
+
+def _wrap_breakpoints(breakpoints):
+  """Returns a sorted list of the unique breakpoints in [0, 2*pi).
+
+  Points within rounding error of each other are merged.
+  """
+  epsilon = 1e-9
+  r = []
+  for point in sorted(float(point % (numpy.pi * 2)) for point in breakpoints):
+    if numpy.pi * 2 - point < epsilon:
+      point = 0.0
+    if not any(abs(point - other) < epsilon for other in r[-1:] + r[:1]):
+      r.append(point)
+  return sorted(r)
+
+@functools.lru_cache(maxsize=None)
+def _leggauss(n):
+  """numpy.polynomial.legendre.leggauss, which is the same every time for each
+  n, and slow enough to matter for functions with many breakpoints."""
+  return numpy.polynomial.legendre.leggauss(n)
+
+def _gauss_legendre(points, samples):
+  """Returns Gauss-Legendre nodes and weights (normalized to calculate an
+  average) for the pieces of a revolution between points.
+
+  The samples are divided between the pieces in proportion to their lengths.
+  """
+  starts = numpy.array(points)
+  ends = numpy.append(starts[1:], starts[0] + numpy.pi * 2)
+  all_thetas, all_weights = [], []
+  for start, end in zip(starts, ends):
+    n = max(2, int(numpy.ceil(samples * (end - start) / (numpy.pi * 2))))
+    nodes, weights = _leggauss(n)
+    half_width = (end - start) / 2
+    all_thetas.append(start + half_width * (nodes + 1))
+    all_weights.append(weights * half_width / (numpy.pi * 2))
+  return numpy.concatenate(all_thetas), numpy.concatenate(all_weights)
+
+_DEFAULT_INTEGRATOR = AdaptiveIntegrator()
+
+def average_circle(f, integrator=None, breakpoints=()):
+  """
+  Calculates the average of f over a whole revolution.
+
+  Arguments
+  ---------
+  f : callable
+      Function from theta to a scalar, with a period of 2*pi.
+  integrator : AdaptiveIntegrator or PeriodicIntegrator, optional
+      How to do the integration. Defaults to an AdaptiveIntegrator.
+  breakpoints : iterable of float, optional
+      Angles where f or its derivatives are discontinuous.
+  """
+  if integrator is None:
+    integrator = _DEFAULT_INTEGRATOR
+  return integrator.average(f, breakpoints)
+
+def rms_circle(f, integrator=None, breakpoints=()):
+  """Like average_circle, but calculates the RMS."""
+  return numpy.sqrt(average_circle(lambda t: f(t)**2, integrator, breakpoints))
 
 def three_phases(f, theta):
   offset = numpy.pi * 2 / 3
   return f(theta) + f(theta + offset) + f(theta - offset)
 
-# TODO(Brian): Is this a good idea in any way?
-def max_circle(f):
-  n = 200
-  results = numpy.zeros((n,))
-  epsilon = numpy.pi * 2 / n / 2
-  i = 0
-  for theta in numpy.linspace(0, numpy.pi * 2, n):
-    result = scipy.optimize.minimize(lambda t: -f(t), x0=(theta,),
-                                     bounds=((theta - epsilon,
-                                              theta + epsilon),))
-    if result.success:
-      results[i] = float(result.x)
-    i += 1
-  return numpy.nanmax(f(results))
-
-def _differentiate(f, theta):
-  """Calculates the first derivative of f at theta.
+def three_phases_breakpoints(breakpoints):
+  """Returns the breakpoints of three_phases(f) given the ones of f."""
+  offset = numpy.pi * 2 / 3
+  return _wrap_breakpoints(point + shift for point in breakpoints
+                           for shift in (0, offset, -offset))
+
+def max_circle(f, samples = 2000, candidates = 8, tolerance = 1e-10,
+               breakpoints = ()):
+  """
+  Finds the maximum of f over a whole revolution.
+
+  f is first evaluated on a dense grid, and then the best few points are
+  refined with a golden-section search between their neighbors, all at the
+  same time. Both sides of every breakpoint are in the grid too, so narrow
+  peaks and jumps there can't fall between the grid points.
 
   Arguments
   ---------
   f : callable
-      Function from theta to a scalar.
-  theta : float
-      The point to evaluate the derivative at.
+      Function from an array of thetas to an array of values, with a period of
+      2*pi.
+  samples : int, optional
+      The number of points in the initial grid.
+  candidates : int, optional
+      The number of the best grid points to refine.
+  tolerance : float, optional
+      The width (in radians) to narrow down the location of each maximum to.
+  breakpoints : iterable of float, optional
+      Angles where f or its derivatives are discontinuous.
+
+  Returns
+  -------
+  float
+      The maximum value.
+  """
+  step = numpy.pi * 2 / samples
+  points = numpy.array(_wrap_breakpoints(breakpoints), dtype=float)
+  thetas = numpy.concatenate((numpy.arange(samples) * step, points,
+                              numpy.nextafter(points, numpy.inf),
+                              numpy.nextafter(points, -numpy.inf)))
+  values = f(thetas)
+  candidates = min(candidates, samples)
+  best = thetas[numpy.argpartition(values, -candidates)[-candidates:]]
+  low, high = best - step, best + step
+  ratio = (numpy.sqrt(5) - 1) / 2
+  while (high - low).max() > tolerance:
+    left = high - ratio * (high - low)
+    right = low + ratio * (high - low)
+    left_values, right_values = numpy.split(
+        f(numpy.concatenate((left, right))), 2)
+    keep_left = left_values > right_values
+    high = numpy.where(keep_left, right, high)
+    low = numpy.where(keep_left, low, left)
+  return max(numpy.amax(values), numpy.amax(f((low + high) / 2)))
+
+def zero_crossings(f, breakpoints=(), samples = 2000, tolerance = 1e-12):
+  """
+  Finds where f changes sign over a whole revolution.
+
+  f is first evaluated on a dense grid which includes all the breakpoints, and
+  then every sign change between neighboring points is narrowed down by
+  bisection, all at the same time. Crossings which happen at a breakpoint are
+  returned as that breakpoint.
+
+  Arguments
+  ---------
+  f : callable
+      Function from an array of thetas to an array of values, with a period of
+      2*pi.
+  breakpoints : iterable of float, optional
+      Angles where f or its derivatives are discontinuous.
+  samples : int, optional
+      The number of evenly spaced points in the initial grid.
+  tolerance : float, optional
+      The width (in radians) to narrow down the location of each crossing to.
+
+  Returns
+  -------
+  list of float
+      The sorted crossings in [0, 2*pi).
+
+  Notes
+  -----
+  Pairs of crossings closer together than the grid spacing can be missed.
+  """
+  breakpoints = _wrap_breakpoints(breakpoints)
+  thetas = numpy.union1d(numpy.arange(samples) * (numpy.pi * 2 / samples),
+                         breakpoints)
+  thetas = numpy.append(thetas, numpy.pi * 2)
+  signs = numpy.sign(f(thetas))
+  crossings = list(thetas[:-1][signs[:-1] == 0])
+  changes = numpy.nonzero(signs[:-1] * signs[1:] < 0)[0]
+  low, high = thetas[changes], thetas[changes + 1]
+  low_signs = signs[changes]
+  while len(low) and (high - low).max() > tolerance:
+    middle = (low + high) / 2
+    same = numpy.sign(f(middle)) == low_signs
+    low = numpy.where(same, middle, low)
+    high = numpy.where(same, high, middle)
+  for low_point, high_point in zip(low, high):
+    # A jump at a breakpoint converges onto it from one side.
+    nearby = [point for point in breakpoints
+              if low_point - tolerance <= point <= high_point + tolerance]
+    crossings.append(nearby[0] if nearby else (low_point + high_point) / 2)
+  return _wrap_breakpoints(crossings)
+
+# The step central_difference uses.
+_DIFFERENCE_EPSILON = numpy.pi * 2 / 10000
+
+def central_difference(f, theta, epsilon=None):
+  """Approximates the first derivative of f at theta with a central difference.
+
+  Arguments
+  ---------
+  f : callable
+      Function from an array of thetas to an array of values. It is called
+      once, with both points for every theta.
+  theta : array_like
+      The points to evaluate the derivative at.
+  epsilon : float, optional
+      The step. Defaults to _DIFFERENCE_EPSILON.
 
   Notes
   -----
   f must be a function of theta for the scale of the region we calculate the
   derivative over to make sense.
   """
-  epsilon = numpy.pi * 2 / 10000
-  values = f((theta + epsilon, theta - epsilon))
-  return (values[1] - values[0]) / (epsilon * 2)
-differentiate = numpy.vectorize(_differentiate, otypes=(numpy.float,),
-                                excluded = ['f'])
+  if epsilon is None:
+    epsilon = _DIFFERENCE_EPSILON
+  theta = numpy.asarray(theta, dtype=float)
+  values = f(numpy.stack((theta + epsilon, theta - epsilon)))
+  return (values[0] - values[1]) / (epsilon * 2)
+
+def piecewise_difference(f, breakpoints, theta, epsilon=None):
+  """Approximates the first derivative of a piecewise f at theta, without
+  differencing across any of its breakpoints.
+
+  Near a breakpoint, both points stay inside the piece theta is in, so jumps
+  don't turn into spikes whose height depends on the step. This makes it exact
+  for piecewise-linear f. At a breakpoint itself, it is the derivative of the
+  piece which starts there.
+
+  Arguments
+  ---------
+  f : callable
+      Function from an array of thetas to an array of values, with a period of
+      2*pi. It is called once, with both points for every theta.
+  breakpoints : iterable of float
+      Angles where f or its derivatives are discontinuous.
+  theta : array_like
+      The points to evaluate the derivative at.
+  epsilon : float, optional
+      The step away from breakpoints. Defaults to _DIFFERENCE_EPSILON.
+  """
+  points = numpy.array(_wrap_breakpoints(breakpoints), dtype=float)
+  if not len(points):
+    return central_difference(f, theta, epsilon)
+  if epsilon is None:
+    epsilon = _DIFFERENCE_EPSILON
+  theta = numpy.asarray(theta, dtype=float)
+  edges = numpy.concatenate((points[-1:] - numpy.pi * 2, points,
+                             points[:1] + numpy.pi * 2))
+  wrapped = theta % (numpy.pi * 2)
+  piece = numpy.searchsorted(points, wrapped, side='right')
+  start, end = edges[piece], edges[piece + 1]
+  # Evaluating right at a breakpoint could give the neighboring piece's value.
+  inset = (end - start) * 1e-9
+  low = numpy.maximum(wrapped - epsilon, start + inset)
+  high = numpy.minimum(wrapped + epsilon, end - inset)
+  values = f(numpy.stack((high, low)))
+  return (values[0] - values[1]) / (high - low)
+
+def derivative(f):
+  """
+  Returns the first derivative of f, as a function of theta.
+
+  Objects with a derivative method (models.Waveform and
+  models.CosSumFunction) provide their own, which is exact for sums of
+  harmonics and piecewise-linear waveforms, and spectral for tabulated
+  waveforms. Anything else gets central_difference.
+  """
+  exact = getattr(f, 'derivative', None)
+  if exact is not None:
+    return exact()
+  return functools.partial(central_difference, f)
+
+def differentiate(f, theta):
+  """Calculates the first derivative of f at theta, with derivative(f)."""
+  return derivative(f)(theta)
 
 class OperatingPoint(object):
   """Represents one operating point of a motor.
@@ -110,20 +440,28 @@ class OperatingPoint(object):
       The average power dissipated in the motor in W.
   torque : float
       The average torque (for all phases) in N*m.
+  limit : str or None
+      Which of the limits determined this operating point (one of LIMITS), if
+      known.
   """
   def __init__(self, omega, rms_motor_power, rms_output_power,
-               rms_input_power, average_motor_power, torque):
+               rms_input_power, average_motor_power, torque, limit = None):
     self._omega = omega
     self._rms_motor_power = rms_motor_power
     self._rms_output_power = rms_output_power
     self._rms_input_power = rms_input_power
     self._average_motor_power = average_motor_power
     self._torque = torque
+    self._limit = limit
 
   @property
   def omega(self):
     return self._omega
 
+  @property
+  def limit(self):
+    return self._limit
+
   @property
   def rms_input_power(self):
     """Calculates the RMS power fed into the motor controller.
@@ -200,19 +538,65 @@ class OperatingPoint(object):
     """
     return self.average_output_power / (self.rms_input_power + self.average_output_power)
 
+class OperatingPoints(OperatingPoint):
+  """Represents many operating points of a motor at once.
+
+  This has all the same attributes as OperatingPoint, but each one is an array
+  with one element per operating point. They all have the same shape. Indexing
+  one of these gives an OperatingPoint (for a single element) or another
+  OperatingPoints (for a slice).
+
+  limit is an array of strings.
+  """
+  _FIELDS = ('omega', 'rms_motor_power', 'rms_output_power', 'rms_input_power',
+             'average_motor_power', 'torque', 'limit')
+
+  def __init__(self, omega, rms_motor_power, rms_output_power,
+               rms_input_power, average_motor_power, torque, limit = None):
+    if limit is None:
+      limit = numpy.full(numpy.shape(omega), None, dtype=object)
+    arrays = numpy.broadcast_arrays(omega, rms_motor_power, rms_output_power,
+                                    rms_input_power, average_motor_power,
+                                    torque, limit)
+    super().__init__(*arrays)
+
+  @property
+  def shape(self):
+    return self.omega.shape
+
+  def __len__(self):
+    return len(self.omega)
+
+  def __getitem__(self, index):
+    values = [getattr(self, field)[index] for field in self._FIELDS]
+    if numpy.ndim(values[0]) == 0:
+      return OperatingPoint(*values)
+    return OperatingPoints(*values)
+
+LIMITS = ('torque', 'motor_current', 'input_power', 'voltage')
+"""The names of the limits, in the order MotorController.operating_point takes
+them."""
+
 class MotorController(object):
   """
   Attributes
   ----------
   motor : models.Motor
+  integrator : AdaptiveIntegrator or PeriodicIntegrator or None
+      How to integrate over a revolution, passed to average_circle etc.
   """
-  def __init__(self, motor):
+  def __init__(self, motor, integrator = None):
     self._motor = motor
+    self._integrator = integrator
 
   @property
   def motor(self):
     return self._motor
 
+  @property
+  def integrator(self):
+    return self._integrator
+
   def max_speed(self):
     """
     Calculates the maximum speed at 1V.
@@ -262,3 +646,40 @@ class MotorController(object):
     OperatingPoint
     """
     pass
+
+  def operating_points(self, omega,
+                       max_torque = None,
+                       max_motor_current = None,
+                       max_input_power = None,
+                       max_voltage = None,
+                       ):
+    """
+    Calculates many operating points at once.
+
+    All the arguments are the same as operating_point, except they may be
+    arrays which are broadcast together.
+
+    This implementation calls operating_point for each one. Subclasses should
+    override it with something faster if they can.
+
+    Returns
+    -------
+    OperatingPoints
+        With the broadcast shape of the arguments.
+    """
+    limits = (max_torque, max_motor_current, max_input_power, max_voltage)
+    specified = [limit is not None for limit in limits]
+    broadcast = numpy.broadcast(omega, *[limit for limit in limits
+                                         if limit is not None])
+    points = []
+    for values in broadcast:
+      values = iter(values)
+      point_omega = next(values)
+      point_limits = [next(values) if is_specified else None
+                      for is_specified in specified]
+      points.append(self.operating_point(point_omega, *point_limits))
+    return OperatingPoints(*[
+        numpy.array([getattr(point, field) for point in points],
+                    dtype=object if field == 'limit' else float
+                    ).reshape(broadcast.shape)
+        for field in OperatingPoints._FIELDS])
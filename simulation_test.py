@@ -0,0 +1,187 @@
+#!/usr/bin/python3
+
+import unittest
+import numpy
+
+import models
+import simulation
+
+class TestIntegrators(unittest.TestCase):
+  def test_smooth(self):
+    f = models.CosSum.make_function({0: (0.3, 0), 1: (1, 0.2), 7: (0.1, 1)})
+    integrator = simulation.PeriodicIntegrator(samples=32)
+    value, error = integrator.average_with_error(f)
+    self.assertAlmostEqual(value, 0.3, places=12)
+    self.assertLess(error, 1e-12)
+    self.assertAlmostEqual(simulation.rms_circle(f, integrator),
+                           simulation.rms_circle(f), places=10)
+
+  def test_piecewise(self):
+    integrator = simulation.PeriodicIntegrator()
+    adaptive = simulation.AdaptiveIntegrator()
+    for waveform in (models.trapezoid, models.trapezoid_6step,
+                     models.trapezoid_4step, models.square):
+      def f(theta):
+        return numpy.abs(waveform(theta) * models.BOMA.f(theta))
+      breakpoints = waveform.breakpoints + (0, numpy.pi)
+      with self.subTest(waveform=waveform.__doc__):
+        value, error = integrator.average_with_error(f, breakpoints)
+        self.assertLess(error, 1e-10)
+        self.assertAlmostEqual(value, adaptive.average(f, breakpoints),
+                               places=10)
+        total_breakpoints = simulation.three_phases_breakpoints(breakpoints)
+        self.assertAlmostEqual(
+            simulation.rms_circle(lambda t: simulation.three_phases(f, t),
+                                  integrator, total_breakpoints),
+            simulation.rms_circle(lambda t: simulation.three_phases(f, t)),
+            places=8)
+
+  def test_tolerance(self):
+    integrator = simulation.PeriodicIntegrator(samples=4, tolerance=1e-10)
+    value, error = integrator.average_with_error(
+        lambda t: numpy.exp(numpy.sin(t)))
+    self.assertLessEqual(error, 1e-10)
+    self.assertAlmostEqual(value, 1.2660658777520082, places=10)
+    calls = []
+    def f(theta):
+      calls.append(len(theta))
+      return numpy.abs(numpy.sin(theta)) ** 0.5
+    with self.assertRaises(ValueError):
+      simulation.PeriodicIntegrator(samples=4, tolerance=1e-10,
+                                    max_samples=16).average(f)
+    # It stops at max_samples, rather than trying twice as many.
+    self.assertEqual(calls, [8, 16])
+
+  def test_breakpoints(self):
+    self.assertEqual(simulation.three_phases_breakpoints(()), [])
+    self.assertEqual(len(simulation.three_phases_breakpoints((0,))), 3)
+    self.assertEqual(len(simulation.three_phases_breakpoints(
+        models.trapezoid_6step.breakpoints)), 6)
+
+class TestMaxCircle(unittest.TestCase):
+  @staticmethod
+  def reference_max_circle(f):
+    '''A slow but straightforward version, with a separate bounded
+    optimization around each of many starting points.'''
+    import scipy.optimize
+
+    n = 200
+    epsilon = numpy.pi * 2 / n / 2
+    results = []
+    for theta in numpy.linspace(0, numpy.pi * 2, n):
+      result = scipy.optimize.minimize(lambda t: -f(t), x0=(theta,),
+                                       bounds=((theta - epsilon,
+                                                theta + epsilon),))
+      if result.success:
+        results.append(result.x[0])
+    return numpy.amax(f(numpy.array(results)))
+
+  def test_matches_reference(self):
+    for coeff in ({1: (1, 0)}, {1: (1, 0.3), 5: (0.2, 1), 7: (0.05, -2)},
+                  {1: (0.1, 0), 11: (0.3, 0.1), 13: (0.3, 0)}):
+      cos_sum = models.CosSum.make_function(coeff)
+      for f in (cos_sum, lambda t: numpy.abs(cos_sum(t)),
+                lambda t: cos_sum(t) - cos_sum(t + numpy.pi * 2 / 3)):
+        with self.subTest(coeff=coeff, f=f):
+          self.assertAlmostEqual(simulation.max_circle(f),
+                                 self.reference_max_circle(f), places=9)
+
+  def test_piecewise(self):
+    '''Narrow peaks at breakpoints, like the central differences of jumps,
+    match a brute-force search of a dense grid.'''
+    thetas = numpy.linspace(0, numpy.pi * 2, 4000001)
+    for name in ('square', 'trapezoid', 'trapezoid_6step', 'trapezoid_4step'):
+      waveform = getattr(models, name)
+      for f in (waveform, waveform.derivative(), -waveform.derivative(),
+                waveform - waveform.shift(numpy.pi * 2 / 3)):
+        with self.subTest(name=name, f=f):
+          self.assertAlmostEqual(
+              simulation.max_circle(f, breakpoints=f.breakpoints),
+              numpy.amax(f(thetas)), places=6)
+
+  def test_wraps(self):
+    self.assertAlmostEqual(simulation.max_circle(
+        lambda t: numpy.cos(t - 1e-4), samples=100), 1, places=12)
+
+class TestZeroCrossings(unittest.TestCase):
+  def test_smooth(self):
+    numpy.testing.assert_allclose(
+        simulation.zero_crossings(lambda t: numpy.sin(t - 0.3)),
+        (0.3, numpy.pi + 0.3), atol=1e-11)
+    numpy.testing.assert_allclose(
+        simulation.zero_crossings(lambda t: numpy.cos(3 * t)),
+        numpy.arange(1, 12, 2) * numpy.pi / 6, atol=1e-11)
+    self.assertEqual(simulation.zero_crossings(lambda t: numpy.cos(t) + 2),
+                     [])
+
+  def test_jumps(self):
+    # Jumps across zero land exactly on the breakpoint.
+    self.assertEqual(simulation.zero_crossings(
+        lambda t: numpy.where((t - 1) % (numpy.pi * 2) < 2, 1.0, -1.0),
+        (1, 3), samples=7), [1.0, 3.0])
+    self.assertEqual(simulation.zero_crossings(models.square,
+                                               models.square.breakpoints),
+                     [0.0, numpy.pi])
+
+class TestDerivative(unittest.TestCase):
+  def setUp(self):
+    self.theta = numpy.linspace(-1, 7, 801).reshape((3, -1))
+
+  def test_central_difference(self):
+    calls = []
+    def f(theta):
+      calls.append(numpy.shape(theta))
+      return numpy.sin(theta)
+    numpy.testing.assert_allclose(simulation.central_difference(f, self.theta),
+                                  numpy.cos(self.theta), atol=1e-6)
+    # Every point is done in a single call.
+    self.assertEqual(calls, [(2,) + self.theta.shape])
+    self.assertAlmostEqual(float(simulation.differentiate(numpy.sin, 0.5)),
+                           numpy.cos(0.5), places=6)
+
+  def test_exact(self):
+    for f in (models.sin, models.BOMA.f, models.T20.line_line_f,
+              models.sin * 2 + models.sin.shift(0.3) * models.sin):
+      with self.subTest(f=f):
+        numpy.testing.assert_allclose(
+            simulation.differentiate(f, self.theta),
+            simulation.central_difference(f, self.theta, epsilon=1e-5),
+            atol=1e-8)
+    numpy.testing.assert_array_equal(
+        simulation.differentiate(models.sin, self.theta),
+        numpy.cos(self.theta))
+
+  def test_fallback(self):
+    numpy.testing.assert_array_equal(
+        simulation.differentiate(lambda theta: models.trapezoid(theta),
+                                 self.theta),
+        simulation.central_difference(models.trapezoid, self.theta))
+
+  def test_piecewise(self):
+    # The slopes of the trapezoid's pieces, starting at pi / 6.
+    slopes = numpy.array((0, 0, -6 / numpy.pi, 0, 0, 6 / numpy.pi))
+    edges = models.trapezoid.breakpoints
+    thetas = numpy.concatenate((self.theta.ravel(), edges,
+                                numpy.nextafter(edges, -numpy.inf)))
+    # Exactly at a breakpoint, it's the slope of the piece starting there.
+    expected = numpy.concatenate((
+        slopes[((self.theta.ravel() - numpy.pi / 6) // (numpy.pi / 3)).astype(
+            int) % 6], slopes, numpy.roll(slopes, 1)))
+    for epsilon in (None, 1e-5, 1):
+      with self.subTest(epsilon=epsilon):
+        numpy.testing.assert_allclose(
+            simulation.piecewise_difference(models.trapezoid, edges, thetas,
+                                            epsilon),
+            expected, atol=1e-9)
+    numpy.testing.assert_array_equal(
+        simulation.differentiate(models.trapezoid, thetas),
+        simulation.piecewise_difference(models.trapezoid, edges, thetas))
+    # Jumps don't show up at all.
+    numpy.testing.assert_allclose(
+        simulation.differentiate(models.square, thetas), 0, atol=1e-9)
+    numpy.testing.assert_array_equal(
+        simulation.piecewise_difference(numpy.sin, (), self.theta),
+        simulation.central_difference(numpy.sin, self.theta))
+
+if __name__ == '__main__':
+  unittest.main()
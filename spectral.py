@@ -0,0 +1,115 @@
+r'''This module does exact math on periodic functions which are finite sums of
+harmonics.
+
+A Spectrum holds the complex Fourier coefficients $X_k$ for $k = -K \dots K$ of
+a real function with period $2\pi$, such that
+$f(\theta) = \sum_k X_k e^{i k \theta}$.
+Products, phase shifts, and averages and RMS values over a whole revolution are
+then exact operations on the coefficients, which avoids numerically
+integrating anything.
+
+This only works for functions with a finite number of integer harmonics. Use
+Spectrum.of to find out whether a function has one. Anything else (including
+the absolute value of a sum of harmonics) needs numeric integration instead.
+'''
+
+import numpy
+
+import models
+
+class Spectrum(object):
+  '''The Fourier coefficients of a real function with period 2*pi.
+
+  Attributes
+  ----------
+  coefficients : numpy.ndarray
+      The complex coefficients for harmonics -K through K, in order.
+  '''
+  def __init__(self, coefficients):
+    coefficients = numpy.asarray(coefficients, dtype=complex)
+    assert coefficients.ndim == 1 and len(coefficients) % 2 == 1
+    self._coefficients = coefficients
+
+  @staticmethod
+  def from_coeff(coeff):
+    r'''Creates a Spectrum from a mapping from a to (b, c), such that the
+    function is $\sum b * cos(a * \theta + c)$.
+
+    Returns None if any a is not a non-negative integer, because those don't
+    have a period of 2*pi.'''
+    harmonics = list(coeff)
+    if not all(float(a).is_integer() and a >= 0 for a in harmonics):
+      return None
+    size = int(max(harmonics + [0]))
+    coefficients = numpy.zeros((size * 2 + 1,), dtype=complex)
+    for a, x in models.two_sided(coeff).items():
+      coefficients[size + int(a)] += x
+    return Spectrum(coefficients)
+
+  @staticmethod
+  def of(f, tolerance=None):
+    '''Returns the Spectrum of f, or None if it doesn't have one.
+
+    This works for models.CosSumFunction objects (such as models.Motor.f) and
+    models.Waveform objects with harmonics. If tolerance is given, any other
+    models.Waveform is approximated with models.Waveform.harmonic_series
+    instead.'''
+    if isinstance(f, models.CosSumFunction):
+      return Spectrum.from_coeff(f.coeff)
+    harmonics = getattr(f, 'harmonics', None)
+    if harmonics is not None:
+      return Spectrum.from_coeff(harmonics)
+    if tolerance is not None and isinstance(f, models.Waveform):
+      return Spectrum.from_coeff(f.harmonic_series(tolerance)[0])
+    return None
+
+  @property
+  def coefficients(self):
+    return self._coefficients
+
+  @property
+  def size(self):
+    '''The highest harmonic represented.'''
+    return len(self._coefficients) // 2
+
+  def _padded(self, size):
+    padding = size - self.size
+    return numpy.pad(self._coefficients, (padding, padding), 'constant')
+
+  def __add__(self, other):
+    size = max(self.size, other.size)
+    return Spectrum(self._padded(size) + other._padded(size))
+
+  def __mul__(self, other):
+    if isinstance(other, Spectrum):
+      return Spectrum(numpy.convolve(self._coefficients, other._coefficients))
+    return Spectrum(self._coefficients * other)
+
+  __rmul__ = __mul__
+
+  def shift(self, offset):
+    '''Returns the Spectrum of theta -> f(theta + offset).'''
+    k = numpy.arange(-self.size, self.size + 1)
+    return Spectrum(self._coefficients * numpy.exp(1j * k * offset))
+
+  def three_phases(self):
+    '''The equivalent of simulation.three_phases.'''
+    offset = numpy.pi * 2 / 3
+    return self + self.shift(offset) + self.shift(-offset)
+
+  def average(self):
+    '''The average over a whole revolution.'''
+    return self._coefficients[self.size].real
+
+  def rms(self):
+    '''The RMS over a whole revolution, via Parseval's theorem.'''
+    return numpy.sqrt(numpy.sum(numpy.abs(self._coefficients) ** 2))
+
+  def __call__(self, theta):
+    theta = numpy.asarray(theta, dtype=float)
+    k = numpy.arange(-self.size, self.size + 1)
+    return (numpy.exp(1j * numpy.multiply.outer(theta, k)) @
+            self._coefficients).real
+
+  def __repr__(self):
+    return 'Spectrum(%r)' % (self._coefficients,)
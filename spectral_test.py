@@ -0,0 +1,62 @@
+#!/usr/bin/python3
+
+import unittest
+import numpy
+
+import models
+import simulation
+import spectral
+
+class TestSpectrum(unittest.TestCase):
+  def setUp(self):
+    self.theta = numpy.linspace(0, numpy.pi * 2, 500)
+
+  def test_evaluate(self):
+    for coeff in ({1: (1, 0)}, {0: (0.5, 0.2), 1: (1, -numpy.pi / 2)},
+                  {1: (1, 0.3), 5: (0.2, 1), 7: (0.05, -2)}):
+      with self.subTest(coeff=coeff):
+        spectrum = spectral.Spectrum.from_coeff(coeff)
+        numpy.testing.assert_allclose(
+            spectrum(self.theta), models.CosSum.make_function(coeff)(self.theta),
+            atol=1e-12)
+
+  def test_of(self):
+    self.assertIsNotNone(spectral.Spectrum.of(models.BOMA.f))
+    self.assertIsNotNone(spectral.Spectrum.of(models.sin))
+    self.assertIsNotNone(spectral.Spectrum.of(
+        models.make_sin_constant(models.T20.f_coeff)))
+    self.assertIsNone(spectral.Spectrum.of(models.square))
+    self.assertIsNone(spectral.Spectrum.of(numpy.sin))
+    self.assertIsNone(spectral.Spectrum.from_coeff({1.5: (1, 0)}))
+
+  def test_of_tolerance(self):
+    spectrum = spectral.Spectrum.of(models.trapezoid, tolerance=1e-3)
+    numpy.testing.assert_allclose(spectrum(self.theta),
+                                  models.trapezoid(self.theta), atol=1e-2)
+    self.assertAlmostEqual(spectrum.rms(), numpy.sqrt(7 / 9), places=5)
+    self.assertIsNone(spectral.Spectrum.of(numpy.sin, tolerance=1e-3))
+
+  def test_integrals(self):
+    f = models.CosSum.make_function({1: (1, -numpy.pi / 2), 5: (0.2, 0.4)})
+    g = models.CosSum.make_function({1: (2, -numpy.pi / 2), 7: (0.1, 1.3)})
+    product = spectral.Spectrum.of(f) * spectral.Spectrum.of(g)
+    def numeric_product(theta):
+      return f(theta) * g(theta)
+    def numeric_total(theta):
+      return simulation.three_phases(numeric_product, theta)
+    self.assertAlmostEqual(product.average(),
+                           simulation.average_circle(numeric_product))
+    self.assertAlmostEqual(product.rms(),
+                           simulation.rms_circle(numeric_product))
+    self.assertAlmostEqual(product.three_phases().average(),
+                           simulation.average_circle(numeric_total))
+    self.assertAlmostEqual(product.three_phases().rms(),
+                           simulation.rms_circle(numeric_total))
+
+  def test_shift(self):
+    spectrum = spectral.Spectrum.of(models.T20.f)
+    numpy.testing.assert_allclose(spectrum.shift(0.7)(self.theta),
+                                  models.T20.f(self.theta + 0.7), atol=1e-12)
+
+if __name__ == '__main__':
+  unittest.main()
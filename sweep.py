@@ -0,0 +1,221 @@
+#!/usr/bin/python3
+
+'''This module evaluates every combination of some motors, current waveforms
+and gear ratios over a grid of output speeds and voltages.
+
+Controllers are built and evaluated in a pool of worker processes, one
+(motor, waveform) pair per task. Each task returns one block of rows of a
+NumPy structured array (with the columns in FIELDS), and the blocks are
+collected or written out in a fixed order, so the results don't depend on how
+many workers there are.
+
+Speeds are output shaft speeds (after the gear ratio) in mechanical rad/s, and
+torques are output shaft torques in N*m.
+'''
+
+import argparse
+import concurrent.futures
+import sys
+
+import numpy
+
+import models
+import simple
+import simulation
+
+MOTORS = {'BOMA': models.BOMA, 'MY1020': models.MY1020, 'T20': models.T20}
+
+class PerMotor(object):
+  '''A waveform which depends on the motor, such as one from
+  models.make_sin_constant.
+
+  make is called with each motor to create the actual waveform. It must be
+  picklable (for example a module-level function) to use multiple workers.'''
+  def __init__(self, make):
+    self._make = make
+
+  def __call__(self, motor):
+    return self._make(motor)
+
+def sin_constant(motor):
+  '''Returns the constant-torque sinusoidal waveform for motor.'''
+  return models.make_sin_constant(motor.f_coeff)
+
+WAVEFORMS = {'sin': models.sin,
+             'trapezoid': models.trapezoid,
+             'trapezoid_6step': models.trapezoid_6step,
+             'trapezoid_4step': models.trapezoid_4step,
+             'square': models.square,
+             'sin_constant': PerMotor(sin_constant)}
+
+# The float columns, after the motor and waveform names.
+_FLOAT_FIELDS = ('gear_ratio', 'speed', 'voltage', 'omega', 'torque',
+                 'rms_input_power', 'average_input_power', 'rms_motor_power',
+                 'average_motor_power', 'average_output_power', 'efficiency')
+FIELDS = ('motor', 'waveform') + _FLOAT_FIELDS + ('limit',)
+
+def _dtype(motors, waveforms):
+  def name_length(names):
+    return max([len(name) for name in names] + [1])
+  limit_length = max(len(name) for name in simulation.LIMITS)
+  return numpy.dtype(
+      [('motor', 'U%d' % name_length(motors)),
+       ('waveform', 'U%d' % name_length(waveforms))] +
+      [(name, float) for name in _FLOAT_FIELDS] +
+      [('limit', 'U%d' % limit_length)])
+
+def _evaluate(task):
+  '''Builds one controller and evaluates all the points for it.
+
+  Returns a structured array with the rows for each gear ratio, speed and
+  voltage, in that order.'''
+  (dtype, motor_name, motor, waveform_name, waveform, gear_ratios, speeds,
+   voltages, limits, integrator, cache) = task
+  if isinstance(waveform, PerMotor):
+    waveform = waveform(motor)
+  controller = simple.SimpleController(motor, waveform, integrator=integrator,
+                                       cache=cache)
+
+  gear_ratios, speeds, voltages = numpy.meshgrid(gear_ratios, speeds, voltages,
+                                                 indexing='ij')
+  omega = speeds * gear_ratios * motor.electrical_ratio
+  # Braking isn't supported, so skip the points where the back EMF is too high.
+  valid = omega / controller.max_speed() <= voltages
+  points = controller.operating_points(numpy.where(valid, omega, 0),
+                                       max_voltage=voltages, **limits)
+
+  rows = numpy.zeros(omega.size, dtype=dtype)
+  rows['motor'] = motor_name
+  rows['waveform'] = waveform_name
+  mechanical_ratio = gear_ratios * motor.electrical_ratio
+  with numpy.errstate(divide='ignore', invalid='ignore'):
+    efficiency = points.efficiency
+  columns = {
+      'gear_ratio': gear_ratios,
+      'speed': speeds,
+      'voltage': voltages,
+      'omega': omega,
+      'torque': points.torque * mechanical_ratio,
+      'rms_input_power': points.rms_input_power,
+      'average_input_power': points.average_input_power,
+      'rms_motor_power': points.rms_motor_power,
+      'average_motor_power': points.average_motor_power,
+      'average_output_power': points.average_output_power,
+      'efficiency': efficiency,
+      }
+  for name, values in columns.items():
+    if name not in ('gear_ratio', 'speed', 'voltage', 'omega'):
+      values = numpy.where(valid, values, numpy.nan)
+    rows[name] = values.reshape(-1)
+  rows['limit'] = numpy.where(valid, points.limit, '').reshape(-1)
+  return rows
+
+def _write_csv(output, rows):
+  formats = ['%s' if rows.dtype[name].kind == 'U' else '%.17g'
+             for name in rows.dtype.names]
+  numpy.savetxt(output, rows, fmt=formats, delimiter=',')
+
+def sweep(motors, waveforms, gear_ratios, speeds, voltages,
+          max_motor_current = None, max_input_power = None,
+          workers = None, output = None, integrator = None, cache = None):
+  '''Evaluates every combination of motor, waveform, gear ratio, speed and
+  voltage.
+
+  Arguments
+  ---------
+  motors : mapping from str to models.Motor
+  waveforms : mapping from str to models.Waveform or PerMotor
+  gear_ratios : array of float
+      Motor rotations per output rotation.
+  speeds : array of float
+      Output speeds in rad/s.
+  voltages : array of float
+      Maximum input voltages in V.
+  max_motor_current, max_input_power : float, optional
+      Additional limits, passed to operating_points.
+  workers : int, optional
+      The number of worker processes. None means one per CPU, and 1 means to
+      do everything in this process.
+  output : file, optional
+      A text file to write CSV rows (with a header) to as they're calculated,
+      instead of returning them.
+  integrator, cache : optional
+      Passed to each simple.SimpleController.
+
+  Returns
+  -------
+  numpy.ndarray or int
+      The structured array of all rows, or the number of rows written if
+      output was specified. Rows are ordered by motor, waveform, gear ratio,
+      speed, and then voltage.
+  '''
+  dtype = _dtype(motors, waveforms)
+  limits = {}
+  if max_motor_current is not None:
+    limits['max_motor_current'] = max_motor_current
+  if max_input_power is not None:
+    limits['max_input_power'] = max_input_power
+  tasks = [(dtype, motor_name, motor, waveform_name, waveform,
+            numpy.asarray(gear_ratios, dtype=float),
+            numpy.asarray(speeds, dtype=float),
+            numpy.asarray(voltages, dtype=float),
+            limits, integrator, cache)
+           for motor_name, motor in motors.items()
+           for waveform_name, waveform in waveforms.items()]
+
+  if output is not None:
+    output.write(','.join(FIELDS) + '\n')
+  blocks = []
+  count = 0
+  if workers == 1:
+    executor = None
+    results = map(_evaluate, tasks)
+  else:
+    executor = concurrent.futures.ProcessPoolExecutor(workers)
+    results = executor.map(_evaluate, tasks)
+  try:
+    for rows in results:
+      count += len(rows)
+      if output is None:
+        blocks.append(rows)
+      else:
+        _write_csv(output, rows)
+  finally:
+    if executor is not None:
+      executor.shutdown()
+  if output is not None:
+    return count
+  return numpy.concatenate(blocks) if blocks else numpy.zeros(0, dtype=dtype)
+
+def _float_list(text):
+  '''Parses either a comma-separated list or start:stop:step.'''
+  if ':' in text:
+    return numpy.arange(*[float(part) for part in text.split(':')])
+  return numpy.array([float(part) for part in text.split(',')])
+
+def main(argv):
+  parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+  parser.add_argument('--motors', default=','.join(MOTORS),
+                      help='Comma-separated names from %s' % ', '.join(MOTORS))
+  parser.add_argument('--waveforms', default=','.join(WAVEFORMS),
+                      help='Comma-separated names from %s' %
+                      ', '.join(WAVEFORMS))
+  parser.add_argument('--gear-ratios', type=_float_list, default='1')
+  parser.add_argument('--speeds', type=_float_list, default='0:1000:10',
+                      help='Output speeds in rad/s, as a list or start:stop:step')
+  parser.add_argument('--voltages', type=_float_list, default='12,24,48')
+  parser.add_argument('--max-motor-current', type=float)
+  parser.add_argument('--max-input-power', type=float)
+  parser.add_argument('--workers', type=int)
+  parser.add_argument('--output', type=argparse.FileType('w'),
+                      default=sys.stdout)
+  args = parser.parse_args(argv)
+  sweep({name: MOTORS[name] for name in args.motors.split(',')},
+        {name: WAVEFORMS[name] for name in args.waveforms.split(',')},
+        args.gear_ratios, args.speeds, args.voltages,
+        max_motor_current=args.max_motor_current,
+        max_input_power=args.max_input_power,
+        workers=args.workers, output=args.output)
+
+if __name__ == '__main__':
+  main(sys.argv[1:])
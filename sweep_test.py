@@ -0,0 +1,61 @@
+#!/usr/bin/python3
+
+import io
+import unittest
+import numpy
+
+import models
+import simple
+import sweep
+
+class SweepTest(unittest.TestCase):
+  _MOTORS = {'BOMA': models.BOMA, 'T20': models.T20}
+  _WAVEFORMS = {'sin': models.sin, 'square': models.square,
+                'sin_constant': sweep.PerMotor(sweep.sin_constant)}
+
+  def run_sweep(self, **kwargs):
+    return sweep.sweep(self._MOTORS, self._WAVEFORMS, gear_ratios=(1, 4),
+                       speeds=numpy.linspace(0, 400, 5), voltages=(12, 48),
+                       max_motor_current=100, **kwargs)
+
+  def test_values(self):
+    rows = self.run_sweep(workers=1)
+    self.assertEqual(len(rows), 2 * 3 * 2 * 5 * 2)
+    self.assertEqual(tuple(rows.dtype.names), sweep.FIELDS)
+    self.assertEqual(list(rows['motor'][:60]), ['BOMA'] * 60)
+    self.assertEqual(list(rows['waveform'][:20]), ['sin'] * 20)
+    controller = simple.SimpleController(models.T20, models.square)
+    for row in rows[(rows['motor'] == 'T20') & (rows['waveform'] == 'square')]:
+      omega = row['speed'] * row['gear_ratio'] * models.T20.electrical_ratio
+      self.assertEqual(row['omega'], omega)
+      if omega / controller.max_speed() > row['voltage']:
+        self.assertTrue(numpy.isnan(row['torque']))
+        self.assertEqual(row['limit'], '')
+        continue
+      point = controller.operating_point(omega, max_voltage=row['voltage'],
+                                         max_motor_current=100)
+      self.assertAlmostEqual(
+          row['torque'],
+          point.torque * row['gear_ratio'] * models.T20.electrical_ratio)
+      self.assertAlmostEqual(row['rms_input_power'], point.rms_input_power)
+      self.assertEqual(row['limit'], point.limit)
+
+  def test_workers(self):
+    serial = self.run_sweep(workers=1)
+    parallel = self.run_sweep(workers=2)
+    self.assertEqual(serial.tobytes(), parallel.tobytes())
+
+  def test_csv(self):
+    output = io.StringIO()
+    count = self.run_sweep(workers=2, output=output)
+    rows = self.run_sweep(workers=1)
+    self.assertEqual(count, len(rows))
+    lines = output.getvalue().splitlines()
+    self.assertEqual(lines[0], ','.join(sweep.FIELDS))
+    self.assertEqual(len(lines), len(rows) + 1)
+    parsed = numpy.genfromtxt(io.StringIO(output.getvalue()), delimiter=',',
+                              names=True, dtype=None, encoding='utf-8')
+    numpy.testing.assert_array_equal(parsed['torque'], rows['torque'])
+
+if __name__ == '__main__':
+  unittest.main()
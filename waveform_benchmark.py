@@ -0,0 +1,47 @@
+#!/usr/bin/python3
+
+'''Measures how long the built-in waveforms take to evaluate per sample.
+
+Each one is timed through numpy.vectorize of its scalar function (which is how
+all of them used to be evaluated), and through the Waveform itself.'''
+
+import argparse
+import sys
+import timeit
+
+import numpy
+
+import models
+
+WAVEFORMS = ('trapezoid', 'trapezoid_6step', 'trapezoid_4step', 'square',
+             'sin')
+
+def time_per_sample(f, theta, repeat):
+  '''Returns the fastest time f(theta) took out of repeat runs, in seconds per
+  element of theta.'''
+  return min(timeit.repeat(lambda: f(theta), number=1,
+                           repeat=repeat)) / len(theta)
+
+def main(argv):
+  parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+  parser.add_argument('--samples', type=int, default=100000,
+                      help='How many thetas to evaluate at a time')
+  parser.add_argument('--repeat', type=int, default=5,
+                      help='How many times to time each one')
+  args = parser.parse_args(argv)
+
+  theta = numpy.linspace(-numpy.pi * 4, numpy.pi * 4, args.samples)
+  print('%-16s %12s %12s %8s' % ('waveform', 'scalar ns', 'vector ns',
+                                 'speedup'))
+  for name in WAVEFORMS:
+    waveform = getattr(models, name)
+    scalar = time_per_sample(
+        numpy.vectorize(waveform._scalar_f, otypes=(float,)), theta,
+        args.repeat)
+    vectorized = time_per_sample(waveform, theta, args.repeat)
+    print('%-16s %12.1f %12.1f %7.0fx' % (name, scalar * 1e9, vectorized * 1e9,
+                                          scalar / vectorized))
+  return 0
+
+if __name__ == '__main__':
+  sys.exit(main(sys.argv[1:]))